@@ -2,6 +2,7 @@
 #define _DEFAULT_SOURCE
 #include <sys/types.h>
 #include <sys/stat.h>
+#include <sys/mman.h>
 #include <fts.h>
 #include <stdint.h>   /* god these includes are boring */
 #include <stdbool.h>
@@ -12,15 +13,34 @@
 #include <errno.h>    /* someone should make everythingposix.h */
 #include <string.h>   /* probably take 100 years to compile though */
 #include <fnmatch.h>
+#include <limits.h>
 #include <assert.h>
+#include <pthread.h>
+#include <time.h>
+#include <dirent.h>
+#include <spawn.h>
+#include <sys/wait.h>
+#ifdef __linux__
+#include <sys/inotify.h>
+#include <sys/syscall.h>
+#include <poll.h>
+#endif
+#ifdef __SSE2__
+#include <emmintrin.h>
+#endif
 
 #include "cfilepirate.h"
 
-/* Memory allocation attempts to increase by a power of 2 each time, 
- * stopping at MEM_MAX, which is 64 megabytes by default.
+/* Each memory pool reserves address space for its whole budget up front, and
+ * commits it as it grows, so it never moves and growing it never copies.
+ * The committed size doubles each time, by no more than MEM_MAX at once.
+ * MEM_LIMIT is the default budget, which can be changed with
+ * fp_set_memory_limit().
  */
 #define MEM_MIN (1 * 1024 * 1024)
 #define MEM_MAX (64 * 1024 * 1024)
+#define MEM_LIMIT_MAX ((size_t)UINT32_MAX) // Distances to parent directories are 32 bits
+#define MEM_LIMIT (sizeof(void *) > 4 ? MEM_LIMIT_MAX : (size_t)512 * 1024 * 1024)  // Just under 4096MB on 64-bit
 #define ERROR printf
 #define INFO  printf
 
@@ -31,47 +51,304 @@
  * Directory entry structure:
  *
  * Offset    Name        Desc
- * 4 bytes   dir_len     Length of directory name including null pointer.
- * 1+ bytes  dirname     Directory name, null terminated
+ * 4 bytes   dir_len     Length of the directory's base name including null pointer.
+ * 8 bytes   dir_mask    Characters present in the full directory path (see charmask())
+ * 4 bytes   dir_parent  Distance back to the parent directory's first entry, or 0 for the root
+ * 4 bytes   path_len    strlen() of the full directory path
+ * 1+ bytes  dirname     Base name of the directory, null terminated
  * 4 bytes   fn_len      Length of file name including null pointer.
+ * 8 bytes   fn_mask     Characters present in the file name
  * 1+ bytes  filename    Base file name, null terminated
  * ...       ...         More filenames
+ * 4 bytes   0           Zero length indicates the end of this directory
  * 1 byte    0           Final extra nul indicates a new directory name
- * 1+ bytes  dirname     Directory name, null terminated
+ * 4 bytes   dir_len     Length of the next directory name...
+ *
+ * Every directory entry, including the last one in the pool, is terminated,
+ * so the watcher can append new directory entries to the end of the pool.
+ * The same directory may appear in several directory entries. The first one
+ * is written when the directory is entered, even if it has no files, so that
+ * its subdirectories can refer to it. Parents always come before children.
+ * Full paths are only put together for results (see dir_path()).
+ *
+ * Files removed by the watcher are not unlinked from the pool; instead
+ * FP_DELETED is set in their fn_len, and the scan skips them.
+ *
+ * The masks let the scan reject most names without calling fp_strstr(): a
+ * name can only match if it contains every character of the search term.
+ * They aren't aligned, so always access them with read_mask().
  */
 
-#define DIRENT_HEADER_SIZE (sizeof(unsigned int) + sizeof(unsigned int))
+typedef uint64_t charmask_t;
+
+#define DIRENT_HEADER_SIZE (sizeof(unsigned int) + sizeof(charmask_t))
+#define DIR_HEADER_SIZE (DIRENT_HEADER_SIZE + 2 * sizeof(uint32_t))
+#define DIRENT_TERMINATOR_SIZE (sizeof(unsigned int) + 1)
+#define FP_DELETED 0x80000000u
 
 struct memory_pool
 {
 	uint8_t *start;
 	uintptr_t next;  // bump pointer
-	uintptr_t size;
+	uintptr_t size;  // committed
+	uintptr_t limit; // reserved
+};
+
+/* A filter pattern. Patterns follow .gitignore: "!" in front includes again
+ * what an earlier pattern left out, "/" at the end matches only directories,
+ * and "/" anywhere else anchors the pattern to the root, so that it matches
+ * the whole path relative to the root ("**" matching any number of
+ * directories). Other patterns match the base name, at any depth. */
+struct filter_rule {
+	char *pattern;             // With the syntax above taken off
+	bool negate;
+	bool dir_only;
+	bool anchored;
+};
+
+/* Literal strings, each mapped to the last rule it matches */
+struct filter_table {
+	struct filter_slot {
+		const char *key;
+		int rule;
+	} *slots;
+	uint32_t mask;
+};
+
+/* Filter patterns, compiled as they are added. Most patterns are a plain
+ * name or "*.ext", which are found with one lookup whatever the number of
+ * patterns; the rest are matched in turn. The last rule to match wins. */
+struct filter {
+	struct filter_rule *rules;
+	int num_rules;
+	struct filter_table names;     // Plain base names, e.g. "node_modules"
+	struct filter_table dir_names; // ... which match only directories, e.g. "build/"
+	struct filter_table suffixes;  // "*.ext", keyed by ".ext"
+	int *globs;                    // Indexes of every other rule, in order
+	int num_globs;
+	bool anchored;                 // Some rule needs the whole path
+};
+
+/* A directory watched for changes. */
+struct watched_dir {
+	char *path;                // Directory name as stored in the pool, or NULL if unused
+	uintptr_t *blocks;         // Pool indices of every directory entry for this directory
+	unsigned int num_blocks;
+	unsigned int max_blocks;
+};
+
+struct watch {
+	int fd;                    // inotify descriptor, or -1 when not watching
+	struct watched_dir *dirs;  // Indexed by watch descriptor
+	int max_wd;
+	int tail_wd;               // Owner of the last directory entry in the pool, if watched
+};
+
+/* The on-disk cache. The file layout is:
+ *
+ * struct cache_header
+ * root dirname, null terminated and padded to a multiple of 8 bytes
+ * struct dir_stamp for every directory walked (including empty ones)
+ * The pool, exactly as described above, starting from 'files'
+ *
+ * The cache is valid as long as no directory's mtime has changed, since
+ * creating, removing or renaming anything in a directory updates its mtime.
+ * Bump FP_CACHE_VERSION whenever the pool layout changes.
+ */
+#define FP_CACHE_MAGIC "FPIRATE"
+#define FP_CACHE_VERSION 3
+#define FP_CACHE_BYTE_ORDER 0x01020304u
+
+struct cache_header {
+	char magic[8];
+	uint32_t byte_order;
+	uint32_t version;
+	uint64_t root_size;       // Including nul and padding
+	uint64_t num_stamps;
+	uint64_t stamps_size;
+	uint64_t pool_size;
+};
+
+struct dir_stamp {
+	int64_t mtime_sec;
+	uint32_t mtime_nsec;
+	uint32_t size;            // Size of this stamp, including the path, nul and padding
+	char path[];
+};
+
+/* Searches are divided into partitions, each starting at a directory entry.
+ * Partitions are handed out to the threads in the worker pool (and the
+ * thread calling fp_get_candidates) as they become free. Each partition has
+ * its own candidate list, and the lists are merged in pool order at the end,
+ * so the result doesn't depend on how many threads there are. */
+#define PARTITIONS_PER_THREAD 4
+#define PARTITION_MIN_SIZE (64 * 1024)
+
+/* fp_cancel() may be called from another thread to abandon the current
+ * search. The scan checks for cancellation every CANCEL_CHECK_INTERVAL files
+ * and directories. */
+#define CANCEL_CHECK_INTERVAL 1024
+
+/* Partial results. If fp_set_progress() has set an interval, each thread
+ * copies the best candidates of the partition it is scanning to the
+ * partition's published list that often (checking the time along with
+ * cancellation), and when it finishes the partition. fp_get_progress()
+ * merges the published lists from another thread. */
+
+/* Incremental narrowing. Anything that doesn't match a query can't match a
+ * longer query starting with it, so when the user types another character
+ * only the files which matched the previous query need to be scanned. Each
+ * search records the files it matched as a list of survivors, and these are
+ * kept on a stack so that backspacing returns to an earlier list. Any change
+ * to the pool empties the stack. */
+#define NARROW_MAX_DEPTH 32
+#define SURVIVOR_DIR 0x80000000u        // This survivor is a directory entry, followed by its files
+#define SURVIVORS_PARTITION_MIN 16384
+
+struct survivors {
+	uint32_t *offsets;                  // Relative to 'files'
+	size_t count;
+	size_t max;
+	bool failed;                        // Out of memory, so the list is incomplete
+};
+
+struct narrow_entry {
+	char *query;
+	int query_len;
+	struct survivors survivors;
+};
+
+struct narrow {
+	struct narrow_entry entries[NARROW_MAX_DEPTH];
+	int depth;
+	unsigned int pool_generation;       // Pool the entries refer to
 };
 
-struct filter_element {
-	struct filter_element *next;
-	char *s;
+/* Extra goodness for files the user opens often (see fp_set_boosts()). They
+ * are given by path, and found by record offset while scanning, so the
+ * offsets are worked out again whenever the pool changes. */
+struct boosts {
+	char **paths;                       // Like "./a/b/name"
+	int *values;
+	int count;
+	uint32_t *offsets;                  // Hash table of record offsets (relative to 'files'), 0 if unused ...
+	int *offset_values;                 // ... and their boosts
+	uint32_t *dirs;                     // Hash set of the directory entries they're in (offset + 1), so others are skipped
+	uint32_t mask;
+	unsigned int pool_generation;       // Pool the offsets refer to
+	bool resolved;
+};
+
+struct partition {
+	uint8_t *start;                     // Range of the pool to scan...
+	uint8_t *end;
+	uint32_t *source;                   // ... or range of survivors to scan, when narrowing
+	uint32_t *source_end;
+	struct candidate_list *candidates;
+	struct candidate_list *published;   // Copy of the best candidates so far, under progress_lock
+	struct survivors survivors;         // Files which matched in this partition
+};
+
+struct search {
+	struct partition *partitions;
+	int num_partitions;
+	int max_candidates;            // Size of each partition's candidate list
+	uint8_t *files, *files_end;    // Pool the partitions were calculated for...
+	int threads;                   // ... and the number of threads
+	char *needle;
+	char *needle_alt;              // The other case of each needle character, or NULL to match case exactly
+	bool simd;                     // Use rfind_simd()?
+	int needle_len;
+	charmask_t needle_mask;        // Zero if the prefilter is disabled. Folded if needle_alt is set.
+	int active_partitions;         // Partitions used by this search
+	int next_partition;            // Next partition to be claimed by a thread
+	struct narrow_entry *narrowing; // Survivors to scan instead of the pool, or NULL
+	const struct boosts *boosts;   // Goodness to add to some files, or NULL
+	bool record;                   // Record survivors for the next search?
+	unsigned int cancel_generation; // Incremented by fp_cancel()
+	unsigned int generation;       // cancel_generation when this search started
+	uint64_t scanned;              // Bytes of the pool (or survivors, when narrowing) scanned
+	uint64_t checked;              // Files considered
+	uint64_t rejected;             // Files rejected by their character masks
+	uint64_t matched;              // Files which matched
+	uint64_t bytes;                // Bytes of the pool and survivor lists read
+	uint64_t progress_ns;          // How often to publish partial results, or 0 not to
+	pthread_mutex_t progress_lock; // Guards the published lists and the following
+	bool publishing;               // A search is in progress, so the published lists may be read
+	struct candidate_list *progress; // Published lists merged by fp_get_progress()
+};
+
+struct worker_pool {
+	pthread_t *threads;
+	int num_threads;               // Not including the searching thread
+	pthread_mutex_t lock;
+	pthread_cond_t start;          // Signalled when a search starts
+	pthread_cond_t done;           // Signalled when the last worker finishes
+	unsigned int generation;       // Incremented for every search
+	int busy;                      // Workers yet to finish this search
+	bool quit;
 };
 
 struct filepirate {
 	char *root_dirname;
-	uint8_t *files;               // When initialised, points to the main pool.
+	char *root_path;              // Canonical path of the root, or "" if it's "/"
+	int root_fd;                  // The root directory, or -1
+	uint8_t *files;               // When initialised, points to the main pool, or to the cache mapping.
 	uint8_t *files_end;
+	uintptr_t files_index;        // Pool index corresponding to 'files'
 	struct memory_pool main_pool;
-	struct filter_element *positive_filter;
-	struct filter_element *negative_filter;
+	struct filter positive_filter;
+	struct filter negative_filter;
+	struct watch watch;
+	struct fp_stats stats;
+	char *cache_filename;         // If set, the walker records directory stamps for the cache
+	struct memory_pool stamp_pool;
+	uint64_t num_stamps;
+	void *cache_map;              // The mapped cache file, if the index was loaded from it
+	size_t cache_map_size;
+	unsigned int pool_generation;  // Incremented whenever the pool changes
+	bool prefilter;               // Reject files using their character masks?
+	bool simd;                    // Find needle characters with vector compares?
+	int case_mode;                // FP_CASE_EXACT, FP_CASE_IGNORE or FP_CASE_SMART
+	bool truncated;               // The pool filled up, so some files are missing
+	int walk_threads;             // Threads used to walk the tree, or 0 to use fts
+	int git;                      // FP_GIT_*: list git work trees from the git index?
+	uintptr_t deleted_size;       // Bytes of the pool taken up by deleted files
+	struct search search;
+	struct narrow narrow;
+	struct boosts boosts;
+	struct worker_pool workers;
 };
 
 /* Memory pool functions */
-static bool pool_init(struct memory_pool *pool)
+static size_t page_round(size_t size)
+{
+	size_t page_size = sysconf(_SC_PAGESIZE);
+
+	return (size + page_size - 1) & ~(page_size - 1);
+}
+
+static bool pool_init(struct memory_pool *pool, size_t limit)
 {
-	pool->start = malloc(MEM_MIN);
-	if (!pool->start) {
-		ERROR("pool_init malloc]\n");
+	limit = page_round(limit < MEM_MIN ? MEM_MIN : limit);
+
+	/* Reserve the address space without committing any memory */
+	pool->start = mmap(NULL, limit, PROT_NONE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	if (pool->start == MAP_FAILED) {
+		ERROR("pool_init mmap: %s\n", strerror(errno));
+		pool->start = NULL;
+		return false;
+	}
+
+	if (mprotect(pool->start, MEM_MIN, PROT_READ | PROT_WRITE) != 0) {
+		ERROR("pool_init mprotect: %s\n", strerror(errno));
+		munmap(pool->start, limit);
+		pool->start = NULL;
 		return false;
 	}
+
 	pool->size = MEM_MIN;
+	pool->limit = limit;
 	pool->next = 4;    // some offset from 0 so we can use 0 return for errors.
 
 	return true;
@@ -79,10 +356,12 @@ static bool pool_init(struct memory_pool *pool)
 
 static bool pool_free(struct memory_pool *pool)
 {
-	free(pool->start);
+	if (pool->start)
+		munmap(pool->start, pool->limit);
 
 	pool->start = NULL;
 	pool->size = 0;
+	pool->limit = 0;
 	pool->next = 0;
 
 	return true;
@@ -102,34 +381,36 @@ static uintptr_t try_pool_alloc(struct memory_pool *pool, size_t size)
 	}
 }
 
-static void pool_expand(struct memory_pool *pool)
+static void pool_reset(struct memory_pool *pool)
 {
-	size_t new = pool->size * 2;
-	uint8_t *pool_new_start;
+	pool->next = 4;
+}
 
-	if (new > MEM_MAX)
-		return;
+static bool pool_expand(struct memory_pool *pool)
+{
+	size_t grow = pool->size < MEM_MAX ? pool->size : MEM_MAX;
 
-	pool_new_start = realloc(pool->start, new);
+	if (pool->size == pool->limit)
+		return false;
+	if (grow > pool->limit - pool->size)
+		grow = pool->limit - pool->size;
 
-	if (pool_new_start == NULL) {
-		// Original pointer still valid
-		return;
+	if (mprotect(pool->start + pool->size, grow, PROT_READ | PROT_WRITE) != 0) {
+		ERROR("pool_expand mprotect: %s\n", strerror(errno));
+		return false;
 	}
 
-	pool->start = pool_new_start;
-	pool->size  = new;
+	pool->size += grow;
+	return true;
 }
 
 static uintptr_t pool_alloc(struct memory_pool *pool, size_t size)
 {
 	uintptr_t addr;
 
-	addr = try_pool_alloc(pool, size);
-
-	if (addr == 0) {
-		pool_expand(pool);
-		addr = try_pool_alloc(pool, size);
+	while ((addr = try_pool_alloc(pool, size)) == 0) {
+		if (!pool_expand(pool))
+			break;
 	}
 
 	return addr;
@@ -140,6 +421,21 @@ static inline uintptr_t alloc(struct filepirate *fp, size_t size)
 	return pool_alloc(&(fp->main_pool), size);
 }
 
+/* Allocate a name record, leaving room to terminate the directory entry
+ * afterwards, so the pool stays well formed when it runs out. */
+static uintptr_t alloc_record(struct filepirate *fp, size_t size)
+{
+	uintptr_t index = alloc(fp, size + DIRENT_TERMINATOR_SIZE);
+
+	if (index == 0) {
+		fp->truncated = true;
+		return 0;
+	}
+
+	fp->main_pool.next -= DIRENT_TERMINATOR_SIZE;
+	return index;
+}
+
 static inline uint8_t *get_ptr(struct filepirate *fp, uintptr_t index)
 {
 	return fp->main_pool.start + index;
@@ -150,395 +446,3902 @@ static inline void write_uint (struct filepirate *fp, uintptr_t index, unsigned
 	*((unsigned int *)(get_ptr(fp, index))) = val;
 }
 
-static inline bool passes_filter(struct filepirate *fp, char *name)
+static inline unsigned int read_uint (struct filepirate *fp, uintptr_t index)
 {
-	if (fp->positive_filter) {
-		for (struct filter_element *filter = fp->positive_filter; filter; filter = filter->next) {
-			if (fnmatch(filter->s, name, 0) == 0) {
-				return true;
-			}
-		}
-		return false;
-	}
-	if (fp->negative_filter) {
-		for (struct filter_element *filter = fp->negative_filter; filter; filter = filter->next) {
-			if (fnmatch(filter->s, name, 0) == 0) {
-				return false;
-			}
-		}
-	}
-	return true;
+	return *((unsigned int *)(get_ptr(fp, index)));
 }
 
-/* Joke's on... erm, me -- this does not recurse! */
-static uintptr_t fp_init_dir_recurse(struct filepirate *fp)
+/* Lock the pointers used by the scan. Must be redone after every allocation. */
+static void fp_lock_files(struct filepirate *fp)
 {
-	/* Just walk it for now */
-	uintptr_t first = 0;
-	uintptr_t dirent_start = 0;
-	uintptr_t tmp = 0;
-	bool dir_written = false;
-	FTSENT *node;
+	fp->files = fp->main_pool.start + fp->files_index;
+	fp->files_end = fp->main_pool.start + fp->main_pool.next;
+	fp->search.files = NULL; // Partitions must be recalculated
+	fp->pool_generation ++;
+}
 
-	first = fp->main_pool.next;
+/* Bit for each character in charmask(), plus one. Letters of each case
+ * and digits get a bit each; fold_mask() relies on the upper case letters
+ * being 26 bits above the lower case ones. Everything else (0 here) shares
+ * the last bit. */
+static const uint8_t charmask_bits[256] = {
+	['a'] = 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26,
+	['A'] = 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52,
+	['0'] = 53, 54, 55, 56, 57, 58, 59, 60, 61, 62,
+	['.'] = 63,
+};
+
+static charmask_t charmask(const char *s, size_t len)
+{
+	charmask_t mask = 0;
 
-	char *cwd_only[] = {".", 0};
+	for (size_t i = 0; i < len; i++) {
+		uint8_t bit = charmask_bits[(uint8_t)s[i]];
 
-	FTS *tree = fts_open(cwd_only, FTS_NOCHDIR, 0);
-	if (!tree) {
-		ERROR("fts_open");
-		return 0;
+		mask |= (charmask_t)1 << (bit ? bit - 1 : 63);
 	}
 
-	while ((node = fts_read(tree))) {
-		if (node->fts_level > 0 && node->fts_name[0] == '.')
-			fts_set(tree, node, FTS_SKIP);
-		else if (node->fts_info & FTS_D) {
-			/* Pre-order directory */
-			dir_written = false;
-		} else if (node->fts_info & FTS_DP) {
-			//printf("post-order directory\n");
-			dir_written = false;
-		} else if ((node->fts_info & FTS_F) && passes_filter(fp, node->fts_name)) {
-			if (dir_written == false) {
-				FTSENT *parent = node->fts_parent;
-				if (dirent_start) {
-					/* Finish off the previous directory with an extra nul */
-					//printf("end previous directory\n");
-					tmp = alloc(fp, sizeof(unsigned int) + 1);
-					write_uint(fp, tmp, 0);
-					tmp += sizeof(unsigned int);
-					*((char *)get_ptr(fp, tmp)) = '\0';
-				}
-				//printf("write dirent %lx %s (%x) %s\n", fp.main_pool.next, parent->fts_path, parent->fts_pathlen, node->fts_path);
-				dirent_start = alloc(fp, sizeof(unsigned int) + parent->fts_pathlen + 1);
-				write_uint(fp, dirent_start, parent->fts_pathlen + 1);
-				dirent_start += sizeof(unsigned int);
-				strncpy((char *)get_ptr(fp, dirent_start), parent->fts_path, parent->fts_pathlen);
-				*((char *)(get_ptr(fp, dirent_start) + parent->fts_pathlen)) = '\0';
+	return mask;
+}
 
-				dir_written = true;
-			}
+static inline charmask_t read_mask(const uint8_t *record)
+{
+	charmask_t mask;
 
-			//printf("file %lx %s\n", fp.main_pool.next, node->fts_name);
-			tmp = alloc(fp, sizeof(unsigned int) + node->fts_namelen + 1);
-			write_uint(fp, tmp, node->fts_namelen + 1);
-			tmp += sizeof(unsigned int);
-			strcpy((char *)get_ptr(fp, tmp), node->fts_name);
-		}
-	}
+	memcpy(&mask, record + sizeof(unsigned int), sizeof mask);
+	return mask;
+}
 
-	if (errno) {
-		ERROR("fts_read");
-		return 0;
-	}
+/* A mask with the bits of upper case letters moved to the lower case ones,
+ * for comparing with the mask of a lower case search term. The other bits
+ * move onto upper case letters, which such a mask doesn't have. */
+static inline charmask_t fold_mask(charmask_t mask)
+{
+	return mask | (mask >> 26);
+}
 
-	if (fts_close(tree)) {
-		ERROR("fts_close");
-		return 0;
-	}
+/* The mask of a record, folded if the search is */
+static inline charmask_t record_mask(const uint8_t *record, bool fold)
+{
+	return fold ? fold_mask(read_mask(record)) : read_mask(record);
+}
 
-	// printf("total size 0x%lx, start at %lx\n", fp.main_pool.next, first);
+static inline uint32_t read_uint32(const uint8_t *ptr)
+{
+	uint32_t val;
 
-	return first;
+	memcpy(&val, ptr, sizeof val);
+	return val;
 }
 
-bool fp_init_dir(struct filepirate *fp, char *dirname)
+/* Directory entry accessors */
+static inline const uint8_t *dir_parent(const uint8_t *dir)
 {
-	int cwd;
-	uintptr_t files_index;
+	uint32_t distance = read_uint32(dir + DIRENT_HEADER_SIZE);
 
-	assert(fp->root_dirname == NULL);
-	fp->root_dirname = malloc(strlen(dirname) + 1);
-	strcpy(fp->root_dirname, dirname);
+	return distance ? dir - distance : NULL;
+}
 
-	/* Remember the CWD */
-	cwd = open(".", O_RDONLY);
-	assert(cwd >= 0);
+static inline unsigned int dir_path_len(const uint8_t *dir)
+{
+	return read_uint32(dir + DIRENT_HEADER_SIZE + sizeof(uint32_t));
+}
 
-	/* Do all our work in the target dir's root */
-	chdir(dirname);
-	files_index = fp_init_dir_recurse(fp);
+static inline const char *dir_name(const uint8_t *dir)
+{
+	return (const char *)dir + DIR_HEADER_SIZE;
+}
 
-	/* Restore the previous CWD */
-	fchdir(cwd);
-	close(cwd);
+/* Put together the full path of a directory. 'path' must have room for
+ * dir_path_len() + 1 bytes. */
+static void dir_path(const uint8_t *dir, char *path)
+{
+	unsigned int pos = dir_path_len(dir);
 
-	// Lock the pointers -- now we can't do more allocation using the main pool (in case we realloc and move the pointer)
-	fp->files = fp->main_pool.start + files_index;
-	fp->files_end = fp->files + fp->main_pool.next - files_index;
+	path[pos] = '\0';
+	for (; dir; dir = dir_parent(dir)) {
+		unsigned int len = *(unsigned int *)dir - 1;
 
-	return files_index != 0;
+		pos -= len;
+		memcpy(path + pos, dir_name(dir), len);
+		if (pos > 0)
+			path[--pos] = '/';
+	}
 }
 
-static void fp_deinit_dir(struct filepirate *fp)
+/* Write a name record: length, mask and name */
+static void write_record(uint8_t *record, const char *name, size_t len)
 {
-	if(fp->root_dirname) {
-		free(fp->root_dirname);
-		fp->root_dirname = NULL;
-	}
+	charmask_t mask = charmask(name, len);
+	unsigned int record_len = len + 1;
+
+	memcpy(record, &record_len, sizeof record_len);
+	memcpy(record + sizeof(unsigned int), &mask, sizeof mask);
+	memcpy(record + DIRENT_HEADER_SIZE, name, len);
+	record[DIRENT_HEADER_SIZE + len] = '\0';
 }
 
-/* Non-contiguous matching across two strings (directory name and file name) */
-/* Note the lengths are strlen() lengths, i.e. don't include the terminating
- * null, unlike the lengths stored in the directory structure in memory. */
+/* Write the header of a directory entry, leaving out the parts which depend
+ * on its parent (see dirent_link()) */
+static void write_dir_record(uint8_t *record, const char *name, size_t len)
+{
+	charmask_t mask = charmask(name, len);
+	unsigned int record_len = len + 1;
 
-// We search backwards in order to match as much on filename as possible
-// before dirname, because filename is more important
-static inline bool fp_strstr(unsigned int dirname_len, char *dirname,
-		unsigned int filename_len, char *filename,
-		unsigned int needle_len, char *needle,
-		int *goodness)
+	memcpy(record, &record_len, sizeof record_len);
+	memcpy(record + sizeof(unsigned int), &mask, sizeof mask);
+	memset(record + DIRENT_HEADER_SIZE, 0, DIR_HEADER_SIZE - DIRENT_HEADER_SIZE);
+	memcpy(record + DIR_HEADER_SIZE, name, len);
+	record[DIR_HEADER_SIZE + len] = '\0';
+}
+
+/* Fill in the parts of the directory entry at 'block' which depend on its
+ * parent: its distance back to 'parent', its path length, and its mask,
+ * which so far only covers its own name. 'parent' is 0 for the root. */
+static void dirent_link(struct filepirate *fp, uintptr_t block, uintptr_t parent)
 {
-	int idx_hay = filename_len, idx_needle = needle_len, contig = 0, contig_filename = 0;
-	char *hay = filename;
-	int last_match_idx = idx_hay;
+	uint32_t header[2] = {0, read_uint(fp, block) - 1};
 
-	while (true) {
-		if (idx_hay == -1) {
-			if (hay == filename) {
-				hay = dirname;
-				idx_hay = dirname_len;
-				last_match_idx = -1;
-
-				contig_filename = contig;
-				contig = 0;
-			} else {
-				/* End of filename -- we're done */
-				break;
-			}
-		}
+	if (parent) {
+		charmask_t mask = read_mask(get_ptr(fp, block));
 
-		if (idx_needle == -1) {
-			/* Matched it all? */
-			break;
-		}
+		mask |= read_mask(get_ptr(fp, parent)) | charmask("/", 1);
+		memcpy(get_ptr(fp, block + sizeof(unsigned int)), &mask, sizeof mask);
+		header[0] = block - parent;
+		header[1] += dir_path_len(get_ptr(fp, parent)) + 1;
+	}
 
-		if (hay[idx_hay] == needle[idx_needle]) {
-			idx_needle --;
+	memcpy(get_ptr(fp, block + DIRENT_HEADER_SIZE), header, sizeof header);
+}
 
-			if (idx_hay + 1 == last_match_idx)
-				contig ++;
+/* Start the first directory entry for a directory. 'parent' is the index of
+ * the parent's first entry, or 0 for the root. Returns its index, or 0 if
+ * the pool is full. */
+static uintptr_t dirent_start(struct filepirate *fp, uintptr_t parent, const char *name, size_t name_len)
+{
+	uintptr_t block = alloc_record(fp, DIR_HEADER_SIZE + name_len + 1);
 
-			last_match_idx = idx_hay;
-		}
+	if (block == 0)
+		return 0;
 
-		idx_hay --;
-	}
+	write_dir_record(get_ptr(fp, block), name, name_len);
+	dirent_link(fp, block, parent);
 
-	if (goodness) {
-		*goodness = contig_filename + contig;
+	return block;
+}
+
+/* Start another directory entry for the directory whose first entry is at
+ * 'first'. Returns its index, or 0 if the pool is full. */
+static uintptr_t dirent_continue(struct filepirate *fp, uintptr_t first)
+{
+	unsigned int name_len = read_uint(fp, first);
+	uintptr_t block = alloc_record(fp, DIR_HEADER_SIZE + name_len);
+	uint32_t distance;
+
+	if (block == 0)
+		return 0;
+
+	memcpy(get_ptr(fp, block), get_ptr(fp, first), DIR_HEADER_SIZE + name_len);
+	distance = read_uint32(get_ptr(fp, first + DIRENT_HEADER_SIZE));
+	if (distance) {
+		distance += block - first;
+		memcpy(get_ptr(fp, block + DIRENT_HEADER_SIZE), &distance, sizeof distance);
 	}
 
-	return idx_needle == -1;
+	return block;
 }
 
-struct candidate_list *fp_candidate_list_create(int max_candidates)
+/* Returns false if the pool is full */
+static bool dirent_add_file(struct filepirate *fp, const char *filename, size_t filename_len)
 {
-	int i;
-	struct candidate_list *list;
+	uintptr_t tmp = alloc_record(fp, DIRENT_HEADER_SIZE + filename_len + 1);
 
-	list = malloc(sizeof(*list));
-	if (!list)
-		return NULL;
-	list->best = list->worst = NULL;
-	list->max_candidates = max_candidates;
+	if (tmp == 0)
+		return false;
+	write_record(get_ptr(fp, tmp), filename, filename_len);
+	return true;
+}
 
-	for (i = 0; i < max_candidates; i++) {
-		struct candidate *new_candidate = malloc(sizeof(struct candidate));
-		if (!new_candidate)
-			return NULL; // FIXME: clean up memory leak
-		new_candidate->goodness = -1;
+/* Finish off a directory entry with a zero length and an extra nul. There is
+ * always room for this (see alloc_record()). */
+static void dirent_end(struct filepirate *fp)
+{
+	uintptr_t tmp = alloc(fp, DIRENT_TERMINATOR_SIZE);
 
-		if (list->worst == NULL) {
-			assert(list->best == NULL);
-			list->best = list->worst = new_candidate;
-			new_candidate->better = new_candidate->worse = NULL;
-		} else {
-			list->worst->worse = new_candidate;
-			new_candidate->better = list->worst;
-			new_candidate->worse = NULL;
-			list->worst = new_candidate;
-		}
-	}
+	write_uint(fp, tmp, 0);
+	*((char *)get_ptr(fp, tmp + sizeof(unsigned int))) = '\0';
+}
 
-	return list;
+bool fp_watch_pending(struct filepirate *fp)
+{
+	/* Whether there are changes which fp_watch_update() hasn't applied yet.
+	 * Unlike fp_watch_update(), this may be called during a search. */
+#ifdef __linux__
+	struct pollfd pollfd = {fp->watch.fd, POLLIN, 0};
+
+	return fp->watch.fd >= 0 && poll(&pollfd, 1, 0) != 0;
+#else
+	return false;
+#endif
 }
 
-static void candidate_list_reset(struct candidate_list *list)
+static uint32_t hash_string(const char *s)
 {
-	for (struct candidate *iter = list->best; iter; iter = iter->worse) {
-		// Only for debugging
-		// iter->dirname = iter->filename = NULL;
-		iter->goodness = -1;
-	}
+	/* FNV-1a */
+	uint32_t hash = 2166136261u;
+
+	for (; *s; s++)
+		hash = (hash ^ (uint8_t)*s) * 16777619u;
+
+	return hash;
 }
 
-void fp_candidate_list_destroy(struct candidate_list *list)
+/* Match 'c' against the bracket expression starting at 'p'. Returns a pointer
+ * past the expression, or NULL if the '[' doesn't start one. */
+static const char *glob_bracket(const char *p, char c, bool *matched)
 {
-	while(list->best) {
-		struct candidate *tmp = list->best->worse;
-		free(list->best);
-		list->best = tmp;
+	const char *start;
+	bool negate = false;
+
+	*matched = false;
+	p++;
+	if (*p == '!' || *p == '^') {
+		negate = true;
+		p++;
 	}
 
-	free(list);
-}
+	/* A ']' straight away is part of the set */
+	for (start = p; *p && (*p != ']' || p == start); ) {
+		unsigned char lo = *p++, hi = lo;
 
-static void candidate_list_add(struct candidate_list *list, char *dirname, char *filename, int goodness)
-{
-	if(goodness >= list->worst->goodness) {
-		/* FIXME: Binary search better */
-		struct candidate *new_candidate = list->worst;
-		list->worst->better->worse = NULL;
-		list->worst = list->worst->better;
-		new_candidate->dirname = dirname;
-		new_candidate->filename = filename;
-		new_candidate->goodness = goodness;
-
-		for (struct candidate *iter = list->best; iter; iter = iter->worse) {
-			if (goodness >= iter->goodness) {
-				if (iter == list->best) {
-					/* Insert before "iter", at head of list */
-					new_candidate->worse = list->best;
-					new_candidate->better = NULL;
-					list->best->better = new_candidate;
-					list->best = new_candidate;
-				} else {
-					/* Insert before "iter":
-					 * A <new> <iter>
-					 * New's worse -> A's worse
-					 * New's better -> iter's better
-					 * A's worse -> new
-					 * iter's better -> new*/
-					struct candidate *better = iter->better;
-					new_candidate->worse = better->worse;
-					new_candidate->better = iter->better;
-					better->worse = new_candidate;
-					iter->better = new_candidate;
-				}
-				break;
-			}
+		if (*p == '-' && p[1] && p[1] != ']') {
+			hi = p[1];
+			p += 2;
 		}
+		if ((unsigned char)c >= lo && (unsigned char)c <= hi)
+			*matched = true;
 	}
+
+	if (*p != ']')
+		return NULL;
+	if (negate)
+		*matched = !*matched;
+	return p + 1;
 }
 
-bool fp_get_candidates(struct filepirate *fp, char *buffer, int buffer_ptr, struct candidate_list *candidates)
+/* fnmatch(pattern, s, FNM_PATHNAME), except that "**" matches slashes too,
+ * and "**" followed by a slash matches any number of directories, including
+ * none. 'pattern' is the start of the whole pattern; 'p' is where to match. */
+static bool glob_match(const char *pattern, const char *p, const char *s)
 {
-	char *files;
-	int file_count = 0;
-	int previous_best_goodness = -1;
-	bool new_directory = true; // Was a new directory entered?
-	unsigned int dirname_len, filename_len;
-	char *dirname = NULL;
-
-	new_directory = true;
-	files = (char *)fp->files;
-	candidate_list_reset(candidates);
+	while (*p) {
+		switch (*p) {
+		case '?':
+			if (*s == '\0' || *s == '/')
+				return false;
+			p++;
+			s++;
+			break;
 
-	for(file_count = 0; file_count < candidates->max_candidates && files < (char *)fp->files_end; ) {
-		if (new_directory) {
-			dirname_len = *(unsigned int *)files;
-			files += sizeof(unsigned int);
-			dirname = files;
-			files += dirname_len;
-			new_directory = false;
-		}
+		case '*':
+			if (p[1] == '*') {
+				bool whole = p == pattern || p[-1] == '/';
 
-		filename_len = *(unsigned int *)files;
-		files += sizeof(unsigned int);
-		if (filename_len == 0) {
-			// End of this directory 
-			files += 1;
-			new_directory = true;
-		} else {
-			int goodness;
-			if (fp_strstr(dirname_len - 1, dirname, filename_len - 1, files, buffer_ptr - 1, buffer, &goodness) == true) {
-				if(goodness >= previous_best_goodness) {
-					candidate_list_add(candidates, dirname, files, goodness);
-					previous_best_goodness = goodness;
+				while (*p == '*')
+					p++;
+				if (whole && *p == '/') {
+					for (p++; ; s++) {
+						if (glob_match(pattern, p, s))
+							return true;
+						s = strchr(s, '/');
+						if (!s)
+							return false;
+					}
+				}
+				for (; ; s++) {
+					if (glob_match(pattern, p, s))
+						return true;
+					if (*s == '\0')
+						return false;
 				}
 			}
-			files += filename_len;
-		}
-	}
-	return true;
-}
-
 
-/* FIXME: Support directory filtering as well. Dodgy option: include both.
- * Less dodgy option: include custom fnmatch to take two-string arg as per
- * strstr. */
+			for (p++; ; s++) {
+				if (glob_match(pattern, p, s))
+					return true;
+				if (*s == '\0' || *s == '/')
+					return false;
+			}
 
-struct filepirate *fp_init()
-{
-	struct filepirate *fp;
+		case '[': {
+			const char *end;
+			bool matched;
 
-	fp = calloc(sizeof *fp, 1);
-	if (fp == NULL)
-		return NULL;
+			if (*s == '\0' || *s == '/')
+				return false;
+			end = glob_bracket(p, *s, &matched);
+			if (end) {
+				if (!matched)
+					return false;
+				p = end;
+				s++;
+				break;
+			}
+			/* Not a bracket expression, so a plain '[' */
+			if (*s != '[')
+				return false;
+			p++;
+			s++;
+			break;
+		}
 
-	fp->positive_filter = fp->negative_filter = NULL;
-	if (pool_init(&(fp->main_pool)) == false) {
-		free(fp);
-		return NULL;
+		case '\\':
+			if (p[1])
+				p++;
+			/* fall through */
+		default:
+			if (*p != *s)
+				return false;
+			p++;
+			s++;
+		}
 	}
 
-	return fp;
+	return *s == '\0';
 }
 
-static void deinit_filter(struct filter_element **filter)
+/* The last rule in 'table' which 'key' matches, or -1 */
+static int filter_table_get(const struct filter_table *table, const char *key)
 {
-	for(struct filter_element *elem = *filter; elem;) {
-		struct filter_element *tmp = elem->next;
-		free(elem);
-		elem = tmp;
+	if (!table->slots)
+		return -1;
+	for (uint32_t slot = hash_string(key) & table->mask; table->slots[slot].key; slot = (slot + 1) & table->mask) {
+		if (strcmp(table->slots[slot].key, key) == 0)
+			return table->slots[slot].rule;
 	}
-	*filter = NULL;
+	return -1;
 }
 
-bool fp_deinit(struct filepirate *fp)
+/* The last rule in 'filter' which matches, or -1. 'path' is relative to the
+ * root, like "a/b/name", and 'name' is its base name. 'path' is only looked
+ * at if filter->anchored is set. */
+static int filter_match(const struct filter *filter, const char *path, const char *name, bool is_dir)
 {
-	fp_deinit_dir(fp);
-
-	if (pool_free(&fp->main_pool)) {
-		free (fp);
-		return true;
-	}
+	int best = filter_table_get(&filter->names, name), rule;
+	const char *ext = strrchr(name, '.');
 
-	deinit_filter(&(fp->negative_filter));
-	deinit_filter(&(fp->positive_filter));
+	if (is_dir && (rule = filter_table_get(&filter->dir_names, name)) > best)
+		best = rule;
+	if (ext && (rule = filter_table_get(&filter->suffixes, ext)) > best)
+		best = rule;
 
-	return false;
-}
+	/* Only a later rule can change the answer */
+	for (int i = filter->num_globs - 1; i >= 0 && filter->globs[i] > best; i--) {
+		struct filter_rule *r = &filter->rules[filter->globs[i]];
+		const char *s = r->anchored ? path : name;
 
-void fp_filter(struct filepirate *fp, char **positive, char **negative)
-{
-	for(char **s = negative; s; s++) {
-		fp_filter_add_negative(fp, *s);
+		if ((is_dir || !r->dir_only) && glob_match(r->pattern, r->pattern, s))
+			return filter->globs[i];
 	}
 
-	for(char **s = positive; s; s++) {
-		fp_filter_add_positive(fp, *s);
-	}
+	return best;
 }
 
-static void fp_filter_add(char *s, struct filter_element **dst)
+/* Whether the file or directory 'name', at 'path' (see filter_match()), is
+ * wanted. Directories which aren't wanted aren't walked at all. A file must
+ * match the positive filter, if there is one, and not the negative one. */
+static bool passes_filter_path(struct filepirate *fp, const char *path, const char *name, bool is_dir)
 {
-	struct filter_element *elem = malloc(sizeof(struct filter_element));
-	if(!elem)
-		return;
+	int rule;
 
-	elem->s = malloc(strlen(s) + 1);
-	if(!elem->s) {
-		free(elem);
-		return;
+	if (!is_dir && fp->positive_filter.num_rules) {
+		rule = filter_match(&fp->positive_filter, path, name, false);
+		if (rule < 0 || fp->positive_filter.rules[rule].negate)
+			return false;
 	}
 
-	strcpy(elem->s, s);
+	if (fp->negative_filter.num_rules) {
+		rule = filter_match(&fp->negative_filter, path, name, is_dir);
+		if (rule >= 0 && !fp->negative_filter.rules[rule].negate)
+			return false;
+	}
 
-	elem->next = *dst;
-	*dst = elem;
+	return true;
+}
+
+/* passes_filter_path() for 'name' in the directory 'dir', which looks like
+ * "." or "./a/b" as in the pool */
+static bool passes_filter(struct filepirate *fp, const char *dir, const char *name, bool is_dir)
+{
+	char path[PATH_MAX];
+
+	if (!fp->positive_filter.num_rules && !fp->negative_filter.num_rules)
+		return true;
+	if ((!fp->positive_filter.anchored && !fp->negative_filter.anchored) || dir[1] == '\0')
+		return passes_filter_path(fp, name, name, is_dir);
+
+	snprintf(path, sizeof path, "%s/%s", dir + 2, name);
+	return passes_filter_path(fp, path, name, is_dir);
+}
+
+/* Paths in the index are relative to the root, and start with ".". The
+ * current directory is left alone, since searches may be going on in other
+ * threads, so put together a path the system can use in 'buf', which must
+ * have room for PATH_MAX bytes. */
+static char *system_path(struct filepirate *fp, const char *path, char *buf)
+{
+	snprintf(buf, PATH_MAX, "%s%s", fp->root_path, path + 1);
+	if (buf[0] == '\0')
+		strcpy(buf, "/");
+	return buf;
+}
+
+/* Directory watching. The walker adds an inotify watch for every directory
+ * it enters, and remembers which directory entries in the pool belong to
+ * which watched directory, so that fp_watch_update() can apply changes in
+ * place rather than walking the whole tree again. */
+#ifdef __linux__
+#define WATCH_MASK (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO \
+		| IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+#endif
+
+static void watched_dir_free(struct watch *watch, int wd)
+{
+	struct watched_dir *dir = &watch->dirs[wd];
+
+	free(dir->path);
+	free(dir->blocks);
+	memset(dir, 0, sizeof *dir);
+
+	if (watch->tail_wd == wd)
+		watch->tail_wd = 0;
+}
+
+/* Forget about all watched directories, but leave the watches themselves in
+ * place. Re-adding a watch for the same directory returns the same
+ * descriptor. */
+static void watch_clear(struct watch *watch)
+{
+	for (int wd = 0; wd < watch->max_wd; wd++) {
+		if (watch->dirs[wd].path)
+			watched_dir_free(watch, wd);
+	}
+}
+
+static void watch_disable(struct watch *watch)
+{
+	if (watch->fd >= 0) {
+		watch_clear(watch);
+		close(watch->fd);
+		watch->fd = -1;
+	}
+	free(watch->dirs);
+	watch->dirs = NULL;
+	watch->max_wd = 0;
+}
+
+#ifdef __linux__
+/* Remember that watch descriptor 'wd' is for 'path'. Returns 'wd', or 0 if
+ * watching has been given up. */
+static long watch_register(struct filepirate *fp, int wd, const char *path)
+{
+	struct watch *watch = &fp->watch;
+	struct watched_dir *dir;
+
+	if (watch->fd < 0)
+		return 0;
+
+	if (wd >= watch->max_wd) {
+		int new_max = watch->max_wd ? watch->max_wd : 64;
+		struct watched_dir *new_dirs;
+
+		while (new_max <= wd)
+			new_max *= 2;
+
+		new_dirs = realloc(watch->dirs, new_max * sizeof(struct watched_dir));
+		if (!new_dirs) {
+			ERROR("watch_register realloc\n");
+			watch_disable(watch);
+			return 0;
+		}
+		memset(new_dirs + watch->max_wd, 0, (new_max - watch->max_wd) * sizeof(struct watched_dir));
+		watch->dirs = new_dirs;
+		watch->max_wd = new_max;
+	}
+
+	dir = &watch->dirs[wd];
+	if (dir->path == NULL) {
+		dir->path = strdup(path);
+		if (!dir->path) {
+			ERROR("watch_register strdup\n");
+			watch_disable(watch);
+			return 0;
+		}
+	}
+
+	return wd;
+}
+#endif
+
+/* Start watching 'path'. Returns the watch descriptor, or 0 if not watching. */
+static long watch_add(struct filepirate *fp, char *path)
+{
+#ifdef __linux__
+	struct watch *watch = &fp->watch;
+	char buf[PATH_MAX];
+	int wd;
+
+	if (watch->fd < 0)
+		return 0;
+
+	wd = inotify_add_watch(watch->fd, system_path(fp, path, buf), WATCH_MASK);
+	if (wd < 0) {
+		/* Probably out of watches. A partial watch is worse than none. */
+		ERROR("inotify_add_watch %s: %s\n", path, strerror(errno));
+		watch_disable(watch);
+		return 0;
+	}
+
+	return watch_register(fp, wd, path);
+#else
+	return 0;
+#endif
+}
+
+/* Record that the directory entry at 'block' belongs to watched directory 'wd' */
+static void watch_add_block(struct filepirate *fp, long wd, uintptr_t block)
+{
+	struct watch *watch = &fp->watch;
+	struct watched_dir *dir;
+
+	watch->tail_wd = wd;
+	if (wd <= 0 || watch->fd < 0)
+		return;
+
+	dir = &watch->dirs[wd];
+	if (dir->num_blocks == dir->max_blocks) {
+		unsigned int new_max = dir->max_blocks ? dir->max_blocks * 2 : 1;
+		uintptr_t *new_blocks = realloc(dir->blocks, new_max * sizeof(uintptr_t));
+
+		if (!new_blocks) {
+			ERROR("watch_add_block realloc\n");
+			watch_disable(watch);
+			return;
+		}
+		dir->blocks = new_blocks;
+		dir->max_blocks = new_max;
+	}
+
+	dir->blocks[dir->num_blocks++] = block;
+}
+
+#ifdef __APPLE__
+#define ST_MTIM(st) ((st)->st_mtimespec)
+#else
+#define ST_MTIM(st) ((st)->st_mtim)
+#endif
+
+static inline size_t pad8(size_t size)
+{
+	return (size + 7) & ~(size_t)7;
+}
+
+/* Remember the mtime of a walked directory, for validating the cache */
+static void stamp_add(struct filepirate *fp, const char *path, size_t path_len, const struct timespec *mtime)
+{
+	size_t size = pad8(sizeof(struct dir_stamp) + path_len + 1);
+	uintptr_t index = pool_alloc(&fp->stamp_pool, size);
+	struct dir_stamp *stamp;
+
+	if (index == 0) {
+		ERROR("stamp_add pool_alloc\n");
+		return;
+	}
+
+	stamp = (struct dir_stamp *)(fp->stamp_pool.start + index);
+	memset(stamp, 0, size);
+	stamp->mtime_sec = mtime->tv_sec;
+	stamp->mtime_nsec = mtime->tv_nsec;
+	stamp->size = size;
+	memcpy(stamp->path, path, path_len);
+	fp->num_stamps ++;
+}
+
+/* Joke's on... erm, me -- this does not recurse! 'parent' is the index of
+ * the first directory entry of the directory containing 'path', or 0 if
+ * 'path' is the root. */
+static uintptr_t fp_init_dir_recurse(struct filepirate *fp, char *path, uintptr_t parent)
+{
+	/* Just walk it for now */
+	uintptr_t first = 0;
+	bool dir_written = false;
+	char root[PATH_MAX], buf[PATH_MAX];
+	size_t root_len = strlen(fp->root_path);
+	FTSENT *node;
+
+	first = fp->main_pool.next;
+
+	char *root_only[] = {system_path(fp, path, root), 0};
+
+	FTS *tree = fts_open(root_only, FTS_NOCHDIR, 0);
+	if (!tree) {
+		ERROR("fts_open");
+		return 0;
+	}
+
+	while ((node = fts_read(tree))) {
+		if (node->fts_level > 0 && node->fts_name[0] == '.')
+			fts_set(tree, node, FTS_SKIP);
+		else if (node->fts_level > 0 && node->fts_info == FTS_D
+				&& !passes_filter_path(fp, node->fts_path + root_len + 1, node->fts_name, true)) {
+			/* Comes back as FTS_DP, without an entry to end */
+			fts_set(tree, node, FTS_SKIP);
+			node->fts_number = -1;
+		} else if (node->fts_info & FTS_D) {
+			/* Pre-order directory */
+			if (dir_written)
+				dirent_end(fp);
+			dir_written = false;
+
+			if (node->fts_info == FTS_D) {
+				uintptr_t block;
+				char *rel_path = path;
+
+				if (node->fts_level > 0) {
+					block = dirent_start(fp, (uintptr_t)node->fts_parent->fts_pointer, node->fts_name, node->fts_namelen);
+					/* fts_path is the system path. Make it relative to the root again. */
+					snprintf(buf, sizeof buf, ".%s", node->fts_path + root_len);
+					rel_path = buf;
+				} else {
+					char *name = strrchr(path, '/');
+
+					name = name ? name + 1 : path;
+					block = dirent_start(fp, parent, name, strlen(name));
+				}
+				if (block == 0)
+					break;
+
+				node->fts_pointer = (void *)block;
+				fp->stats.walk_dirs ++;
+				node->fts_number = watch_add(fp, rel_path);
+				watch_add_block(fp, node->fts_number, block);
+				if (fp->cache_filename)
+					stamp_add(fp, rel_path, strlen(rel_path), &ST_MTIM(node->fts_statp));
+				dir_written = true;
+			}
+		} else if ((node->fts_info & FTS_DP) && node->fts_number != -1) {
+			//printf("post-order directory\n");
+			if (dir_written)
+				dirent_end(fp);
+			dir_written = false;
+		} else if ((node->fts_info & FTS_F)
+				&& passes_filter_path(fp, node->fts_path + root_len + 1, node->fts_name, false)) {
+			if (dir_written == false) {
+				FTSENT *parent = node->fts_parent;
+				uintptr_t block;
+
+				/* Back from a subdirectory */
+				block = dirent_continue(fp, (uintptr_t)parent->fts_pointer);
+				if (block == 0)
+					break;
+				watch_add_block(fp, parent->fts_number, block);
+
+				dir_written = true;
+			}
+
+			//printf("file %lx %s\n", fp.main_pool.next, node->fts_name);
+			if (!dirent_add_file(fp, node->fts_name, node->fts_namelen))
+				break;
+			fp->stats.walk_files ++;
+		}
+	}
+
+	if (fp->truncated) {
+		ERROR("fp_init_dir: memory limit reached, index truncated\n");
+		errno = 0;
+	}
+
+	if (dir_written)
+		dirent_end(fp);
+
+	if (errno) {
+		ERROR("fts_read");
+		return 0;
+	}
+
+	if (fts_close(tree)) {
+		ERROR("fts_close");
+		return 0;
+	}
+
+	// printf("total size 0x%lx, start at %lx\n", fp.main_pool.next, first);
+
+	return first;
+}
+
+static uint64_t now_ns(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (uint64_t)ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+/* The parallel walker. Directories are read by up to 'threads' threads
+ * (including the caller), which take them from a shared stack and push the
+ * subdirectories they find back onto it. Each thread writes a directory entry
+ * for every directory it reads into its own segment, leaving out the parts
+ * which depend on the parent. Once the whole tree has been read,
+ * walk_stitch() copies the entries into the main pool in the order the
+ * directories were found, which puts parents before children, and links them
+ * up with dirent_link().
+ *
+ * Names are read with getdents64() on Linux, and the type of each name comes
+ * from the directory, so nothing is stat()ed unless the file system doesn't
+ * say, or the cache needs the directory's mtime. */
+#define WALK_BUF_SIZE (64 * 1024)
+
+enum walk_state {
+	WALK_QUEUED,               // Not read (yet)
+	WALK_DONE,
+	WALK_UNREADABLE            // Couldn't be opened, so it's left out
+};
+
+struct walk_dir {
+	char *path;
+	size_t path_len;
+	size_t id;                 // Index in walker->dirs
+	size_t parent;             // ... of the parent, unless this is the first
+	enum walk_state state;
+	int wd;                    // Watch descriptor, 0 if not watching, or -errno if the watch failed
+	struct timespec mtime;     // Only when caching
+	struct memory_pool *segment;
+	uintptr_t block;           // Directory entry in 'segment', including its terminator
+	size_t size;
+	uintptr_t index;           // ... and its index in the main pool, once stitched
+	unsigned int num_files;
+};
+
+struct walk_thread {
+	struct walker *walker;
+	pthread_t thread;
+	struct memory_pool segment;
+	uint8_t *buf;
+	struct walk_dir **children; // Subdirectories of the directory being read
+	size_t num_children;
+	size_t max_children;
+};
+
+struct walker {
+	struct filepirate *fp;
+	pthread_mutex_t lock;
+	pthread_cond_t work;       // Signalled when directories are pushed, or the walk ends
+	struct walk_dir **dirs;    // Every directory found, in order
+	size_t num_dirs;
+	struct walk_dir **stack;   // Directories waiting to be read
+	size_t stack_depth;
+	size_t max_dirs;           // Size of both arrays
+	size_t pending;            // Directories pushed but not yet read
+	size_t used;               // Bytes written to all the segments
+	bool stop;                 // Out of memory, so give up
+};
+
+#ifdef __linux__
+struct linux_dirent64 {
+	uint64_t d_ino;
+	int64_t d_off;
+	unsigned short d_reclen;
+	unsigned char d_type;
+	char d_name[];
+};
+#endif
+
+static struct walk_dir *walk_dir_new(const char *parent_path, size_t parent_len, const char *name, size_t name_len)
+{
+	struct walk_dir *dir = calloc(1, sizeof *dir);
+
+	if (!dir)
+		return NULL;
+
+	dir->path_len = parent_len ? parent_len + 1 + name_len : name_len;
+	dir->path = malloc(dir->path_len + 1);
+	if (!dir->path) {
+		free(dir);
+		return NULL;
+	}
+
+	if (parent_len) {
+		memcpy(dir->path, parent_path, parent_len);
+		dir->path[parent_len] = '/';
+		memcpy(dir->path + parent_len + 1, name, name_len + 1);
+	} else {
+		memcpy(dir->path, name, name_len + 1);
+	}
+
+	return dir;
+}
+
+static void walk_dir_free(struct walk_dir *dir)
+{
+	free(dir->path);
+	free(dir);
+}
+
+/* Like alloc_record(), for a segment */
+static uintptr_t segment_alloc(struct memory_pool *segment, size_t size)
+{
+	uintptr_t index = pool_alloc(segment, size + DIRENT_TERMINATOR_SIZE);
+
+	if (index)
+		segment->next -= DIRENT_TERMINATOR_SIZE;
+	return index;
+}
+
+/* Deal with one name in 'dir'. Returns false if the segment is full. */
+static bool walk_name(struct walk_thread *thread, struct walk_dir *dir, int fd, char *name, unsigned char type)
+{
+	struct filepirate *fp = thread->walker->fp;
+	size_t len;
+
+	if (name[0] == '.')
+		return true;
+
+	if (type == DT_UNKNOWN) {
+		struct stat st;
+
+		if (fstatat(fd, name, &st, AT_SYMLINK_NOFOLLOW) != 0)
+			return true;
+		type = S_ISDIR(st.st_mode) ? DT_DIR : S_ISREG(st.st_mode) ? DT_REG : DT_UNKNOWN;
+	}
+
+	len = strlen(name);
+	if (type == DT_DIR) {
+		struct walk_dir *child;
+
+		if (!passes_filter(fp, dir->path, name, true))
+			return true;
+
+		if (thread->num_children == thread->max_children) {
+			size_t new_max = thread->max_children ? thread->max_children * 2 : 64;
+			struct walk_dir **new_children = realloc(thread->children, new_max * sizeof(struct walk_dir *));
+
+			if (!new_children)
+				return false;
+			thread->children = new_children;
+			thread->max_children = new_max;
+		}
+
+		child = walk_dir_new(dir->path, dir->path_len, name, len);
+		if (!child)
+			return false;
+		child->parent = dir->id;
+		thread->children[thread->num_children++] = child;
+	} else if (type == DT_REG && passes_filter(fp, dir->path, name, false)) {
+		uintptr_t record = segment_alloc(&thread->segment, DIRENT_HEADER_SIZE + len + 1);
+
+		if (record == 0)
+			return false;
+		write_record(thread->segment.start + record, name, len);
+		dir->num_files ++;
+	}
+
+	return true;
+}
+
+/* Read 'dir' into this thread's segment. Returns false if the segment is full. */
+static bool walk_read_dir(struct walk_thread *thread, struct walk_dir *dir)
+{
+	struct filepirate *fp = thread->walker->fp;
+	struct memory_pool *segment = &thread->segment;
+	const char *name = strrchr(dir->path, '/');
+	size_t name_len;
+	bool ok = true;
+	int fd;
+
+	fd = openat(fp->root_fd, dir->path, O_RDONLY | O_DIRECTORY | O_CLOEXEC);
+	if (fd < 0) {
+		dir->state = WALK_UNREADABLE;
+		return true;
+	}
+
+#ifdef __linux__
+	if (fp->watch.fd >= 0) {
+		char buf[PATH_MAX];
+
+		dir->wd = inotify_add_watch(fp->watch.fd, system_path(fp, dir->path, buf), WATCH_MASK);
+		if (dir->wd < 0)
+			dir->wd = -errno;
+	}
+#endif
+
+	if (fp->cache_filename) {
+		struct stat st;
+
+		if (fstat(fd, &st) == 0)
+			dir->mtime = ST_MTIM(&st);
+	}
+
+	name = name ? name + 1 : dir->path;
+	name_len = strlen(name);
+	dir->segment = segment;
+	dir->block = segment_alloc(segment, DIR_HEADER_SIZE + name_len + 1);
+	if (dir->block == 0) {
+		close(fd);
+		return false;
+	}
+	write_dir_record(segment->start + dir->block, name, name_len);
+
+#ifdef __linux__
+	while (ok) {
+		long len = syscall(SYS_getdents64, fd, thread->buf, WALK_BUF_SIZE);
+		struct linux_dirent64 *ent;
+
+		if (len <= 0)
+			break;
+		for (long pos = 0; ok && pos < len; pos += ent->d_reclen) {
+			ent = (struct linux_dirent64 *)(thread->buf + pos);
+			ok = walk_name(thread, dir, fd, ent->d_name, ent->d_type);
+		}
+	}
+	close(fd);
+#else
+	DIR *stream = fdopendir(fd);
+	struct dirent *ent;
+
+	if (!stream) {
+		close(fd);
+	} else {
+		while (ok && (ent = readdir(stream)))
+			ok = walk_name(thread, dir, fd, ent->d_name, ent->d_type);
+		closedir(stream);
+	}
+#endif
+
+	if (!ok) {
+		segment->next = dir->block;
+		return false;
+	}
+
+	/* There is always room for the terminator (see segment_alloc()) */
+	uintptr_t terminator = pool_alloc(segment, DIRENT_TERMINATOR_SIZE);
+	memset(segment->start + terminator, 0, DIRENT_TERMINATOR_SIZE);
+	dir->size = segment->next - dir->block;
+	dir->state = WALK_DONE;
+	return true;
+}
+
+/* Push this thread's subdirectories. Called with the lock held. */
+static void walk_push_children(struct walk_thread *thread)
+{
+	struct walker *walker = thread->walker;
+	size_t need = walker->num_dirs + thread->num_children;
+
+	if (need > walker->max_dirs) {
+		size_t new_max = walker->max_dirs ? walker->max_dirs : 1024;
+		struct walk_dir **new_dirs, **new_stack;
+
+		while (new_max < need)
+			new_max *= 2;
+		new_dirs = realloc(walker->dirs, new_max * sizeof(struct walk_dir *));
+		if (new_dirs)
+			walker->dirs = new_dirs;
+		new_stack = realloc(walker->stack, new_max * sizeof(struct walk_dir *));
+		if (new_stack)
+			walker->stack = new_stack;
+		if (!new_dirs || !new_stack) {
+			ERROR("walk_push_children realloc\n");
+			walker->stop = true;
+			return;
+		}
+		walker->max_dirs = new_max;
+	}
+
+	for (size_t i = 0; i < thread->num_children; i++) {
+		struct walk_dir *child = thread->children[i];
+
+		child->id = walker->num_dirs;
+		walker->dirs[walker->num_dirs++] = child;
+		walker->stack[walker->stack_depth++] = child;
+	}
+	walker->pending += thread->num_children;
+	thread->num_children = 0;
+}
+
+static void *walk_thread_main(void *arg)
+{
+	struct walk_thread *thread = arg;
+	struct walker *walker = thread->walker;
+	size_t limit = walker->fp->main_pool.limit;
+
+	pthread_mutex_lock(&walker->lock);
+	while (true) {
+		struct walk_dir *dir;
+		bool ok;
+
+		while (!walker->stop && walker->stack_depth == 0 && walker->pending > 0)
+			pthread_cond_wait(&walker->work, &walker->lock);
+
+		if (walker->stop || walker->stack_depth == 0)
+			break;
+
+		dir = walker->stack[--walker->stack_depth];
+		pthread_mutex_unlock(&walker->lock);
+
+		ok = walk_read_dir(thread, dir);
+
+		pthread_mutex_lock(&walker->lock);
+		walker->used += dir->size;
+		if (!ok || walker->used > limit)
+			walker->stop = true;
+		if (walker->stop) {
+			for (size_t i = 0; i < thread->num_children; i++)
+				walk_dir_free(thread->children[i]);
+			thread->num_children = 0;
+		} else {
+			walk_push_children(thread);
+		}
+		walker->pending --;
+		pthread_cond_broadcast(&walker->work);
+	}
+	pthread_mutex_unlock(&walker->lock);
+
+	return NULL;
+}
+
+/* Copy the directory entries into the main pool, in order, linking each one
+ * to its parent. 'parent' is the parent of the first directory. */
+static void walk_stitch(struct walker *walker, uintptr_t parent)
+{
+	struct filepirate *fp = walker->fp;
+
+	for (size_t i = 0; i < walker->num_dirs; i++) {
+		struct walk_dir *dir = walker->dirs[i];
+		uintptr_t block;
+
+		/* A directory which wasn't read has no subdirectories */
+		if (dir->state == WALK_UNREADABLE)
+			continue;
+		if (dir->state != WALK_DONE) {
+			fp->truncated = true;
+			continue;
+		}
+
+		block = alloc(fp, dir->size);
+		if (block == 0) {
+			fp->truncated = true;
+			break;
+		}
+		memcpy(get_ptr(fp, block), dir->segment->start + dir->block, dir->size);
+		dirent_link(fp, block, i ? walker->dirs[dir->parent]->index : parent);
+		dir->index = block;
+
+#ifdef __linux__
+		if (dir->wd < 0) {
+			/* Probably out of watches. A partial watch is worse than none. */
+			ERROR("inotify_add_watch %s: %s\n", dir->path, strerror(-dir->wd));
+			watch_disable(&fp->watch);
+		} else if (dir->wd > 0) {
+			dir->wd = watch_register(fp, dir->wd, dir->path);
+		}
+#endif
+		watch_add_block(fp, dir->wd > 0 ? dir->wd : 0, block);
+		if (fp->cache_filename)
+			stamp_add(fp, dir->path, dir->path_len, &dir->mtime);
+
+		fp->stats.walk_dirs ++;
+		fp->stats.walk_files += dir->num_files;
+	}
+
+	if (fp->truncated)
+		ERROR("fp_init_dir: memory limit reached, index truncated\n");
+}
+
+/* Walk 'path' with up to 'threads' threads. Arguments and result are as for
+ * fp_init_dir_recurse(). */
+static uintptr_t walk_parallel(struct filepirate *fp, char *path, uintptr_t parent, int threads)
+{
+	struct walker walker = {.fp = fp};
+	struct walk_thread *workers = calloc(threads, sizeof(struct walk_thread));
+	uintptr_t first = fp->main_pool.next;
+	struct walk_dir *root;
+	int num_workers, started;
+
+	if (!workers) {
+		ERROR("walk_parallel calloc\n");
+		return 0;
+	}
+
+	for (num_workers = 0; num_workers < threads; num_workers++) {
+		struct walk_thread *thread = &workers[num_workers];
+
+		thread->walker = &walker;
+		thread->buf = malloc(WALK_BUF_SIZE);
+		if (!thread->buf || !pool_init(&thread->segment, fp->main_pool.limit)) {
+			free(thread->buf);
+			break;
+		}
+	}
+
+	root = walk_dir_new(NULL, 0, path, strlen(path));
+	walker.dirs = malloc(sizeof(struct walk_dir *));
+	walker.stack = malloc(sizeof(struct walk_dir *));
+	if (num_workers == 0 || !root || !walker.dirs || !walker.stack) {
+		ERROR("walk_parallel: out of memory\n");
+		first = 0;
+		goto out;
+	}
+	walker.dirs[0] = walker.stack[0] = root;
+	walker.num_dirs = walker.stack_depth = walker.pending = walker.max_dirs = 1;
+	root = NULL;
+
+	pthread_mutex_init(&walker.lock, NULL);
+	pthread_cond_init(&walker.work, NULL);
+
+	for (started = 1; started < num_workers; started++) {
+		if (pthread_create(&workers[started].thread, NULL, walk_thread_main, &workers[started])) {
+			ERROR("pthread_create: %s\n", strerror(errno));
+			break;
+		}
+	}
+	walk_thread_main(&workers[0]);
+	for (int i = 1; i < started; i++)
+		pthread_join(workers[i].thread, NULL);
+
+	pthread_cond_destroy(&walker.work);
+	pthread_mutex_destroy(&walker.lock);
+
+	walk_stitch(&walker, parent);
+
+out:
+	if (root)
+		walk_dir_free(root);
+	for (size_t i = 0; i < walker.num_dirs; i++)
+		walk_dir_free(walker.dirs[i]);
+	free(walker.dirs);
+	free(walker.stack);
+	for (int i = 0; i < num_workers; i++) {
+		pool_free(&workers[i].segment);
+		free(workers[i].buf);
+		free(workers[i].children);
+	}
+	free(workers);
+
+	return first;
+}
+
+/* Walk 'path' into the pool: with fts if 'threads' is 0, otherwise in parallel */
+static uintptr_t walk(struct filepirate *fp, char *path, uintptr_t parent, int threads)
+{
+	if (threads == 0)
+		return fp_init_dir_recurse(fp, path, parent);
+	return walk_parallel(fp, path, parent, threads);
+}
+
+/* Git work trees can be listed from the git index instead of being walked,
+ * which leaves out ignored files (such as build output) without reading
+ * them at all. Files which aren't tracked, but aren't ignored either, are
+ * listed by git itself, if asked for. Hidden files are left out, as they are
+ * by the walker. */
+struct git_paths {
+	char *buf;                 // Every path, each null terminated
+	size_t len;
+	size_t size;
+	size_t count;
+	char **names;              // Pointers into 'buf', made at the end
+};
+
+static bool git_paths_append(struct git_paths *paths, const char *data, size_t len)
+{
+	if (paths->len + len > paths->size) {
+		size_t new_size = paths->size ? paths->size : 64 * 1024;
+		char *new_buf;
+
+		while (new_size < paths->len + len)
+			new_size *= 2;
+		new_buf = realloc(paths->buf, new_size);
+		if (!new_buf) {
+			ERROR("git_paths_append realloc\n");
+			return false;
+		}
+		paths->buf = new_buf;
+		paths->size = new_size;
+	}
+
+	memcpy(paths->buf + paths->len, data, len);
+	paths->len += len;
+	return true;
+}
+
+static bool git_paths_add(struct git_paths *paths, const char *name, size_t len)
+{
+	if (!git_paths_append(paths, name, len) || !git_paths_append(paths, "", 1))
+		return false;
+	paths->count ++;
+	return true;
+}
+
+static void git_paths_free(struct git_paths *paths)
+{
+	free(paths->buf);
+	free(paths->names);
+	memset(paths, 0, sizeof *paths);
+}
+
+static inline uint32_t be32(const uint8_t *ptr)
+{
+	return (uint32_t)ptr[0] << 24 | (uint32_t)ptr[1] << 16 | (uint32_t)ptr[2] << 8 | ptr[3];
+}
+
+static inline uint16_t be16(const uint8_t *ptr)
+{
+	return ptr[0] << 8 | ptr[1];
+}
+
+#define GIT_ENTRY_HEADER_SIZE 40       // ctime, mtime, dev, ino, mode, uid, gid, size
+#define GIT_FLAG_EXTENDED 0x4000
+#define GIT_FLAG_NAME_MASK 0x0fff
+#define GIT_EXT_SKIP_WORKTREE 0x4000
+
+/* Read the regular files out of a git index (versions 2 to 4), whose object
+ * names are 'hash_len' bytes. Returns false if it doesn't make sense, which
+ * is also how a SHA-256 repository is told apart from a SHA-1 one. */
+static bool git_index_parse(const uint8_t *map, size_t size, size_t hash_len, struct git_paths *paths)
+{
+	uint32_t version = be32(map + 4), count = be32(map + 8);
+	const uint8_t *ptr = map + 12, *end = map + size - hash_len;
+	char name[PATH_MAX];
+	size_t name_len = 0;
+
+	for (uint32_t i = 0; i < count; i++) {
+		const uint8_t *entry = ptr, *nul;
+		uint32_t mode;
+		uint16_t flags, ext = 0;
+
+		if (end - ptr < GIT_ENTRY_HEADER_SIZE + hash_len + 2)
+			return false;
+		mode = be32(ptr + 24);
+		flags = be16(ptr + GIT_ENTRY_HEADER_SIZE + hash_len);
+		ptr += GIT_ENTRY_HEADER_SIZE + hash_len + 2;
+		if (flags & GIT_FLAG_EXTENDED) {
+			if (version < 3 || end - ptr < 2)
+				return false;
+			ext = be16(ptr);
+			ptr += 2;
+		}
+
+		if (version == 4) {
+			/* The name is the previous one, less some bytes from the end, plus a suffix */
+			size_t strip = 0;
+			uint8_t c;
+
+			do {
+				if (ptr >= end)
+					return false;
+				c = *ptr++;
+				strip = (strip << 7) | (c & 0x7f);
+				if (c & 0x80)
+					strip ++;
+			} while (c & 0x80);
+
+			nul = memchr(ptr, '\0', end - ptr);
+			if (!nul || strip > name_len || name_len - strip + (nul - ptr) >= sizeof name)
+				return false;
+			name_len -= strip;
+			memcpy(name + name_len, ptr, nul - ptr);
+			name_len += nul - ptr;
+			name[name_len] = '\0';
+			ptr = nul + 1;
+		} else {
+			nul = memchr(ptr, '\0', end - ptr);
+			if (!nul || nul - ptr >= sizeof name)
+				return false;
+			name_len = nul - ptr;
+			memcpy(name, ptr, name_len + 1);
+			/* Entries are padded with nuls to a multiple of 8 bytes */
+			ptr = entry + ((ptr - entry + name_len + 8) & ~(size_t)7);
+		}
+
+		if ((flags & GIT_FLAG_NAME_MASK) != (name_len < GIT_FLAG_NAME_MASK ? name_len : GIT_FLAG_NAME_MASK))
+			return false;
+
+		/* Leave out submodules, symlinks, sparse directories and files not checked out */
+		if ((mode & 0170000) == 0100000 && !(ext & GIT_EXT_SKIP_WORKTREE)) {
+			if (!git_paths_add(paths, name, name_len))
+				return false;
+		}
+	}
+
+	return ptr <= end;
+}
+
+/* Open the git index of the root, or return -1 if it isn't a git work tree */
+static int git_index_open(struct filepirate *fp)
+{
+	char buf[PATH_MAX];
+	struct stat st;
+	ssize_t len;
+	int fd;
+
+	if (fstatat(fp->root_fd, ".git", &st, 0) != 0)
+		return -1;
+	if (S_ISDIR(st.st_mode))
+		return openat(fp->root_fd, ".git/index", O_RDONLY | O_CLOEXEC);
+
+	/* A linked work tree or a submodule: .git says where the git directory is */
+	fd = openat(fp->root_fd, ".git", O_RDONLY | O_CLOEXEC);
+	if (fd < 0)
+		return -1;
+	len = read(fd, buf, sizeof buf - sizeof "/index");
+	close(fd);
+	if (len < 8 || strncmp(buf, "gitdir: ", 8) != 0)
+		return -1;
+	while (len > 8 && (buf[len - 1] == '\n' || buf[len - 1] == '\r'))
+		len --;
+	strcpy(buf + len, "/index");
+
+	/* Relative to the root, unless it's absolute */
+	return openat(fp->root_fd, buf + 8, O_RDONLY | O_CLOEXEC);
+}
+
+static bool git_index_read(struct filepirate *fp, struct git_paths *paths)
+{
+	struct stat st;
+	uint8_t *map;
+	bool ok = false;
+	int fd = git_index_open(fp);
+
+	if (fd < 0)
+		return false;
+
+	if (fstat(fd, &st) != 0 || st.st_size < 12 + 20) {
+		close(fd);
+		return false;
+	}
+
+	map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+	close(fd);
+	if (map == MAP_FAILED)
+		return false;
+
+	if (memcmp(map, "DIRC", 4) == 0 && be32(map + 4) >= 2 && be32(map + 4) <= 4) {
+		ok = git_index_parse(map, st.st_size, 20, paths);
+		if (!ok && st.st_size >= 12 + 32) {
+			paths->len = paths->count = 0;
+			ok = git_index_parse(map, st.st_size, 32, paths);
+		}
+	}
+	if (!ok)
+		ERROR("git_index_read: can't read the git index\n");
+
+	munmap(map, st.st_size);
+	return ok;
+}
+
+extern char **environ;
+
+/* Add the files which git isn't tracking, and isn't ignoring either */
+static bool git_untracked_read(struct filepirate *fp, struct git_paths *paths)
+{
+	char root[PATH_MAX], buf[64 * 1024];
+	char *argv[] = {"git", "-C", system_path(fp, ".", root), "ls-files", "-z", "--others", "--exclude-standard", NULL};
+	posix_spawn_file_actions_t actions;
+	size_t start = paths->len;
+	int pipe_fds[2], status;
+	bool ok = true;
+	ssize_t len;
+	pid_t pid;
+
+	if (pipe(pipe_fds) != 0)
+		return false;
+	fcntl(pipe_fds[0], F_SETFD, FD_CLOEXEC);
+	fcntl(pipe_fds[1], F_SETFD, FD_CLOEXEC);
+
+	posix_spawn_file_actions_init(&actions);
+	posix_spawn_file_actions_adddup2(&actions, pipe_fds[1], 1);
+	posix_spawn_file_actions_addopen(&actions, 2, "/dev/null", O_WRONLY, 0);
+	status = posix_spawnp(&pid, "git", &actions, NULL, argv, environ);
+	posix_spawn_file_actions_destroy(&actions);
+	close(pipe_fds[1]);
+	if (status != 0) {
+		ERROR("git_untracked_read: can't run git: %s\n", strerror(status));
+		close(pipe_fds[0]);
+		return false;
+	}
+
+	/* Names may be split between reads, so count them afterwards */
+	while ((len = read(pipe_fds[0], buf, sizeof buf)) > 0 || (len < 0 && errno == EINTR)) {
+		if (len > 0 && ok)
+			ok = git_paths_append(paths, buf, len);
+	}
+	close(pipe_fds[0]);
+
+	while (waitpid(pid, &status, 0) < 0 && errno == EINTR)
+		;
+	if (!ok || !WIFEXITED(status) || WEXITSTATUS(status) != 0
+			|| (paths->len > start && paths->buf[paths->len - 1] != '\0')) {
+		ERROR("git_untracked_read: git ls-files failed\n");
+		paths->len = start;
+		return false;
+	}
+
+	/* Every name, including the last, is null terminated */
+	for (size_t pos = start; pos < paths->len; pos++) {
+		if (paths->buf[pos] == '\0')
+			paths->count ++;
+	}
+
+	return true;
+}
+
+static int compare_names(const void *a, const void *b)
+{
+	return strcmp(*(char * const *)a, *(char * const *)b);
+}
+
+static bool name_hidden(const char *name)
+{
+	return name[0] == '.' || strstr(name, "/.") != NULL;
+}
+
+/* A directory on the way down to the current file */
+struct git_dir {
+	uintptr_t first;           // Its first directory entry
+	long wd;
+	size_t path_len;           // Of the path up to and including it
+};
+
+/* Put sorted paths in the pool. The files in a directory are interrupted by
+ * its subdirectories, so a directory may need more than one entry, as with
+ * fts. Returns the index of the root's first directory entry. */
+static uintptr_t git_build(struct filepirate *fp, char **names, size_t count)
+{
+	struct git_dir *dirs = malloc((PATH_MAX / 2 + 1) * sizeof(struct git_dir));
+	uintptr_t first = fp->main_pool.next, block;
+	char path[PATH_MAX] = ".";
+	int depth = 0, open_depth = -1;  // Depth of the directory whose entry is open
+	const char *skip = NULL;         // A directory left out by the filter ...
+	size_t skip_len = 0;             // ... and the length of its path
+	struct stat st;
+
+	if (!dirs) {
+		ERROR("git_build malloc\n");
+		return 0;
+	}
+
+	block = dirent_start(fp, 0, ".", 1);
+	if (block == 0)
+		goto out;
+	dirs[0] = (struct git_dir){block, watch_add(fp, "."), 1};
+	watch_add_block(fp, dirs[0].wd, block);
+	if (fp->cache_filename && fstat(fp->root_fd, &st) == 0)
+		stamp_add(fp, ".", 1, &ST_MTIM(&st));
+	fp->stats.walk_dirs ++;
+	open_depth = 0;
+
+	for (size_t i = 0; i < count; i++) {
+		char *name = names[i], *file = strrchr(name, '/');
+		size_t dir_len = file ? file - name : 0;
+
+		file = file ? file + 1 : name;
+		if ((i > 0 && strcmp(name, names[i - 1]) == 0) || name_hidden(name)
+				|| (skip && dir_len >= skip_len && name[skip_len] == '/' && memcmp(name, skip, skip_len) == 0)
+				|| !passes_filter_path(fp, name, file, false))
+			continue;
+
+		/* Leave the directories which this file isn't in. The path
+		 * looks like "./a/b", while the name looks like "a/b/c". */
+		while (depth > 0 && !(dirs[depth].path_len - 2 <= dir_len
+				&& memcmp(path + 2, name, dirs[depth].path_len - 2) == 0
+				&& (name[dirs[depth].path_len - 2] == '/')))
+			depth --;
+		path[dirs[depth].path_len] = '\0';
+
+		/* Enter the rest */
+		for (size_t pos = depth ? dirs[depth].path_len - 1 : 0; pos < dir_len; ) {
+			size_t path_len = dirs[depth].path_len, comp_len;
+			char *comp = name + pos;
+
+			comp_len = (char *)memchr(comp, '/', dir_len - pos + 1) - comp;
+			if (path_len + 1 + comp_len >= sizeof path)
+				goto next;
+
+			path[path_len] = '/';
+			memcpy(path + path_len + 1, comp, comp_len);
+			path[path_len + 1 + comp_len] = '\0';
+			if (!passes_filter_path(fp, path + 2, path + path_len + 1, true)) {
+				/* Nor anything else in it */
+				path[path_len] = '\0';
+				skip = name;
+				skip_len = pos + comp_len;
+				goto next;
+			}
+			path_len += 1 + comp_len;
+
+			if (open_depth >= 0)
+				dirent_end(fp);
+			open_depth = -1;
+			block = dirent_start(fp, dirs[depth].first, comp, comp_len);
+			if (block == 0)
+				goto out;
+
+			depth ++;
+			dirs[depth] = (struct git_dir){block, watch_add(fp, path), path_len};
+			watch_add_block(fp, dirs[depth].wd, block);
+			if (fp->cache_filename && fstatat(fp->root_fd, path, &st, 0) == 0)
+				stamp_add(fp, path, path_len, &ST_MTIM(&st));
+			fp->stats.walk_dirs ++;
+			open_depth = depth;
+			pos += comp_len + 1;
+		}
+
+		if (open_depth != depth) {
+			/* Back from a subdirectory */
+			if (open_depth >= 0)
+				dirent_end(fp);
+			open_depth = -1;
+			block = dirent_continue(fp, dirs[depth].first);
+			if (block == 0)
+				goto out;
+			watch_add_block(fp, dirs[depth].wd, block);
+			open_depth = depth;
+		}
+
+		if (!dirent_add_file(fp, file, strlen(file)))
+			goto out;
+		fp->stats.walk_files ++;
+next:
+		;
+	}
+
+out:
+	if (open_depth >= 0)
+		dirent_end(fp);
+	if (fp->truncated)
+		ERROR("fp_init_dir: memory limit reached, index truncated\n");
+	free(dirs);
+	return first;
+}
+
+/* Fill the pool from the git index. Returns 0, without touching the pool,
+ * if the root isn't a git work tree. */
+static uintptr_t git_walk(struct filepirate *fp)
+{
+	struct git_paths paths = {0};
+	uintptr_t first = 0;
+	bool sorted = true;
+
+	if (!git_index_read(fp, &paths))
+		goto out;
+	if (fp->git == FP_GIT_UNTRACKED && git_untracked_read(fp, &paths))
+		sorted = false;
+
+	paths.names = malloc((paths.count + 1) * sizeof(char *));
+	if (!paths.names) {
+		ERROR("git_walk malloc\n");
+		goto out;
+	}
+	for (size_t i = 0, pos = 0; i < paths.count; i++) {
+		paths.names[i] = paths.buf + pos;
+		pos += strlen(paths.buf + pos) + 1;
+	}
+	if (!sorted)
+		qsort(paths.names, paths.count, sizeof(char *), compare_names);
+
+	first = git_build(fp, paths.names, paths.count);
+	fp->stats.walk_git ++;
+
+out:
+	git_paths_free(&paths);
+	return first;
+}
+
+/* Walk the whole tree, from the root */
+static uintptr_t walk_tree(struct filepirate *fp)
+{
+	uint64_t start_ns = now_ns();
+	uintptr_t first = 0;
+
+	fp->truncated = false;
+	if (fp->git != FP_GIT_OFF)
+		first = git_walk(fp);
+	if (first == 0)
+		first = walk(fp, ".", 0, fp->walk_threads);
+	fp->stats.walk_ns += now_ns() - start_ns;
+
+	return first;
+}
+
+/* Remember the root directory, which all the paths in the index are relative to */
+static bool set_root(struct filepirate *fp, const char *dirname)
+{
+	fp->root_dirname = strdup(dirname);
+	fp->root_path = realpath(dirname, NULL);
+	if (!fp->root_dirname || !fp->root_path) {
+		ERROR("set_root %s: %s\n", dirname, strerror(errno));
+		return false;
+	}
+	if (strcmp(fp->root_path, "/") == 0)
+		fp->root_path[0] = '\0';
+
+	fp->root_fd = open(dirname, O_RDONLY | O_DIRECTORY | O_CLOEXEC);
+	if (fp->root_fd < 0) {
+		ERROR("set_root open %s: %s\n", dirname, strerror(errno));
+		return false;
+	}
+
+	return true;
+}
+
+static void clear_root(struct filepirate *fp)
+{
+	free(fp->root_dirname);
+	free(fp->root_path);
+	fp->root_dirname = fp->root_path = NULL;
+	if (fp->root_fd >= 0)
+		close(fp->root_fd);
+	fp->root_fd = -1;
+}
+
+bool fp_init_dir(struct filepirate *fp, char *dirname)
+{
+	uintptr_t files_index;
+
+	assert(fp->root_dirname == NULL);
+	if (!set_root(fp, dirname)) {
+		clear_root(fp);
+		return false;
+	}
+
+	files_index = walk_tree(fp);
+
+	// Lock the pointers -- now we can't do more allocation using the main pool (in case we realloc and move the pointer)
+	fp->files_index = files_index;
+	fp_lock_files(fp);
+
+	return files_index != 0;
+}
+
+bool fp_watch_enable(struct filepirate *fp)
+{
+	/* Must be called before fp_init_dir(), so the walker can add watches. */
+	assert(fp->root_dirname == NULL);
+#ifdef __linux__
+	if (fp->watch.fd < 0) {
+		fp->watch.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC);
+		if (fp->watch.fd < 0) {
+			ERROR("inotify_init1: %s\n", strerror(errno));
+			return false;
+		}
+	}
+	return true;
+#else
+	return false;
+#endif
+}
+
+#ifdef __linux__
+/* Returns the pool index of the fn_len of live file 'name' in 'dir', or 0 */
+static uintptr_t watch_find_file(struct filepirate *fp, struct watched_dir *dir, const char *name)
+{
+	for (unsigned int i = 0; i < dir->num_blocks; i++) {
+		uintptr_t index = dir->blocks[i];
+
+		index += DIR_HEADER_SIZE + read_uint(fp, index);
+		for (unsigned int len; (len = read_uint(fp, index)) != 0; ) {
+			if (!(len & FP_DELETED) && strcmp((char *)get_ptr(fp, index + DIRENT_HEADER_SIZE), name) == 0)
+				return index;
+			index += DIRENT_HEADER_SIZE + (len & ~FP_DELETED);
+		}
+	}
+
+	return 0;
+}
+
+static bool watch_add_file(struct filepirate *fp, int wd, const char *name)
+{
+	struct watch *watch = &fp->watch;
+	struct watched_dir *dir = &watch->dirs[wd];
+	bool added;
+
+	if (watch_find_file(fp, dir, name))
+		return false;
+
+	if (watch->tail_wd == wd) {
+		/* The last directory entry in the pool is ours: drop its terminator and extend it */
+		fp->main_pool.next -= DIRENT_TERMINATOR_SIZE;
+	} else {
+		uintptr_t block = dirent_continue(fp, dir->blocks[0]);
+		if (block == 0)
+			return false;
+		watch_add_block(fp, wd, block);
+	}
+
+	/* If the pool is full the file is left out, and fp->truncated says so */
+	added = dirent_add_file(fp, name, strlen(name));
+	dirent_end(fp);
+
+	return added;
+}
+
+static bool watch_remove_file(struct filepirate *fp, int wd, const char *name)
+{
+	uintptr_t index = watch_find_file(fp, &fp->watch.dirs[wd], name);
+
+	if (index == 0)
+		return false;
+
+	fp->deleted_size += DIRENT_HEADER_SIZE + read_uint(fp, index);
+	write_uint(fp, index, read_uint(fp, index) | FP_DELETED);
+	return true;
+}
+
+static bool path_in_tree(const char *path, const char *tree, size_t tree_len)
+{
+	return strncmp(path, tree, tree_len) == 0 && (path[tree_len] == '\0' || path[tree_len] == '/');
+}
+
+/* Remove every file in and below directory 'path', and stop watching it. */
+static void watch_remove_tree(struct filepirate *fp, const char *path)
+{
+	struct watch *watch = &fp->watch;
+	size_t path_len = strlen(path);
+
+	for (int wd = 0; wd < watch->max_wd; wd++) {
+		struct watched_dir *dir = &watch->dirs[wd];
+
+		if (dir->path == NULL || !path_in_tree(dir->path, path, path_len))
+			continue;
+
+		for (unsigned int i = 0; i < dir->num_blocks; i++) {
+			uintptr_t index = dir->blocks[i];
+
+			index += DIR_HEADER_SIZE + read_uint(fp, index);
+			for (unsigned int len; (len = read_uint(fp, index)) != 0; ) {
+				if (!(len & FP_DELETED))
+					fp->deleted_size += DIRENT_HEADER_SIZE + len;
+				write_uint(fp, index, len | FP_DELETED);
+				index += DIRENT_HEADER_SIZE + (len & ~FP_DELETED);
+			}
+		}
+
+		inotify_rm_watch(watch->fd, wd);
+		watched_dir_free(watch, wd);
+	}
+}
+
+static bool watch_is_watched(struct watch *watch, const char *path)
+{
+	for (int wd = 0; wd < watch->max_wd; wd++) {
+		if (watch->dirs[wd].path && strcmp(watch->dirs[wd].path, path) == 0)
+			return true;
+	}
+	return false;
+}
+
+/* Apply a single event to the index. Returns false if a full rescan is required. */
+static bool watch_apply(struct filepirate *fp, struct inotify_event *event)
+{
+	struct watch *watch = &fp->watch;
+	struct watched_dir *dir;
+	bool applied = false;
+
+	if (event->mask & IN_Q_OVERFLOW)
+		return false;
+
+	if (event->wd < 0 || event->wd >= watch->max_wd || watch->dirs[event->wd].path == NULL)
+		return true; // Stale event for a directory we've stopped watching
+
+	dir = &watch->dirs[event->wd];
+
+	if (event->mask & IN_IGNORED) {
+		watched_dir_free(watch, event->wd);
+		return true;
+	}
+
+	if (event->mask & (IN_DELETE_SELF | IN_MOVE_SELF)) {
+		/* Subdirectories are dealt with by their parent's events; only the root matters */
+		return strcmp(dir->path, ".") != 0;
+	}
+
+	if (event->len == 0 || event->name[0] == '.')
+		return true;
+
+	if (event->mask & IN_ISDIR) {
+		char *path = malloc(strlen(dir->path) + 1 + strlen(event->name) + 1);
+
+		if (!path) {
+			ERROR("watch_apply malloc\n");
+			return false;
+		}
+		sprintf(path, "%s/%s", dir->path, event->name);
+
+		if (event->mask & (IN_DELETE | IN_MOVED_FROM)) {
+			watch_remove_tree(fp, path);
+			applied = true;
+		} else if ((event->mask & (IN_CREATE | IN_MOVED_TO)) && !watch_is_watched(watch, path)
+				&& passes_filter(fp, dir->path, event->name, true)) {
+			walk(fp, path, dir->blocks[0], fp->walk_threads ? 1 : 0);
+			applied = true;
+		}
+
+		free(path);
+	} else if (event->mask & (IN_DELETE | IN_MOVED_FROM)) {
+		applied = watch_remove_file(fp, event->wd, event->name);
+	} else if ((event->mask & (IN_CREATE | IN_MOVED_TO)) && passes_filter(fp, dir->path, event->name, false)) {
+		applied = watch_add_file(fp, event->wd, event->name);
+	}
+
+	if (applied)
+		fp->stats.watch_events ++;
+
+	return true;
+}
+
+/* Throw the index away and walk the whole tree again. */
+static void watch_rescan(struct filepirate *fp)
+{
+	watch_clear(&fp->watch);
+	pool_reset(&fp->main_pool);
+	fp->deleted_size = 0;
+	if (fp->cache_filename) {
+		pool_reset(&fp->stamp_pool);
+		fp->num_stamps = 0;
+	}
+	fp->files_index = walk_tree(fp);
+	fp->stats.watch_rescans ++;
+}
+#endif
+
+int fp_watch_update(struct filepirate *fp)
+{
+	/* Apply all pending changes to the index. Returns the number of events
+	 * applied (a rescan counts as one), or -1 if the index is not being
+	 * watched. */
+#ifdef __linux__
+	char buf[64 * 1024] __attribute__ ((aligned(__alignof__(struct inotify_event))));
+	uint64_t events_before = fp->stats.watch_events;
+	bool rescan = false;
+	bool changed = false;
+	ssize_t len;
+
+	if (fp->watch.fd < 0)
+		return -1;
+
+	while ((len = read(fp->watch.fd, buf, sizeof buf)) > 0) {
+		struct inotify_event *event;
+
+		changed = true;
+
+		for (char *ptr = buf; ptr < buf + len; ptr += sizeof(struct inotify_event) + event->len) {
+			event = (struct inotify_event *)ptr;
+			/* Once we know we're rescanning, just drain the queue */
+			if (!rescan && !watch_apply(fp, event))
+				rescan = true;
+		}
+	}
+
+	if (len < 0 && errno != EAGAIN)
+		ERROR("inotify read: %s\n", strerror(errno));
+
+	if (changed) {
+		if (rescan)
+			watch_rescan(fp);
+		fp_lock_files(fp);
+	}
+
+	/* The walker may have run out of watches */
+	if (fp->watch.fd < 0)
+		return -1;
+
+	return fp->stats.watch_events - events_before + rescan;
+#else
+	return -1;
+#endif
+}
+
+/* Watch every directory in an index loaded from the cache, and reconstruct
+ * the directory entries belonging to each one. */
+static void watch_attach(struct filepirate *fp, uint8_t *stamps, uint64_t num_stamps)
+{
+	struct watch *watch = &fp->watch;
+	uint32_t table_size = 16, mask;
+	int *table;
+	uint8_t *files;
+
+	while (table_size < num_stamps * 2)
+		table_size *= 2;
+	mask = table_size - 1;
+
+	table = calloc(table_size, sizeof(int));
+	if (!table) {
+		ERROR("watch_attach calloc\n");
+		watch_disable(watch);
+		return;
+	}
+
+	for (uint64_t i = 0; i < num_stamps; i++) {
+		struct dir_stamp *stamp = (struct dir_stamp *)stamps;
+		long wd = watch_add(fp, stamp->path);
+
+		if (wd <= 0)
+			goto out;
+
+		for (uint32_t slot = hash_string(stamp->path) & mask; ; slot = (slot + 1) & mask) {
+			if (table[slot] == 0) {
+				table[slot] = wd;
+				break;
+			}
+		}
+		stamps += stamp->size;
+	}
+
+	for (files = fp->files; files < fp->files_end; ) {
+		char dirname[dir_path_len(files) + 1];
+		uintptr_t block = files - fp->main_pool.start;
+		unsigned int len;
+
+		dir_path(files, dirname);
+		for (uint32_t slot = hash_string(dirname) & mask; table[slot]; slot = (slot + 1) & mask) {
+			if (strcmp(watch->dirs[table[slot]].path, dirname) == 0) {
+				watch_add_block(fp, table[slot], block);
+				break;
+			}
+		}
+
+		files += DIR_HEADER_SIZE + *(unsigned int *)files;
+		while ((len = *(unsigned int *)files) != 0)
+			files += DIRENT_HEADER_SIZE + (len & ~FP_DELETED);
+		files += DIRENT_TERMINATOR_SIZE;
+	}
+
+out:
+	free(table);
+}
+
+void fp_cache_set(struct filepirate *fp, char *cache_filename)
+{
+	/* Must be called before fp_init_dir(), so the walker records directory stamps. */
+	assert(fp->root_dirname == NULL);
+
+	if (fp->cache_filename == NULL && pool_init(&fp->stamp_pool, MEM_LIMIT) == false)
+		return;
+
+	free(fp->cache_filename);
+	fp->cache_filename = strdup(cache_filename);
+}
+
+static bool write_all(int fd, const void *buf, size_t len)
+{
+	while (len > 0) {
+		ssize_t written = write(fd, buf, len);
+
+		if (written < 0) {
+			if (errno == EINTR)
+				continue;
+			return false;
+		}
+		buf = (const uint8_t *)buf + written;
+		len -= written;
+	}
+
+	return true;
+}
+
+bool fp_cache_save(struct filepirate *fp)
+{
+	/* Save the index, as built by the most recent fp_init_dir(), to the cache. */
+	struct cache_header header;
+	char padding[8] = {0};
+	char *tmp_filename;
+	size_t root_len;
+	bool ok;
+	int fd;
+
+	if (fp->cache_filename == NULL || fp->root_dirname == NULL || fp->cache_map)
+		return false;
+
+	tmp_filename = malloc(strlen(fp->cache_filename) + 32);
+	if (!tmp_filename)
+		return false;
+	sprintf(tmp_filename, "%s.%ld", fp->cache_filename, (long)getpid());
+
+	fd = open(tmp_filename, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+	if (fd < 0) {
+		ERROR("fp_cache_save open %s: %s\n", tmp_filename, strerror(errno));
+		free(tmp_filename);
+		return false;
+	}
+
+	root_len = strlen(fp->root_dirname) + 1;
+
+	memset(&header, 0, sizeof header);
+	memcpy(header.magic, FP_CACHE_MAGIC, sizeof header.magic);
+	header.byte_order = FP_CACHE_BYTE_ORDER;
+	header.version = FP_CACHE_VERSION;
+	header.root_size = pad8(root_len);
+	header.num_stamps = fp->num_stamps;
+	header.stamps_size = fp->stamp_pool.next - 4;
+	header.pool_size = fp->files_end - fp->files;
+
+	ok = write_all(fd, &header, sizeof header)
+		&& write_all(fd, fp->root_dirname, root_len)
+		&& write_all(fd, padding, header.root_size - root_len)
+		&& write_all(fd, fp->stamp_pool.start + 4, header.stamps_size)
+		&& write_all(fd, fp->files, header.pool_size);
+
+	/* On disk before the rename, so a crash can't leave a truncated cache */
+	if (ok && fsync(fd))
+		ok = false;
+	if (close(fd))
+		ok = false;
+
+	/* Replace the old cache atomically, so concurrent readers see one or the other */
+	if (ok && rename(tmp_filename, fp->cache_filename) == 0) {
+		free(tmp_filename);
+		return true;
+	}
+
+	ERROR("fp_cache_save %s: %s\n", fp->cache_filename, strerror(errno));
+	unlink(tmp_filename);
+	free(tmp_filename);
+	return false;
+}
+
+/* Returns true if every directory still has the mtime recorded in the cache */
+static bool cache_validate(struct filepirate *fp, uint8_t *stamps, uint64_t num_stamps)
+{
+	for (uint64_t i = 0; i < num_stamps; i++) {
+		struct dir_stamp *stamp = (struct dir_stamp *)stamps;
+		struct stat st;
+
+		if (fstatat(fp->root_fd, stamp->path, &st, 0)
+				|| ST_MTIM(&st).tv_sec != stamp->mtime_sec
+				|| ST_MTIM(&st).tv_nsec != stamp->mtime_nsec)
+			return false;
+
+		stamps += stamp->size;
+	}
+
+	return true;
+}
+
+/* Returns true if the stamps are well formed: 'num_stamps' of them, each
+ * with a nul terminated path, filling exactly 'stamps_size' bytes */
+static bool cache_check_stamps(const uint8_t *stamps, uint64_t stamps_size, uint64_t num_stamps)
+{
+	uint64_t pos = 0;
+
+	for (uint64_t i = 0; i < num_stamps; i++) {
+		const struct dir_stamp *stamp = (const struct dir_stamp *)(stamps + pos);
+
+		if (stamps_size - pos < sizeof(struct dir_stamp) + 1
+				|| stamp->size < sizeof(struct dir_stamp) + 1
+				|| stamp->size % 8 != 0
+				|| stamp->size > stamps_size - pos
+				|| stamp->path[stamp->size - sizeof(struct dir_stamp) - 1] != '\0')
+			return false;
+		pos += stamp->size;
+	}
+
+	return pos == stamps_size;
+}
+
+/* Returns true if 'name', 'len' bytes including the nul, is nul terminated */
+static inline bool cache_check_name(const uint8_t *name, unsigned int len)
+{
+	return len >= 1 && name[len - 1] == '\0';
+}
+
+/* Returns true if the pool is well formed, so that the scan, dir_path() and
+ * the watcher can trust it: every record fits in the pool and is nul
+ * terminated, every directory entry is terminated, and every directory
+ * entry's parent is an earlier directory entry, with a path length which
+ * agrees with it. Cached pools are read-only if not watched, so this is the
+ * only check they get. */
+static bool cache_check_pool(const uint8_t *pool, uint64_t pool_size)
+{
+	uint32_t *dirs = NULL, *new_dirs;   /* Offset of each directory entry, in order */
+	size_t num_dirs = 0, max_dirs = 0;
+	uint64_t pos = 0;
+	bool ok = false;
+
+	if (pool_size > MEM_LIMIT_MAX)
+		return false;
+
+	while (pos < pool_size) {
+		const uint8_t *dir = pool + pos;
+		unsigned int dir_len, path_len;
+		uint32_t distance;
+
+		if (pool_size - pos < DIR_HEADER_SIZE)
+			goto out;
+		dir_len = read_uint32(dir);
+		distance = read_uint32(dir + DIRENT_HEADER_SIZE);
+		path_len = dir_path_len(dir);
+		if (dir_len > pool_size - pos - DIR_HEADER_SIZE || !cache_check_name(dir + DIR_HEADER_SIZE, dir_len)
+				|| path_len >= PATH_MAX)
+			goto out;
+
+		if (distance == 0) {
+			if (path_len != dir_len - 1)
+				goto out;
+		} else {
+			/* The parent must be the start of an earlier directory entry */
+			uint64_t parent = pos - distance;
+			size_t lo = 0, hi = num_dirs;
+
+			if (distance > pos)
+				goto out;
+			while (lo < hi) {
+				size_t mid = lo + (hi - lo) / 2;
+
+				if (dirs[mid] < parent)
+					lo = mid + 1;
+				else
+					hi = mid;
+			}
+			if (lo == num_dirs || dirs[lo] != parent || path_len != dir_path_len(pool + parent) + dir_len)
+				goto out;
+		}
+
+		if (num_dirs == max_dirs) {
+			max_dirs = max_dirs ? max_dirs * 2 : 1024;
+			new_dirs = realloc(dirs, max_dirs * sizeof *dirs);
+			if (!new_dirs)
+				goto out;
+			dirs = new_dirs;
+		}
+		dirs[num_dirs++] = pos;
+		pos += DIR_HEADER_SIZE + dir_len;
+
+		/* The files, up to the terminator */
+		for (;;) {
+			unsigned int len;
+
+			if (pool_size - pos < sizeof(unsigned int))
+				goto out;
+			len = read_uint32(pool + pos);
+			if (len == 0)
+				break;
+			len &= ~FP_DELETED;
+			if (pool_size - pos < DIRENT_HEADER_SIZE || len > pool_size - pos - DIRENT_HEADER_SIZE
+					|| !cache_check_name(pool + pos + DIRENT_HEADER_SIZE, len))
+				goto out;
+			pos += DIRENT_HEADER_SIZE + len;
+		}
+		if (pool_size - pos < DIRENT_TERMINATOR_SIZE || pool[pos + sizeof(unsigned int)] != '\0')
+			goto out;
+		pos += DIRENT_TERMINATOR_SIZE;
+	}
+	ok = true;
+
+out:
+	free(dirs);
+	return ok;
+}
+
+int fp_cache_load(struct filepirate *fp, char *dirname)
+{
+	/* Load the index for 'dirname' from the cache set by fp_cache_set(),
+	 * instead of calling fp_init_dir(). Returns FP_CACHE_NONE if there is no
+	 * usable cache, in which case fp is untouched. Otherwise the index is
+	 * ready to search, but if the result is FP_CACHE_STALE it's out of date
+	 * and the caller should build a new one. */
+	struct cache_header *header;
+	struct stat st;
+	uint8_t *map, *stamps;
+	uint64_t available;
+	bool fresh;
+	int fd;
+
+	assert(fp->root_dirname == NULL);
+
+	if (fp->cache_filename == NULL)
+		return FP_CACHE_NONE;
+
+	fd = open(fp->cache_filename, O_RDONLY);
+	if (fd < 0)
+		return FP_CACHE_NONE;
+
+	if (fstat(fd, &st) || st.st_size < sizeof(struct cache_header)) {
+		close(fd);
+		return FP_CACHE_NONE;
+	}
+
+	map = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+	close(fd);
+	if (map == MAP_FAILED)
+		return FP_CACHE_NONE;
+
+	/* Check each size against the file before adding them up, so they can't overflow */
+	header = (struct cache_header *)map;
+	available = st.st_size - sizeof *header;
+	if (memcmp(header->magic, FP_CACHE_MAGIC, sizeof header->magic)
+			|| header->byte_order != FP_CACHE_BYTE_ORDER
+			|| header->version != FP_CACHE_VERSION
+			|| header->root_size > available
+			|| header->stamps_size > available - header->root_size
+			|| header->pool_size != available - header->root_size - header->stamps_size
+			|| header->root_size == 0
+			|| map[sizeof *header + header->root_size - 1] != '\0'
+			|| strncmp((char *)(map + sizeof *header), dirname, header->root_size) != 0) {
+		munmap(map, st.st_size);
+		return FP_CACHE_NONE;
+	}
+
+	/* A damaged cache would crash the scan */
+	stamps = map + sizeof *header + header->root_size;
+	if (!cache_check_stamps(stamps, header->stamps_size, header->num_stamps)
+			|| !cache_check_pool(stamps + header->stamps_size, header->pool_size)) {
+		ERROR("fp_cache_load %s: damaged, ignoring\n", fp->cache_filename);
+		munmap(map, st.st_size);
+		return FP_CACHE_NONE;
+	}
+
+	posix_madvise(map, st.st_size, POSIX_MADV_WILLNEED);
+
+	if (!set_root(fp, dirname)) {
+		munmap(map, st.st_size);
+		clear_root(fp);
+		return FP_CACHE_NONE;
+	}
+	fresh = cache_validate(fp, stamps, header->num_stamps);
+
+	if (fp->watch.fd >= 0) {
+		/* The watcher modifies the pool, so it can't live in the mapping */
+		uintptr_t index = alloc(fp, header->pool_size);
+
+		if (index == 0) {
+			/* Over the memory limit. Let the walker do what it can. */
+			munmap(map, st.st_size);
+			clear_root(fp);
+			return FP_CACHE_NONE;
+		}
+
+		memcpy(get_ptr(fp, index), stamps + header->stamps_size, header->pool_size);
+		fp->files_index = index;
+		fp_lock_files(fp);
+		watch_attach(fp, stamps, header->num_stamps);
+		munmap(map, st.st_size);
+	} else {
+		fp->cache_map = map;
+		fp->cache_map_size = st.st_size;
+		fp->files = stamps + header->stamps_size;
+		fp->files_end = fp->files + header->pool_size;
+	}
+
+	return fresh ? FP_CACHE_FRESH : FP_CACHE_STALE;
+}
+
+void fp_get_stats(struct filepirate *fp, struct fp_stats *stats)
+{
+	*stats = fp->stats;
+	stats->pool_used = fp->files_end - fp->files;
+	stats->pool_committed = fp->cache_map ? fp->cache_map_size : fp->main_pool.size;
+	stats->pool_deleted = fp->deleted_size;
+}
+
+bool fp_index_truncated(struct filepirate *fp)
+{
+	return fp->truncated;
+}
+
+bool fp_set_memory_limit(struct filepirate *fp, size_t limit)
+{
+	/* Must be called before fp_init_dir(), as the pool is reallocated. */
+	assert(fp->root_dirname == NULL);
+
+	pool_free(&fp->main_pool);
+	return pool_init(&fp->main_pool, limit < MEM_LIMIT_MAX ? limit : MEM_LIMIT_MAX);
+}
+
+static void fp_deinit_dir(struct filepirate *fp)
+{
+	clear_root(fp);
+
+	if (fp->cache_map) {
+		munmap(fp->cache_map, fp->cache_map_size);
+		fp->cache_map = NULL;
+	}
+
+	if (fp->cache_filename) {
+		free(fp->cache_filename);
+		fp->cache_filename = NULL;
+		pool_free(&fp->stamp_pool);
+	}
+}
+
+/* Non-contiguous matching across two strings (directory name and file name) */
+/* Note the lengths are strlen() lengths, i.e. don't include the terminating
+ * null, unlike the lengths stored in the directory structure in memory. */
+
+// We search backwards in order to match as much on filename as possible
+// before dirname, because filename is more important. The directory name
+// is matched one component at a time, walking up the tree, with positions
+// counted as if the whole path were there.
+//
+// What happens in the directory name depends only on how much of the needle
+// is left after the file name, so the scan remembers it for each directory in
+// 'dir_memo', indexed by the needle position: DIR_MEMO_UNKNOWN, DIR_NO_MATCH,
+// or the number of contiguous matches.
+//
+// When case is folded, 'needle_alt' holds the other case of each needle
+// character, so a character matches either without converting the name. A
+// match whose every character has the case of the needle gets
+// CASE_EXACT_BONUS. The directory memo then holds twice the number of
+// contiguous matches, plus 1 if the case matched.
+#define DIR_MEMO_UNKNOWN (-2)
+#define DIR_NO_MATCH (-1)
+#define CASE_EXACT_BONUS 1
+
+static inline bool char_matches(char c, int idx, const char *needle, const char *needle_alt)
+{
+	return c == needle[idx] || (needle_alt && c == needle_alt[idx]);
+}
+
+/* Finding needle characters. The matchers below look for each needle
+ * character in turn, walking backwards, so the work is mostly finding the
+ * last 'c' (or 'alt') at or before a position. rfind_simd() does this 16
+ * bytes at a time. Its loads are aligned, so they never cross into another
+ * page, although they may read a few bytes either side of the name. */
+#ifdef __SSE2__
+#define FP_HAVE_SIMD true
+
+static inline int rfind_simd(const char *s, int end, char c, char alt)
+{
+	uintptr_t start = (uintptr_t)s, pos = start + end;
+	uintptr_t block = pos & ~(uintptr_t)15;
+	unsigned int keep = 0xffffu >> (15 - (pos & 15));  /* Bytes up to 'pos' */
+	__m128i want = _mm_set1_epi8(c), want_alt = _mm_set1_epi8(alt);
+
+	if (end < 0)
+		return -1;
+
+	for (;;) {
+		__m128i bytes = _mm_load_si128((const __m128i *)block);
+		__m128i found = _mm_cmpeq_epi8(bytes, want);
+		unsigned int bits;
+
+		if (alt != c)
+			found = _mm_or_si128(found, _mm_cmpeq_epi8(bytes, want_alt));
+		bits = _mm_movemask_epi8(found) & keep;
+		if (block <= start)
+			bits &= 0xffffu << (start - block);  /* Bytes from the start of 's' */
+		if (bits)
+			return (int)(block + 31 - __builtin_clz(bits) - start);
+		if (block <= start)
+			return -1;
+		block -= 16;
+		keep = 0xffffu;
+	}
+}
+#else
+#define FP_HAVE_SIMD false
+
+static inline int rfind_simd(const char *s, int end, char c, char alt)
+{
+	/* Not used; see fp_set_simd() */
+	return -1;
+}
+#endif
+
+static int match_dir(const uint8_t *dir, unsigned int path_len, int idx_needle, char *needle, const char *needle_alt, bool simd)
+{
+	int idx_hay = path_len, last_match_idx = -1, contig = 0;
+	bool exact = true;
+
+	while (dir && idx_needle >= 0) {
+		const char *name = dir_name(dir);
+
+		if (simd) {
+			int name_len = *(unsigned int *)dir - 1, idx_name = name_len - 1;
+			int name_start = idx_hay - name_len;  /* Position of the name in the path */
+
+			while (idx_needle >= 0) {
+				idx_name = rfind_simd(name, idx_name, needle[idx_needle],
+						needle_alt ? needle_alt[idx_needle] : needle[idx_needle]);
+				if (idx_name < 0)
+					break;
+				exact &= name[idx_name] == needle[idx_needle];
+				idx_needle --;
+
+				if (name_start + idx_name + 1 == last_match_idx)
+					contig ++;
+
+				last_match_idx = name_start + idx_name;
+				idx_name --;
+			}
+			idx_hay = name_start;
+		} else {
+			for (int idx_name = *(unsigned int *)dir - 2; idx_name >= 0 && idx_needle >= 0; idx_name--) {
+				idx_hay --;
+				if (char_matches(name[idx_name], idx_needle, needle, needle_alt)) {
+					exact &= name[idx_name] == needle[idx_needle];
+					idx_needle --;
+
+					if (idx_hay + 1 == last_match_idx)
+						contig ++;
+
+					last_match_idx = idx_hay;
+				}
+			}
+		}
+
+		dir = dir_parent(dir);
+		if (dir && idx_needle >= 0) {
+			/* The separator */
+			idx_hay --;
+			if (needle[idx_needle] == '/') {
+				idx_needle --;
+
+				if (idx_hay + 1 == last_match_idx)
+					contig ++;
+
+				last_match_idx = idx_hay;
+			}
+		}
+	}
+
+	if (idx_needle != -1)
+		return DIR_NO_MATCH;
+	return needle_alt ? contig * 2 + exact : contig;
+}
+
+static inline bool fp_strstr(const uint8_t *dir, unsigned int path_len, int *dir_memo,
+		unsigned int filename_len, char *filename,
+		unsigned int needle_len, char *needle, const char *needle_alt, bool simd,
+		int *goodness)
+{
+	int idx_hay, idx_needle = needle_len, contig = 0, contig_dir = 0;
+	int last_match_idx = filename_len;
+	bool exact = true;
+
+	if (simd) {
+		for (idx_hay = filename_len - 1; idx_needle >= 0; idx_hay--) {
+			idx_hay = rfind_simd(filename, idx_hay, needle[idx_needle],
+					needle_alt ? needle_alt[idx_needle] : needle[idx_needle]);
+			if (idx_hay < 0)
+				break;
+			if (needle_alt)
+				exact &= filename[idx_hay] == needle[idx_needle];
+			idx_needle --;
+
+			if (idx_hay + 1 == last_match_idx)
+				contig ++;
+
+			last_match_idx = idx_hay;
+		}
+	} else {
+		for (idx_hay = filename_len - 1; idx_hay >= 0 && idx_needle >= 0; idx_hay--) {
+			if (char_matches(filename[idx_hay], idx_needle, needle, needle_alt)) {
+				if (needle_alt)
+					exact &= filename[idx_hay] == needle[idx_needle];
+				idx_needle --;
+
+				if (idx_hay + 1 == last_match_idx)
+					contig ++;
+
+				last_match_idx = idx_hay;
+			}
+		}
+	}
+
+	if (idx_needle >= 0) {
+		if (dir_memo[idx_needle] == DIR_MEMO_UNKNOWN)
+			dir_memo[idx_needle] = match_dir(dir, path_len, idx_needle, needle, needle_alt, simd);
+		contig_dir = dir_memo[idx_needle];
+		if (contig_dir == DIR_NO_MATCH)
+			return false;
+		if (needle_alt) {
+			exact &= contig_dir & 1;
+			contig_dir >>= 1;
+		}
+	}
+
+	if (goodness) {
+		*goodness = contig + contig_dir + (needle_alt && exact ? CASE_EXACT_BONUS : 0);
+	}
+
+	return true;
+}
+
+struct candidate_list *fp_candidate_list_create(int max_candidates)
+{
+	struct candidate_list *list;
+
+	list = malloc(sizeof(*list));
+	if (!list)
+		return NULL;
+
+	list->candidates = malloc((max_candidates > 0 ? max_candidates : 1) * sizeof(struct candidate));
+	if (!list->candidates) {
+		free(list);
+		return NULL;
+	}
+	list->num_candidates = 0;
+	list->max_candidates = max_candidates;
+	list->dirnames = NULL;
+	list->dirnames_size = 0;
+	list->needle = NULL;
+	list->needle_len = 0;
+
+	return list;
+}
+
+static void candidate_list_reset(struct candidate_list *list)
+{
+	list->num_candidates = 0;
+}
+
+void fp_candidate_list_destroy(struct candidate_list *list)
+{
+	free(list->candidates);
+	free(list->dirnames);
+	free(list->needle);
+	free(list);
+}
+
+/* strcmp() the full paths of two directories without putting them together */
+static int dir_compare(const uint8_t *a, const uint8_t *b)
+{
+	int depth_a = 0, depth_b = 0;
+
+	for (const uint8_t *dir = a; dir; dir = dir_parent(dir))
+		depth_a ++;
+	for (const uint8_t *dir = b; dir; dir = dir_parent(dir))
+		depth_b ++;
+
+	const uint8_t *chain_a[depth_a], *chain_b[depth_b];
+	for (int i = depth_a - 1; i >= 0; i--, a = dir_parent(a))
+		chain_a[i] = a;
+	for (int i = depth_b - 1; i >= 0; i--, b = dir_parent(b))
+		chain_b[i] = b;
+
+	/* Compare from the root down. Once a component differs, so do the paths. */
+	for (int i = 0; i < depth_a && i < depth_b; i++) {
+		const char *name_a = dir_name(chain_a[i]), *name_b = dir_name(chain_b[i]);
+		int j;
+
+		if (name_a == name_b)
+			continue;
+		for (j = 0; name_a[j] && name_a[j] == name_b[j]; j++)
+			;
+		if (name_a[j] != name_b[j]) {
+			/* The shorter name is followed by a separator, unless the path ends there */
+			uint8_t ca = name_a[j] ? name_a[j] : (i + 1 < depth_a ? '/' : '\0');
+			uint8_t cb = name_b[j] ? name_b[j] : (i + 1 < depth_b ? '/' : '\0');
+
+			return ca - cb;
+		}
+	}
+
+	return depth_a - depth_b;
+}
+
+/* The ranking. Higher goodness wins; ties go to the shorter path, then to
+ * the directory name and file name that sort first. This is a total order,
+ * so the results don't depend on the order in which files were scanned. */
+static inline bool candidate_better(const struct candidate *a, const struct candidate *b)
+{
+	int cmp;
+
+	if (a->goodness != b->goodness)
+		return a->goodness > b->goodness;
+	if (a->path_len != b->path_len)
+		return a->path_len < b->path_len;
+	if (a->dir != b->dir && (cmp = dir_compare(a->dir, b->dir)) != 0)
+		return cmp < 0;
+	return strcmp(a->filename, b->filename) < 0;
+}
+
+/* Until fp_get_candidates() sorts it, the list is a heap with the worst
+ * candidate at the top, so it is quick to tell whether a new one gets in. */
+static void heap_sift_down(struct candidate *heap, int count, int idx)
+{
+	struct candidate moving = heap[idx];
+
+	while (true) {
+		int child = idx * 2 + 1;
+
+		if (child >= count)
+			break;
+		if (child + 1 < count && candidate_better(&heap[child], &heap[child + 1]))
+			child ++;
+		if (!candidate_better(&moving, &heap[child]))
+			break;
+		heap[idx] = heap[child];
+		idx = child;
+	}
+	heap[idx] = moving;
+}
+
+static void candidate_list_add(struct candidate_list *list, const uint8_t *dir, char *filename,
+		unsigned int path_len, int goodness)
+{
+	struct candidate new_candidate = {NULL, filename, goodness, path_len, dir};
+	struct candidate *heap = list->candidates;
+
+	if (list->num_candidates < list->max_candidates) {
+		int idx = list->num_candidates++;
+
+		while (idx > 0) {
+			int parent = (idx - 1) / 2;
+
+			if (!candidate_better(&heap[parent], &new_candidate))
+				break;
+			heap[idx] = heap[parent];
+			idx = parent;
+		}
+		heap[idx] = new_candidate;
+	} else if (list->num_candidates > 0 && candidate_better(&new_candidate, &heap[0])) {
+		heap[0] = new_candidate;
+		heap_sift_down(heap, list->num_candidates, 0);
+	}
+}
+
+/* Turn the heap into a list sorted best first, and fill in the directory names */
+static bool candidate_list_finish(struct candidate_list *list)
+{
+	size_t dirnames_size = 0;
+	char *dirname;
+
+	for (int count = list->num_candidates; count > 1; count--) {
+		struct candidate worst = list->candidates[0];
+
+		list->candidates[0] = list->candidates[count - 1];
+		list->candidates[count - 1] = worst;
+		heap_sift_down(list->candidates, count - 1, 0);
+	}
+
+	for (int i = 0; i < list->num_candidates; i++)
+		dirnames_size += dir_path_len(list->candidates[i].dir) + 1;
+
+	if (dirnames_size > list->dirnames_size) {
+		char *new_dirnames = realloc(list->dirnames, dirnames_size);
+
+		if (!new_dirnames)
+			return false;
+		list->dirnames = new_dirnames;
+		list->dirnames_size = dirnames_size;
+	}
+
+	dirname = list->dirnames;
+	for (int i = 0; i < list->num_candidates; i++) {
+		list->candidates[i].dirname = dirname;
+		dir_path(list->candidates[i].dir, dirname);
+		dirname += dir_path_len(list->candidates[i].dir) + 1;
+	}
+
+	return true;
+}
+
+/* Remember what was searched for, for match_positions(). 'needle_alt' is
+ * NULL if case was matched exactly. */
+static bool candidate_list_set_needle(struct candidate_list *list, const char *needle, const char *needle_alt, int needle_len)
+{
+	char *new_needle = realloc(list->needle, needle_len * 2 + 1);
+
+	if (!new_needle)
+		return false;
+	memcpy(new_needle, needle, needle_len);
+	memcpy(new_needle + needle_len, needle_alt ? needle_alt : needle, needle_len);
+	list->needle = new_needle;
+	list->needle_len = needle_len;
+	return true;
+}
+
+/* Where each needle character matched 'dirname'/'filename', found the same
+ * way as fp_strstr() does: the filename first, from the end, then the
+ * directory. The directory's path is matched as one string, which is the
+ * same as matching each name and separator in turn as match_dir() does.
+ * Positions are relative to the start of the path as packed, which starts
+ * 'skip' bytes into 'dirname', or to the filename if 'dirname' isn't
+ * packed; matches outside it are UINT32_MAX. */
+static void match_positions(const struct candidate_list *list, const char *dirname, size_t skip,
+		bool dir_packed, const char *filename, uint32_t *positions)
+{
+	const char *needle = list->needle, *needle_alt = list->needle + list->needle_len;
+	int idx_needle = list->needle_len - 1;
+	int filename_len = strlen(filename), dirname_len = strlen(dirname);
+	size_t filename_start = dir_packed ? dirname_len - skip + 1 : 0;
+
+	for (int idx_hay = filename_len - 1; idx_hay >= 0 && idx_needle >= 0; idx_hay--) {
+		if (char_matches(filename[idx_hay], idx_needle, needle, needle_alt))
+			positions[idx_needle--] = filename_start + idx_hay;
+	}
+
+	for (int idx_hay = dirname_len - 1; idx_hay >= 0 && idx_needle >= 0; idx_hay--) {
+		if (char_matches(dirname[idx_hay], idx_needle, needle, needle_alt))
+			positions[idx_needle--] = dir_packed && idx_hay >= (int)skip ? idx_hay - skip : UINT32_MAX;
+	}
+
+	/* Not expected, since the candidate matched */
+	while (idx_needle >= 0)
+		positions[idx_needle--] = UINT32_MAX;
+}
+
+size_t fp_candidates_pack(struct candidate_list *list, char *buf, size_t size, int flags)
+{
+	/* Write the candidates to 'buf' in one go: the number of them (uint32),
+	 * the goodness of each (int32), the offset of each path from the start
+	 * of 'buf' (uint32), then the paths, each nul terminated. With
+	 * FP_PACK_RELATIVE, paths don't start with "./". With
+	 * FP_PACK_POSITIONS, the offsets are followed by the length of the
+	 * search term (uint32), then for each candidate, the byte offset in its
+	 * path of each character of the search term (uint32), or UINT32_MAX for
+	 * a character matched in a part of the path which was left off. Returns
+	 * the size needed, which is more than 'size' if it didn't fit. */
+	uint32_t count = list->num_candidates;
+	uint32_t needle_len = (flags & FP_PACK_POSITIONS) ? list->needle_len : 0;
+	size_t needed = sizeof(uint32_t) + count * (sizeof(int32_t) + sizeof(uint32_t));
+	size_t positions_pos = needed + sizeof(uint32_t);
+	size_t pos;
+
+	if (flags & FP_PACK_POSITIONS)
+		needed = positions_pos + count * needle_len * sizeof(uint32_t);
+	pos = needed;
+
+	for (uint32_t i = 0; i < count; i++) {
+		const char *dirname = list->candidates[i].dirname;
+
+		if (flags & FP_PACK_RELATIVE)
+			dirname = dirname[1] ? dirname + 2 : "";
+		needed += strlen(dirname) + (dirname[0] ? 1 : 0) + strlen(list->candidates[i].filename) + 1;
+	}
+	if (needed > size)
+		return needed;
+
+	memcpy(buf, &count, sizeof count);
+	if (flags & FP_PACK_POSITIONS)
+		memcpy(buf + positions_pos - sizeof(uint32_t), &needle_len, sizeof needle_len);
+	for (uint32_t i = 0; i < count; i++) {
+		struct candidate *candidate = &list->candidates[i];
+		const char *dirname = candidate->dirname;
+		int32_t goodness = candidate->goodness;
+		uint32_t offset = pos;
+		size_t len;
+
+		memcpy(buf + sizeof(uint32_t) + i * sizeof(int32_t), &goodness, sizeof goodness);
+		memcpy(buf + sizeof(uint32_t) + count * sizeof(int32_t) + i * sizeof(uint32_t), &offset, sizeof offset);
+
+		if (flags & FP_PACK_RELATIVE)
+			dirname = dirname[1] ? dirname + 2 : "";
+		if (needle_len) {
+			uint32_t positions[needle_len];
+
+			match_positions(list, candidate->dirname, dirname - candidate->dirname, dirname[0] != '\0',
+					candidate->filename, positions);
+			memcpy(buf + positions_pos + i * needle_len * sizeof(uint32_t), positions, sizeof positions);
+		}
+		len = strlen(dirname);
+		if (len) {
+			memcpy(buf + pos, dirname, len);
+			buf[pos + len] = '/';
+			pos += len + 1;
+		}
+		len = strlen(candidate->filename) + 1;
+		memcpy(buf + pos, candidate->filename, len);
+		pos += len;
+	}
+
+	return needed;
+}
+
+static inline bool search_cancelled(struct search *search)
+{
+	return __atomic_load_n(&search->cancel_generation, __ATOMIC_RELAXED) != search->generation;
+}
+
+static void survivors_grow(struct survivors *survivors)
+{
+	size_t new_max = survivors->max ? survivors->max * 2 : 1024;
+	uint32_t *new_offsets = realloc(survivors->offsets, new_max * sizeof(uint32_t));
+
+	if (!new_offsets) {
+		survivors->failed = true;
+		return;
+	}
+
+	survivors->offsets = new_offsets;
+	survivors->max = new_max;
+}
+
+static inline void survivors_add(struct survivors *survivors, uint32_t offset)
+{
+	if (survivors->count == survivors->max) {
+		survivors_grow(survivors);
+		if (survivors->failed)
+			return;
+	}
+
+	survivors->offsets[survivors->count++] = offset;
+}
+
+static void survivors_free(struct survivors *survivors)
+{
+	free(survivors->offsets);
+	memset(survivors, 0, sizeof *survivors);
+}
+
+static inline uint32_t boost_slot(uint32_t offset)
+{
+	return offset * 2654435761u;
+}
+
+static inline bool boost_dir(const struct boosts *boosts, uint32_t offset)
+{
+	offset ++;
+	for (uint32_t slot = boost_slot(offset) & boosts->mask; boosts->dirs[slot]; slot = (slot + 1) & boosts->mask) {
+		if (boosts->dirs[slot] == offset)
+			return true;
+	}
+	return false;
+}
+
+static inline int boost_get(const struct boosts *boosts, uint32_t offset)
+{
+	for (uint32_t slot = boost_slot(offset) & boosts->mask; boosts->offsets[slot]; slot = (slot + 1) & boosts->mask) {
+		if (boosts->offsets[slot] == offset)
+			return boosts->offset_values[slot];
+	}
+	return 0;
+}
+
+/* Hash table of strings, for finding the boosted paths. Slots hold an index
+ * into 'keys' plus one, or 0 if unused. */
+static int path_table_find(const int *table, uint32_t mask, char **keys, const char *key)
+{
+	for (uint32_t slot = hash_string(key) & mask; table[slot]; slot = (slot + 1) & mask) {
+		if (strcmp(keys[table[slot] - 1], key) == 0)
+			return table[slot] - 1;
+	}
+	return -1;
+}
+
+static void path_table_add(int *table, uint32_t mask, char **keys, int idx)
+{
+	uint32_t slot;
+
+	if (path_table_find(table, mask, keys, keys[idx]) >= 0)
+		return;
+	for (slot = hash_string(keys[idx]) & mask; table[slot]; slot = (slot + 1) & mask)
+		;
+	table[slot] = idx + 1;
+}
+
+/* Find the record of each boosted file in the pool. Only the files in
+ * directories with boosted files are looked at. */
+static bool boosts_resolve(struct filepirate *fp)
+{
+	struct boosts *boosts = &fp->boosts;
+	uint32_t size = 16;
+	int *by_path, *by_dir;
+	char **dirs;
+	bool ok = false;
+
+	boosts->resolved = false;
+	while (size < (uint32_t)boosts->count * 2)
+		size *= 2;
+
+	by_path = calloc(size, sizeof(int));
+	by_dir = calloc(size, sizeof(int));
+	dirs = calloc(boosts->count, sizeof(char *));
+	if (!by_path || !by_dir || !dirs)
+		goto out;
+
+	for (int i = 0; i < boosts->count; i++) {
+		char *slash = strrchr(boosts->paths[i], '/');
+
+		dirs[i] = slash ? strndup(boosts->paths[i], slash - boosts->paths[i]) : strdup("");
+		if (!dirs[i])
+			goto out;
+		path_table_add(by_path, size - 1, boosts->paths, i);
+		path_table_add(by_dir, size - 1, dirs, i);
+	}
+
+	memset(boosts->offsets, 0, (boosts->mask + 1) * sizeof(uint32_t));
+	memset(boosts->dirs, 0, (boosts->mask + 1) * sizeof(uint32_t));
+	for (uint8_t *files = fp->files; files < fp->files_end; ) {
+		char path[PATH_MAX];
+		unsigned int len, dir_len = dir_path_len(files);
+		uint32_t dir_offset = files - fp->files + 1;
+		bool wanted = false, found = false;
+
+		if (dir_len < sizeof path) {
+			dir_path(files, path);
+			wanted = path_table_find(by_dir, size - 1, dirs, path) >= 0;
+			path[dir_len] = '/';
+		}
+
+		files += DIR_HEADER_SIZE + *(unsigned int *)files;
+		for (; (len = *(unsigned int *)files) != 0; files += DIRENT_HEADER_SIZE + (len & ~FP_DELETED)) {
+			uint32_t offset = files - fp->files, slot;
+			int idx;
+
+			if (!wanted || (len & FP_DELETED) || dir_len + len >= sizeof path)
+				continue;
+			memcpy(path + dir_len + 1, files + DIRENT_HEADER_SIZE, len);
+			idx = path_table_find(by_path, size - 1, boosts->paths, path);
+			if (idx < 0)
+				continue;
+
+			for (slot = boost_slot(offset) & boosts->mask; boosts->offsets[slot]; slot = (slot + 1) & boosts->mask)
+				;
+			boosts->offsets[slot] = offset;
+			boosts->offset_values[slot] = boosts->values[idx];
+
+			if (!found) {
+				for (slot = boost_slot(dir_offset) & boosts->mask; boosts->dirs[slot]; slot = (slot + 1) & boosts->mask)
+					;
+				boosts->dirs[slot] = dir_offset;
+				found = true;
+			}
+		}
+		files += DIRENT_TERMINATOR_SIZE;
+	}
+
+	boosts->pool_generation = fp->pool_generation;
+	boosts->resolved = true;
+	ok = true;
+
+out:
+	if (dirs) {
+		for (int i = 0; i < boosts->count; i++)
+			free(dirs[i]);
+	}
+	free(dirs);
+	free(by_dir);
+	free(by_path);
+	return ok;
+}
+
+static void boosts_clear(struct boosts *boosts)
+{
+	for (int i = 0; i < boosts->count; i++)
+		free(boosts->paths[i]);
+	free(boosts->paths);
+	free(boosts->values);
+	free(boosts->offsets);
+	free(boosts->offset_values);
+	free(boosts->dirs);
+	memset(boosts, 0, sizeof *boosts);
+}
+
+static void partition_publish(struct search *search, struct partition *partition, struct candidate_list *candidates)
+{
+	pthread_mutex_lock(&search->progress_lock);
+	memcpy(partition->published->candidates, candidates->candidates, candidates->num_candidates * sizeof(struct candidate));
+	partition->published->num_candidates = candidates->num_candidates;
+	pthread_mutex_unlock(&search->progress_lock);
+}
+
+/* Publish the partition's candidates if it's time. Returns when to next. */
+static uint64_t partition_publish_due(struct search *search, struct partition *partition,
+		struct candidate_list *candidates, uint64_t publish_ns)
+{
+	uint64_t now = now_ns();
+
+	if (now < publish_ns)
+		return publish_ns;
+	partition_publish(search, partition, candidates);
+	return now + search->progress_ns;
+}
+
+/* Scan part of the pool. Returns the number of bytes scanned, which is less
+ * than the size of the range if the search was cancelled. 'fold' is whether
+ * search->needle_alt is set; it is passed as a constant (see scan_partition())
+ * so that exact matching has a loop of its own. */
+static inline __attribute__((always_inline)) uintptr_t scan_range(struct search *search, struct partition *partition, uint8_t *start, uint8_t *end,
+		struct candidate_list *candidates, struct survivors *survivors, bool fold)
+{
+	char *files = (char *)start;
+	bool new_directory = true; // Was a new directory entered?
+	bool dir_recorded = false; // Has this directory been added to the survivors?
+	bool dir_boosted = false;  // Does this directory entry have boosted files?
+	unsigned int path_len = 0, filename_len;
+	char *dir_record = NULL;
+	charmask_t missing = 0;    // Characters of the needle not in the directory name
+	char *buffer = search->needle;
+	const char *buffer_alt = fold ? search->needle_alt : NULL;
+	int buffer_ptr = search->needle_len;
+	int countdown = CANCEL_CHECK_INTERVAL;
+	uint64_t checked = 0, rejected = 0, matched = 0;
+	uint64_t publish_ns = search->progress_ns ? now_ns() + search->progress_ns : 0;
+	int dir_memo[buffer_ptr + 1];
+
+	while (files < (char *)end) {
+		if (--countdown == 0) {
+			if (search_cancelled(search))
+				break;
+			if (publish_ns)
+				publish_ns = partition_publish_due(search, partition, candidates, publish_ns);
+			countdown = CANCEL_CHECK_INTERVAL;
+		}
+
+		if (new_directory) {
+			dir_record = files;
+			path_len = dir_path_len((uint8_t *)files);
+			missing = search->needle_mask & ~record_mask((uint8_t *)files, fold);
+			dir_boosted = search->boosts && boost_dir(search->boosts, files - (char *)search->files);
+			files += DIR_HEADER_SIZE + *(unsigned int *)files;
+			for (int i = 0; i < buffer_ptr; i++)
+				dir_memo[i] = DIR_MEMO_UNKNOWN;
+			new_directory = false;
+			dir_recorded = false;
+		}
+
+		filename_len = *(unsigned int *)files;
+		if (filename_len == 0) {
+			// End of this directory 
+			files += DIRENT_TERMINATOR_SIZE;
+			new_directory = true;
+		} else if (filename_len & FP_DELETED) {
+			files += DIRENT_HEADER_SIZE + (filename_len & ~FP_DELETED);
+		} else {
+			char *record = files;
+			int goodness;
+
+			files += DIRENT_HEADER_SIZE;
+			checked ++;
+			if (missing & ~record_mask((uint8_t *)record, fold)) {
+				rejected ++;
+			} else if (fp_strstr((uint8_t *)dir_record, path_len, dir_memo, filename_len - 1, files, buffer_ptr - 1, buffer, buffer_alt, search->simd, &goodness) == true) {
+				if (dir_boosted)
+					goodness += boost_get(search->boosts, record - (char *)search->files);
+				matched ++;
+				candidate_list_add(candidates, (uint8_t *)dir_record, files, path_len + filename_len - 1, goodness);
+				if (survivors) {
+					if (!dir_recorded) {
+						survivors_add(survivors, (dir_record - (char *)search->files) | SURVIVOR_DIR);
+						dir_recorded = true;
+					}
+					survivors_add(survivors, record - (char *)search->files);
+				}
+			}
+			files += filename_len;
+		}
+	}
+
+	__atomic_add_fetch(&search->checked, checked, __ATOMIC_RELAXED);
+	__atomic_add_fetch(&search->rejected, rejected, __ATOMIC_RELAXED);
+	__atomic_add_fetch(&search->matched, matched, __ATOMIC_RELAXED);
+	__atomic_add_fetch(&search->bytes, (uint8_t *)files - start, __ATOMIC_RELAXED);
+	return (uint8_t *)files - start;
+}
+
+/* As scan_range(), but scan only the survivors of a previous search. Returns
+ * the number of survivors scanned. */
+static inline __attribute__((always_inline)) uintptr_t scan_survivors(struct search *search, struct partition *partition, uint32_t *source, uint32_t *source_end,
+		struct candidate_list *candidates, struct survivors *survivors, bool fold)
+{
+	uint32_t *survivor;
+	bool dir_recorded = false, dir_boosted = false;
+	unsigned int path_len = 0, filename_len;
+	uint32_t dir_offset = 0;
+	uint8_t *dir = NULL;
+	charmask_t missing = 0;
+	char *buffer = search->needle;
+	const char *buffer_alt = fold ? search->needle_alt : NULL;
+	int buffer_ptr = search->needle_len;
+	int countdown = CANCEL_CHECK_INTERVAL;
+	uint64_t checked = 0, rejected = 0, matched = 0, bytes = 0;
+	uint64_t publish_ns = search->progress_ns ? now_ns() + search->progress_ns : 0;
+	int dir_memo[buffer_ptr + 1];
+
+	for (survivor = source; survivor < source_end; survivor++) {
+		char *record;
+
+		if (--countdown == 0) {
+			if (search_cancelled(search))
+				break;
+			if (publish_ns)
+				publish_ns = partition_publish_due(search, partition, candidates, publish_ns);
+			countdown = CANCEL_CHECK_INTERVAL;
+		}
+
+		if (*survivor & SURVIVOR_DIR) {
+			dir_offset = *survivor;
+			dir = search->files + (dir_offset & ~SURVIVOR_DIR);
+			path_len = dir_path_len(dir);
+			missing = search->needle_mask & ~record_mask(dir, fold);
+			dir_boosted = search->boosts && boost_dir(search->boosts, dir_offset & ~SURVIVOR_DIR);
+			for (int i = 0; i < buffer_ptr; i++)
+				dir_memo[i] = DIR_MEMO_UNKNOWN;
+			dir_recorded = false;
+			continue;
+		}
+
+		record = (char *)search->files + *survivor;
+		filename_len = *(unsigned int *)record;
+		if (filename_len & FP_DELETED)
+			continue;
+
+		int goodness;
+		checked ++;
+		bytes += DIRENT_HEADER_SIZE + filename_len;
+		if (missing & ~record_mask((uint8_t *)record, fold)) {
+			rejected ++;
+		} else if (fp_strstr(dir, path_len, dir_memo, filename_len - 1, record + DIRENT_HEADER_SIZE, buffer_ptr - 1, buffer, buffer_alt, search->simd, &goodness) == true) {
+			if (dir_boosted)
+				goodness += boost_get(search->boosts, *survivor);
+			matched ++;
+			candidate_list_add(candidates, dir, record + DIRENT_HEADER_SIZE, path_len + filename_len - 1, goodness);
+			if (survivors) {
+				if (!dir_recorded) {
+					survivors_add(survivors, dir_offset);
+					dir_recorded = true;
+				}
+				survivors_add(survivors, *survivor);
+			}
+		}
+	}
+
+	bytes += (survivor - source) * sizeof *survivor;
+	__atomic_add_fetch(&search->checked, checked, __ATOMIC_RELAXED);
+	__atomic_add_fetch(&search->rejected, rejected, __ATOMIC_RELAXED);
+	__atomic_add_fetch(&search->matched, matched, __ATOMIC_RELAXED);
+	__atomic_add_fetch(&search->bytes, bytes, __ATOMIC_RELAXED);
+	return survivor - source;
+}
+
+static void scan_partition(struct search *search, struct partition *partition, struct candidate_list *candidates)
+{
+	struct survivors *survivors = search->record ? &partition->survivors : NULL;
+	uintptr_t scanned;
+
+	partition->survivors.count = 0;
+	partition->survivors.failed = false;
+
+	if (search->narrowing && search->needle_alt)
+		scanned = scan_survivors(search, partition, partition->source, partition->source_end, candidates, survivors, true);
+	else if (search->narrowing)
+		scanned = scan_survivors(search, partition, partition->source, partition->source_end, candidates, survivors, false);
+	else if (search->needle_alt)
+		scanned = scan_range(search, partition, partition->start, partition->end, candidates, survivors, true);
+	else
+		scanned = scan_range(search, partition, partition->start, partition->end, candidates, survivors, false);
+
+	if (search->progress_ns)
+		partition_publish(search, partition, candidates);
+	__atomic_add_fetch(&search->scanned, scanned, __ATOMIC_RELAXED);
+}
+
+/* Claim and scan partitions until there are none left */
+static void search_work(struct search *search)
+{
+	int idx;
+
+	while ((idx = __atomic_fetch_add(&search->next_partition, 1, __ATOMIC_RELAXED)) < search->active_partitions) {
+		struct partition *partition = &search->partitions[idx];
+
+		if (search_cancelled(search))
+			break;
+
+		candidate_list_reset(partition->candidates);
+		scan_partition(search, partition, partition->candidates);
+	}
+}
+
+static void search_free_partitions(struct search *search)
+{
+	for (int i = 0; i < search->num_partitions; i++) {
+		if (search->partitions[i].candidates)
+			fp_candidate_list_destroy(search->partitions[i].candidates);
+		if (search->partitions[i].published)
+			fp_candidate_list_destroy(search->partitions[i].published);
+		survivors_free(&search->partitions[i].survivors);
+	}
+	if (search->progress)
+		fp_candidate_list_destroy(search->progress);
+	search->progress = NULL;
+	free(search->partitions);
+	search->partitions = NULL;
+	search->num_partitions = 0;
+	search->files = search->files_end = NULL;
+}
+
+/* (Re)divide the pool into partitions if it, or the number of threads, has changed */
+static bool search_partition(struct filepirate *fp, int max_candidates)
+{
+	struct search *search = &fp->search;
+	int threads = fp->workers.num_threads + 1;
+	int max_partitions = threads == 1 ? 1 : threads * PARTITIONS_PER_THREAD;
+	size_t pool_size = fp->files_end - fp->files;
+	size_t target;
+	uint8_t *files, *start;
+
+	if (pool_size / PARTITION_MIN_SIZE + 1 < max_partitions)
+		max_partitions = pool_size / PARTITION_MIN_SIZE + 1;
+
+	if (search->files == fp->files && search->files_end == fp->files_end
+			&& search->max_candidates == max_candidates && search->threads == threads)
+		return true;
+
+	search_free_partitions(search);
+	search->partitions = calloc(max_partitions, sizeof(struct partition));
+	if (!search->partitions)
+		return false;
+
+	/* Walk the directory entries, starting a new partition whenever the current one is big enough */
+	target = pool_size / max_partitions;
+	files = start = fp->files;
+	while (files < fp->files_end) {
+		unsigned int len;
+
+		if (files - start >= target && search->num_partitions < max_partitions - 1) {
+			search->partitions[search->num_partitions].start = start;
+			search->partitions[search->num_partitions].end = files;
+			search->num_partitions ++;
+			start = files;
+		}
+
+		files += DIR_HEADER_SIZE + *(unsigned int *)files;
+		while ((len = *(unsigned int *)files) != 0)
+			files += DIRENT_HEADER_SIZE + (len & ~FP_DELETED);
+		files += DIRENT_TERMINATOR_SIZE;
+	}
+	search->partitions[search->num_partitions].start = start;
+	search->partitions[search->num_partitions].end = fp->files_end;
+	search->num_partitions ++;
+
+	for (int i = 0; i < search->num_partitions; i++) {
+		search->partitions[i].candidates = fp_candidate_list_create(max_candidates);
+		search->partitions[i].published = fp_candidate_list_create(max_candidates);
+		if (!search->partitions[i].candidates || !search->partitions[i].published) {
+			search_free_partitions(search);
+			return false;
+		}
+	}
+	search->progress = fp_candidate_list_create(max_candidates);
+	if (!search->progress) {
+		search_free_partitions(search);
+		return false;
+	}
+
+	search->files = fp->files;
+	search->files_end = fp->files_end;
+	search->max_candidates = max_candidates;
+	search->threads = threads;
+
+	return true;
+}
+
+/* Divide the survivors being narrowed among the partitions, starting each at a directory */
+static void search_partition_survivors(struct search *search)
+{
+	struct survivors *source = &search->narrowing->survivors;
+	uint32_t *begin = source->offsets, *end = source->offsets + source->count;
+	size_t target;
+
+	search->active_partitions = search->num_partitions;
+	if (source->count < SURVIVORS_PARTITION_MIN * search->active_partitions)
+		search->active_partitions = source->count / SURVIVORS_PARTITION_MIN + 1;
+	target = source->count / search->active_partitions;
+
+	for (int i = 0; i < search->active_partitions; i++) {
+		uint32_t *partition_end = end;
+
+		if (i < search->active_partitions - 1) {
+			partition_end = begin + target < end ? begin + target : end;
+			while (partition_end < end && !(*partition_end & SURVIVOR_DIR))
+				partition_end ++;
+		}
+
+		search->partitions[i].source = begin;
+		search->partitions[i].source_end = partition_end;
+		begin = partition_end;
+	}
+}
+
+static void narrow_pop(struct narrow *narrow)
+{
+	struct narrow_entry *entry = &narrow->entries[--narrow->depth];
+
+	free(entry->query);
+	survivors_free(&entry->survivors);
+}
+
+static void narrow_clear(struct narrow *narrow)
+{
+	while (narrow->depth > 0)
+		narrow_pop(narrow);
+}
+
+/* Find the survivors of the longest earlier query that 'query' starts with,
+ * discarding any that don't apply. */
+static struct narrow_entry *narrow_find(struct filepirate *fp, char *query, int query_len)
+{
+	struct narrow *narrow = &fp->narrow;
+
+	if (narrow->pool_generation != fp->pool_generation) {
+		narrow_clear(narrow);
+		narrow->pool_generation = fp->pool_generation;
+	}
+
+	while (narrow->depth > 0) {
+		struct narrow_entry *entry = &narrow->entries[narrow->depth - 1];
+
+		if (entry->query_len <= query_len && memcmp(entry->query, query, entry->query_len) == 0)
+			return entry;
+
+		narrow_pop(narrow);
+	}
+
+	return NULL;
+}
+
+/* Push the survivors of a completed search */
+static void narrow_push(struct narrow *narrow, struct search *search)
+{
+	struct narrow_entry *entry = &narrow->entries[narrow->depth];
+	size_t count = 0;
+
+	for (int i = 0; i < search->active_partitions; i++) {
+		if (search->partitions[i].survivors.failed)
+			return;
+		count += search->partitions[i].survivors.count;
+	}
+
+	memset(entry, 0, sizeof *entry);
+	entry->query = malloc(search->needle_len);
+	if (!entry->query)
+		return;
+	memcpy(entry->query, search->needle, search->needle_len);
+	entry->query_len = search->needle_len;
+
+	if (search->active_partitions == 1) {
+		/* Just take the partition's list */
+		entry->survivors = search->partitions[0].survivors;
+		memset(&search->partitions[0].survivors, 0, sizeof(struct survivors));
+	} else {
+		entry->survivors.offsets = malloc(count * sizeof(uint32_t) + 1);
+		if (!entry->survivors.offsets) {
+			free(entry->query);
+			return;
+		}
+		for (int i = 0; i < search->active_partitions; i++) {
+			struct survivors *survivors = &search->partitions[i].survivors;
+
+			memcpy(entry->survivors.offsets + entry->survivors.count, survivors->offsets, survivors->count * sizeof(uint32_t));
+			entry->survivors.count += survivors->count;
+		}
+		entry->survivors.max = count;
+	}
+
+	narrow->depth ++;
+}
+
+static void *worker_main(void *arg)
+{
+	struct filepirate *fp = arg;
+	struct worker_pool *workers = &fp->workers;
+	unsigned int generation = 0;
+
+	pthread_mutex_lock(&workers->lock);
+	while (true) {
+		while (!workers->quit && workers->generation == generation)
+			pthread_cond_wait(&workers->start, &workers->lock);
+
+		if (workers->quit)
+			break;
+
+		generation = workers->generation;
+		pthread_mutex_unlock(&workers->lock);
+
+		search_work(&fp->search);
+
+		pthread_mutex_lock(&workers->lock);
+		if (--workers->busy == 0)
+			pthread_cond_signal(&workers->done);
+	}
+	pthread_mutex_unlock(&workers->lock);
+
+	return NULL;
+}
+
+static void workers_stop(struct worker_pool *workers)
+{
+	if (workers->threads == NULL)
+		return;
+
+	pthread_mutex_lock(&workers->lock);
+	workers->quit = true;
+	pthread_cond_broadcast(&workers->start);
+	pthread_mutex_unlock(&workers->lock);
+
+	for (int i = 0; i < workers->num_threads; i++)
+		pthread_join(workers->threads[i], NULL);
+
+	pthread_cond_destroy(&workers->done);
+	pthread_cond_destroy(&workers->start);
+	pthread_mutex_destroy(&workers->lock);
+	free(workers->threads);
+	memset(workers, 0, sizeof *workers);
+}
+
+bool fp_set_threads(struct filepirate *fp, int threads)
+{
+	/* Search using 'threads' threads, including the caller of
+	 * fp_get_candidates(). The tree is walked with as many. */
+	struct worker_pool *workers = &fp->workers;
+
+	fp->walk_threads = threads > 1 ? threads : 1;
+	workers_stop(workers);
+	if (threads <= 1)
+		return true;
+
+	workers->threads = calloc(threads - 1, sizeof(pthread_t));
+	if (!workers->threads)
+		return false;
+
+	pthread_mutex_init(&workers->lock, NULL);
+	pthread_cond_init(&workers->start, NULL);
+	pthread_cond_init(&workers->done, NULL);
+
+	for (int i = 0; i < threads - 1; i++) {
+		if (pthread_create(&workers->threads[i], NULL, worker_main, fp)) {
+			ERROR("pthread_create: %s\n", strerror(errno));
+			break;
+		}
+		workers->num_threads ++;
+	}
+
+	return workers->num_threads == threads - 1;
+}
+
+void fp_set_walk_threads(struct filepirate *fp, int threads)
+{
+	/* Walk the tree with 'threads' threads, or with fts if 0. Call after
+	 * fp_set_threads(), which sets this too. */
+	fp->walk_threads = threads < 0 ? 0 : threads;
+}
+
+void fp_set_git(struct filepirate *fp, int git)
+{
+	/* List the files of a git work tree from its index (FP_GIT_TRACKED), and
+	 * maybe git ls-files (FP_GIT_UNTRACKED), instead of walking it. Other
+	 * roots are walked as usual. Call before fp_init_dir(). */
+	fp->git = git;
+}
+
+void fp_cancel(struct filepirate *fp)
+{
+	/* Abandon the search in progress, if any. Safe to call from any thread. */
+	__atomic_add_fetch(&fp->search.cancel_generation, 1, __ATOMIC_RELAXED);
+}
+
+void fp_set_prefilter(struct filepirate *fp, bool enable)
+{
+	/* The character mask prefilter is on by default. Turning it off is only
+	 * useful for benchmarking. */
+	fp->prefilter = enable;
+}
+
+bool fp_set_boosts(struct filepirate *fp, char **paths, int *values, int count)
+{
+	/* Add values[i] to the goodness of the file at paths[i] (like
+	 * "./a/b/name") whenever it matches, replacing any earlier boosts.
+	 * Files which aren't in the index are ignored. */
+	struct boosts *boosts = &fp->boosts;
+	uint32_t size = 16;
+
+	boosts_clear(boosts);
+	if (count <= 0)
+		return true;
+
+	while (size < (uint32_t)count * 2)
+		size *= 2;
+	boosts->paths = calloc(count, sizeof(char *));
+	boosts->values = malloc(count * sizeof(int));
+	boosts->offsets = calloc(size, sizeof(uint32_t));
+	boosts->offset_values = malloc(size * sizeof(int));
+	boosts->dirs = calloc(size, sizeof(uint32_t));
+	if (!boosts->paths || !boosts->values || !boosts->offsets || !boosts->offset_values || !boosts->dirs)
+		goto fail;
+	boosts->mask = size - 1;
+
+	for (boosts->count = 0; boosts->count < count; boosts->count++) {
+		boosts->paths[boosts->count] = strdup(paths[boosts->count]);
+		if (!boosts->paths[boosts->count])
+			goto fail;
+		boosts->values[boosts->count] = values[boosts->count];
+	}
+
+	return true;
+
+fail:
+	ERROR("fp_set_boosts: out of memory\n");
+	boosts_clear(boosts);
+	return false;
+}
+
+/* Start or stop letting fp_get_progress() read the published lists. They are
+ * emptied at the start, so that an earlier search's aren't read. */
+static void search_set_publishing(struct search *search, bool publishing)
+{
+	pthread_mutex_lock(&search->progress_lock);
+	if (publishing) {
+		for (int i = 0; i < search->num_partitions; i++)
+			search->partitions[i].published->num_candidates = 0;
+	}
+	search->publishing = publishing;
+	pthread_mutex_unlock(&search->progress_lock);
+}
+
+void fp_set_progress(struct filepirate *fp, unsigned int interval_ms)
+{
+	/* Publish the best candidates found so far every 'interval_ms' while
+	 * searching, for fp_get_progress(). 0, the default, turns it off. Don't
+	 * call while searching. */
+	fp->search.progress_ns = (uint64_t)interval_ms * 1000000;
+}
+
+size_t fp_get_progress(struct filepirate *fp, char *buf, size_t size, int flags)
+{
+	/* Pack the best candidates published so far by the search in progress
+	 * into 'buf', as fp_candidates_pack() does. Returns 0 if there's no
+	 * search in progress, or it hasn't found anything yet. May be called
+	 * from another thread while fp_get_candidates() runs. */
+	struct search *search = &fp->search;
+	size_t needed = 0;
+
+	pthread_mutex_lock(&search->progress_lock);
+	if (search->publishing) {
+		candidate_list_reset(search->progress);
+		for (int i = 0; i < search->num_partitions; i++) {
+			struct candidate_list *list = search->partitions[i].published;
+
+			for (int j = 0; j < list->num_candidates; j++) {
+				struct candidate *iter = &list->candidates[j];
+				candidate_list_add(search->progress, iter->dir, iter->filename, iter->path_len, iter->goodness);
+			}
+		}
+		/* Packed while the lock keeps the search, and so the pool, from finishing */
+		if (search->progress->num_candidates > 0 && candidate_list_finish(search->progress)
+				&& candidate_list_set_needle(search->progress, search->needle, search->needle_alt, search->needle_len))
+			needed = fp_candidates_pack(search->progress, buf, size, flags);
+	}
+	pthread_mutex_unlock(&search->progress_lock);
+
+	return needed;
+}
+
+static bool has_upper(const char *s, int len)
+{
+	for (int i = 0; i < len; i++) {
+		if (s[i] >= 'A' && s[i] <= 'Z')
+			return true;
+	}
+	return false;
+}
+
+/* Fill 'alt' with the other case of each character of 'needle' (or the
+ * character itself, if it has none), and 'lower' with its lower case. */
+static void needle_cases(const char *needle, int len, char *alt, char *lower)
+{
+	for (int i = 0; i < len; i++) {
+		char c = needle[i];
+
+		if (c >= 'a' && c <= 'z') {
+			alt[i] = c - 'a' + 'A';
+			lower[i] = c;
+		} else if (c >= 'A' && c <= 'Z') {
+			alt[i] = lower[i] = c - 'A' + 'a';
+		} else {
+			alt[i] = lower[i] = c;
+		}
+	}
+}
+
+bool fp_set_simd(struct filepirate *fp, bool enable)
+{
+	/* Vector compares are used to match names, where available, by default.
+	 * Turning them off is only useful for benchmarking and testing. Returns
+	 * false if they aren't available. */
+	fp->simd = enable && FP_HAVE_SIMD;
+	return fp->simd == enable;
+}
+
+void fp_set_case(struct filepirate *fp, int case_mode)
+{
+	/* How to match letters (see FP_CASE_EXACT and so on). The default is
+	 * FP_CASE_EXACT. */
+	if (case_mode != fp->case_mode) {
+		/* Survivors of a case sensitive search don't include everything an
+		 * insensitive one would match */
+		narrow_clear(&fp->narrow);
+		fp->case_mode = case_mode;
+	}
+}
+
+/* Returns false if the search failed or was cancelled */
+bool fp_get_candidates(struct filepirate *fp, char *buffer, int buffer_ptr, struct candidate_list *candidates)
+{
+	struct search *search = &fp->search;
+	struct worker_pool *workers = &fp->workers;
+	uint64_t start_ns, scan_ns, merge_ns, total;
+	char needle_alt[buffer_ptr + 1], needle_lower[buffer_ptr + 1];
+	bool fold = fp->case_mode == FP_CASE_IGNORE || (fp->case_mode == FP_CASE_SMART && !has_upper(buffer, buffer_ptr));
+
+	/* A cancellation issued before this point is for an earlier search */
+	search->generation = __atomic_load_n(&search->cancel_generation, __ATOMIC_RELAXED);
+	start_ns = now_ns();
+
+	candidate_list_reset(candidates);
+
+	if (!search_partition(fp, candidates->max_candidates))
+		return false;
+
+	search->needle = buffer;
+	search->needle_len = buffer_ptr;
+	search->simd = fp->simd;
+	if (fold) {
+		needle_cases(buffer, buffer_ptr, needle_alt, needle_lower);
+		search->needle_alt = needle_alt;
+		search->needle_mask = fp->prefilter ? charmask(needle_lower, buffer_ptr) : 0;
+	} else {
+		search->needle_alt = NULL;
+		search->needle_mask = fp->prefilter ? charmask(buffer, buffer_ptr) : 0;
+	}
+	search->scanned = search->checked = search->rejected = search->matched = search->bytes = 0;
+	search->narrowing = narrow_find(fp, buffer, buffer_ptr);
+	if (fp->boosts.count && (!fp->boosts.resolved || fp->boosts.pool_generation != fp->pool_generation))
+		boosts_resolve(fp);
+	search->boosts = fp->boosts.resolved ? &fp->boosts : NULL;
+	/* Everything matches the empty query, so there's no point recording it.
+	 * Offsets must fit in 31 bits. */
+	search->record = buffer_ptr > 0 && fp->narrow.depth < NARROW_MAX_DEPTH
+		&& (search->narrowing == NULL || search->narrowing->query_len < buffer_ptr)
+		&& fp->files_end - fp->files < SURVIVOR_DIR;
+
+	if (search->narrowing) {
+		search_partition_survivors(search);
+		total = search->narrowing->survivors.count;
+		fp->stats.searches_narrowed ++;
+	} else {
+		search->active_partitions = search->num_partitions;
+		total = fp->files_end - fp->files;
+	}
+
+	scan_ns = now_ns();
+	if (search->progress_ns)
+		search_set_publishing(search, true);
+
+	if (search->active_partitions == 1) {
+		scan_partition(search, &search->partitions[0], candidates);
+	} else {
+		search->next_partition = 0;
+
+		pthread_mutex_lock(&workers->lock);
+		workers->generation ++;
+		workers->busy = workers->num_threads;
+		pthread_cond_broadcast(&workers->start);
+		pthread_mutex_unlock(&workers->lock);
+
+		search_work(search);
+
+		pthread_mutex_lock(&workers->lock);
+		while (workers->busy > 0)
+			pthread_cond_wait(&workers->done, &workers->lock);
+		pthread_mutex_unlock(&workers->lock);
+	}
+
+	if (search->progress_ns)
+		search_set_publishing(search, false);
+
+	merge_ns = now_ns();
+	fp->stats.searches ++;
+	fp->stats.files_checked += search->checked;
+	fp->stats.files_rejected += search->rejected;
+	fp->stats.files_matched += search->matched;
+	fp->stats.bytes_scanned += search->bytes;
+	fp->stats.scan_ns += merge_ns - scan_ns;
+
+	if (search->scanned < total) {
+		/* Cancelled. Estimate the time saved from the rate we were scanning at. */
+		uint64_t elapsed_ns = merge_ns - start_ns;
+
+		fp->stats.search_ns += elapsed_ns;
+		fp->stats.searches_cancelled ++;
+		if (search->scanned > 0)
+			fp->stats.cancel_ns_saved += (double)elapsed_ns * (total - search->scanned) / search->scanned;
+		candidate_list_reset(candidates);
+		return false;
+	}
+
+	if (search->active_partitions > 1) {
+		/* Merge the partitions. The ranking is a total order, so this gives
+		 * the same result as scanning the whole pool into one list. */
+		for (int i = 0; i < search->active_partitions; i++) {
+			struct candidate_list *list = search->partitions[i].candidates;
+
+			for (int j = 0; j < list->num_candidates; j++) {
+				struct candidate *iter = &list->candidates[j];
+				candidate_list_add(candidates, iter->dir, iter->filename, iter->path_len, iter->goodness);
+			}
+		}
+	}
+
+	if (!candidate_list_finish(candidates) || !candidate_list_set_needle(candidates, buffer, search->needle_alt, buffer_ptr)) {
+		candidate_list_reset(candidates);
+		return false;
+	}
+	fp->stats.topk_ns += now_ns() - merge_ns;
+
+	if (search->record)
+		narrow_push(&fp->narrow, search);
+	fp->stats.search_ns += now_ns() - start_ns;
+
+	return true;
+}
+
+
+struct filepirate *fp_init()
+{
+	struct filepirate *fp;
+
+	fp = calloc(sizeof *fp, 1);
+	if (fp == NULL)
+		return NULL;
+
+	fp->watch.fd = -1;
+	fp->root_fd = -1;
+	fp->prefilter = true;
+	fp->simd = FP_HAVE_SIMD;
+	fp->walk_threads = 1;
+	if (pool_init(&(fp->main_pool), MEM_LIMIT) == false) {
+		free(fp);
+		return NULL;
+	}
+	pthread_mutex_init(&fp->search.progress_lock, NULL);
+
+	return fp;
+}
+
+static void filter_free_tables(struct filter *filter)
+{
+	free(filter->names.slots);
+	free(filter->dir_names.slots);
+	free(filter->suffixes.slots);
+	free(filter->globs);
+	filter->names.slots = filter->dir_names.slots = filter->suffixes.slots = NULL;
+	filter->globs = NULL;
+	filter->num_globs = 0;
+}
+
+static void deinit_filter(struct filter *filter)
+{
+	filter_free_tables(filter);
+	for (int i = 0; i < filter->num_rules; i++)
+		free(filter->rules[i].pattern);
+	free(filter->rules);
+	filter->rules = NULL;
+	filter->num_rules = 0;
+}
+
+bool fp_deinit(struct filepirate *fp)
+{
+	workers_stop(&fp->workers);
+	search_free_partitions(&fp->search);
+	pthread_mutex_destroy(&fp->search.progress_lock);
+	narrow_clear(&fp->narrow);
+	boosts_clear(&fp->boosts);
+	fp_deinit_dir(fp);
+	watch_disable(&fp->watch);
+
+	deinit_filter(&(fp->negative_filter));
+	deinit_filter(&(fp->positive_filter));
+
+	if (pool_free(&fp->main_pool)) {
+		free (fp);
+		return true;
+	}
+
+	return false;
+}
+
+void fp_filter(struct filepirate *fp, char **positive, char **negative)
+{
+	for(char **s = negative; s && *s; s++) {
+		fp_filter_add_negative(fp, *s);
+	}
+
+	for(char **s = positive; s && *s; s++) {
+		fp_filter_add_positive(fp, *s);
+	}
+}
+
+static void filter_table_set(struct filter_table *table, const char *key, int rule)
+{
+	uint32_t slot = hash_string(key) & table->mask;
+
+	while (table->slots[slot].key && strcmp(table->slots[slot].key, key) != 0)
+		slot = (slot + 1) & table->mask;
+	table->slots[slot] = (struct filter_slot){key, rule};
+}
+
+/* Sort the rules into the lookup tables and the list of globs. */
+static bool filter_compile(struct filter *filter)
+{
+	uint32_t size = 8;
+
+	filter_free_tables(filter);
+	while (size < (uint32_t)filter->num_rules * 2)
+		size *= 2;
+
+	filter->names.slots = calloc(size, sizeof(struct filter_slot));
+	filter->dir_names.slots = calloc(size, sizeof(struct filter_slot));
+	filter->suffixes.slots = calloc(size, sizeof(struct filter_slot));
+	filter->globs = malloc(filter->num_rules * sizeof(int));
+	if (!filter->names.slots || !filter->dir_names.slots || !filter->suffixes.slots || !filter->globs) {
+		filter_free_tables(filter);
+		return false;
+	}
+	filter->names.mask = filter->dir_names.mask = filter->suffixes.mask = size - 1;
+	filter->anchored = false;
+
+	for (int i = 0; i < filter->num_rules; i++) {
+		struct filter_rule *rule = &filter->rules[i];
+		char *pattern = rule->pattern;
+		bool plain = !rule->negate && !rule->anchored;
+
+		if (plain && !strpbrk(pattern, "*?[\\")) {
+			filter_table_set(rule->dir_only ? &filter->dir_names : &filter->names, pattern, i);
+		} else if (plain && !rule->dir_only && pattern[0] == '*' && pattern[1] == '.'
+				&& !strpbrk(pattern + 1, "*?[\\") && !strchr(pattern + 2, '.')) {
+			filter_table_set(&filter->suffixes, pattern + 1, i);
+		} else {
+			filter->globs[filter->num_globs++] = i;
+			filter->anchored |= rule->anchored;
+		}
+	}
+
+	return true;
+}
+
+static void fp_filter_add(char *s, struct filter *filter)
+{
+	struct filter_rule rule = {0}, *rules;
+	size_t len;
+
+	if (*s == '!') {
+		rule.negate = true;
+		s++;
+	}
+	if (*s == '/') {
+		rule.anchored = true;
+		s++;
+	}
+	len = strlen(s);
+	if (len > 0 && s[len - 1] == '/') {
+		rule.dir_only = true;
+		len --;
+	}
+	if (len == 0)
+		return;
+
+	rule.pattern = malloc(len + 1);
+	if (!rule.pattern)
+		return;
+	memcpy(rule.pattern, s, len);
+	rule.pattern[len] = '\0';
+	if (strchr(rule.pattern, '/'))
+		rule.anchored = true;
+
+	rules = realloc(filter->rules, (filter->num_rules + 1) * sizeof(struct filter_rule));
+	if (!rules) {
+		free(rule.pattern);
+		return;
+	}
+	filter->rules = rules;
+	filter->rules[filter->num_rules++] = rule;
+
+	if (!filter_compile(filter)) {
+		ERROR("fp_filter_add: out of memory\n");
+		free(rule.pattern);
+		filter->num_rules --;
+		filter_compile(filter);
+	}
 }
 
 void fp_filter_add_negative(struct filepirate *fp, char *negative)
@@ -549,7 +4352,6 @@ void fp_filter_add_negative(struct filepirate *fp, char *negative)
 
 void fp_filter_add_positive(struct filepirate *fp, char *positive)
 {
-	/* Add 'negative' to the negative filter list. */
+	/* Add 'positive' to the positive filter list. */
 	fp_filter_add(positive, &(fp->positive_filter));
 }
-
@@ -1,8 +1,67 @@
 struct filepirate;
 
+struct fp_stats {
+	uint64_t watch_events;    /* Changes applied to the index in place by the watcher */
+	uint64_t watch_rescans;   /* Full rescans forced by the watcher, e.g. on queue overflow */
+	uint64_t searches;        /* Calls to fp_get_candidates */
+	uint64_t searches_narrowed; /* Searches which only scanned the matches of an earlier one */
+	uint64_t searches_cancelled;
+	uint64_t cancel_ns_saved; /* Estimated scan time saved by cancelling */
+	uint64_t files_checked;   /* Files considered by searches */
+	uint64_t files_rejected;  /* ... of which were rejected by the character mask prefilter */
+	uint64_t pool_used;       /* Bytes of index */
+	uint64_t pool_committed;  /* Bytes of memory (or cache mapping) holding the index */
+	uint64_t pool_deleted;    /* Bytes of index taken up by deleted files */
+	uint64_t walk_ns;         /* Time spent walking the whole tree */
+	uint64_t walk_files;      /* Files found by the walker, including in new directories */
+	uint64_t walk_dirs;
+	uint64_t walk_git;        /* Full walks which read the git index instead */
+	uint64_t files_matched;   /* Files considered by searches which matched */
+	uint64_t bytes_scanned;   /* Bytes of index (and of narrowed searches' survivor lists) read by searches */
+	uint64_t search_ns;       /* Time spent in fp_get_candidates... */
+	uint64_t scan_ns;         /* ... scanning the index ... */
+	uint64_t topk_ns;         /* ... and merging and sorting the best candidates */
+};
+
+/* Results of fp_cache_load() */
+enum {
+	FP_CACHE_NONE,    /* No usable cache; call fp_init_dir() */
+	FP_CACHE_STALE,   /* Loaded, but the tree has changed since */
+	FP_CACHE_FRESH    /* Loaded and up to date */
+};
+
+/* Sources of files for fp_set_git() */
+enum {
+	FP_GIT_OFF,       /* Walk the tree */
+	FP_GIT_TRACKED,   /* Files in the git index, if the root is a git work tree */
+	FP_GIT_UNTRACKED  /* ... and files which aren't tracked or ignored */
+};
+
+/* Case matching modes for fp_set_case() */
+enum {
+	FP_CASE_EXACT,    /* Letters match only their own case */
+	FP_CASE_IGNORE,   /* Letters match either case; matches in the case typed rank higher */
+	FP_CASE_SMART     /* As FP_CASE_IGNORE, unless the search term has upper case letters */
+};
+
 struct filepirate *fp_init();
 bool fp_init_dir(struct filepirate *fp, char *dirname);
 bool fp_deinit(struct filepirate *fp);
+bool fp_watch_enable(struct filepirate *fp);
+int fp_watch_update(struct filepirate *fp);
+bool fp_watch_pending(struct filepirate *fp);
+void fp_get_stats(struct filepirate *fp, struct fp_stats *stats);
+void fp_cache_set(struct filepirate *fp, char *cache_filename);
+int fp_cache_load(struct filepirate *fp, char *dirname);
+bool fp_cache_save(struct filepirate *fp);
+bool fp_set_threads(struct filepirate *fp, int threads);
+void fp_set_walk_threads(struct filepirate *fp, int threads);
+void fp_set_git(struct filepirate *fp, int git);
+void fp_set_prefilter(struct filepirate *fp, bool enable);
+void fp_set_case(struct filepirate *fp, int case_mode);
+bool fp_set_simd(struct filepirate *fp, bool enable);
+bool fp_set_memory_limit(struct filepirate *fp, size_t limit);
+bool fp_index_truncated(struct filepirate *fp);
 void fp_filter_add_positive(struct filepirate *fp, char *positive);
 void fp_filter_add_negative(struct filepirate *fp, char *negative);
 void fp_filter(struct filepirate *fp, char **positive, char **negative);
@@ -11,17 +70,32 @@ struct candidate {
 	char *dirname;
 	char *filename;
 	int goodness;
-
-	struct candidate *better, *worse;
+	unsigned int path_len;    /* strlen(dirname) + strlen(filename), used to break ties */
+	const void *dir;          /* Directory entry in the index, which dirname is made from */
 };
 
 struct candidate_list {
-	struct candidate *best;
-	struct candidate *worst;
+	struct candidate *candidates; /* Best first, after fp_get_candidates() */
+	int num_candidates;
 	int max_candidates;
+	char *dirnames;           /* Storage for the candidates' dirnames */
+	size_t dirnames_size;
+	char *needle;             /* What was searched for, then its other case, for FP_PACK_POSITIONS */
+	int needle_len;
+};
+
+/* Flags for fp_candidates_pack() */
+enum {
+	FP_PACK_RELATIVE = 1,     /* Leave "./" off the front of paths */
+	FP_PACK_POSITIONS = 2     /* Include where in each path the search term matched */
 };
 
 struct candidate_list *fp_candidate_list_create(int max_candidates);
 void fp_candidate_list_destroy(struct candidate_list *list);
+size_t fp_candidates_pack(struct candidate_list *list, char *buf, size_t size, int flags);
 bool fp_get_candidates(struct filepirate *fp, char *buffer, int buffer_ptr, struct candidate_list *candidates);
+bool fp_set_boosts(struct filepirate *fp, char **paths, int *values, int count);
+void fp_cancel(struct filepirate *fp);
+void fp_set_progress(struct filepirate *fp, unsigned int interval_ms);
+size_t fp_get_progress(struct filepirate *fp, char *buf, size_t size, int flags);
 
@@ -1,6 +1,7 @@
 #include <stdio.h>
 #include <assert.h>
 #include <stdbool.h>
+#include <stdint.h>
 #include <termios.h>
 #include <stdlib.h>
 #include <string.h>
@@ -57,9 +58,9 @@ static void term_init(void)
 
 static void candidate_list_dump(struct candidate_list *list)
 {
-	for (struct candidate *iter = list->best; iter; iter = iter->worse) {
-		if (iter->goodness > -1)
-			printf("%s/%s (%d)\n", iter->dirname, iter->filename, iter->goodness);
+	for (int i = 0; i < list->num_candidates; i++) {
+		struct candidate *iter = &list->candidates[i];
+		printf("%s/%s (%d)\n", iter->dirname, iter->filename, iter->goodness);
 	}
 }
 
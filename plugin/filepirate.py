@@ -3,26 +3,83 @@ Python generic filepirate interface
 """
 import os
 import sys
+import glob
+import math
 import ctypes
+import struct
+import hashlib
+import json
+import socket
+import threading
+import contextlib
+import collections
 import time
 
 SONAME = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cfilepirate.so'))
 MAX_PIRATES = 5
+RESULT_CACHE_SIZE = 64 # Searches remembered by each FilePirate
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'filepirate')
 
-class Candidate(ctypes.Structure):
-	# Forward declaration because of recursive type
-	pass
+FRECENCY_FILE = os.path.join(CACHE_DIR, 'frecency')
+FRECENCY_HALF_LIFE = 7 * 24 * 60 * 60 # seconds
+FRECENCY_MAX_FILES = 1000
+
+# Results of fp_cache_load
+CACHE_NONE = 0
+CACHE_STALE = 1
+CACHE_FRESH = 2
+
+# Flags for fp_candidates_pack
+PACK_RELATIVE = 1
+PACK_POSITIONS = 2
+# Position of a match in a part of the path which was left off
+POSITION_HIDDEN = 0xffffffff
 
-Candidate._fields_ = [('dirname', ctypes.c_char_p),
+# Case matching (see fp_set_case)
+CASE_EXACT = 0
+CASE_IGNORE = 1
+CASE_SMART = 2
+
+# Sources of files (see fp_set_git)
+GIT_OFF = 0
+GIT_TRACKED = 1
+GIT_UNTRACKED = 2
+
+class Candidate(ctypes.Structure):
+	_fields_ = [('dirname', ctypes.c_char_p),
 			('filename', ctypes.c_char_p),
 			('goodness', ctypes.c_int),
-			('better', ctypes.POINTER(Candidate)),
-			('worse', ctypes.POINTER(Candidate))]
+			('path_len', ctypes.c_uint),
+			('dir', ctypes.c_void_p)]
 
 class CandidateList(ctypes.Structure):
-	_fields_ = [('best', ctypes.POINTER(Candidate)),
-		('worst', ctypes.POINTER(Candidate)),
-		('max_candidates', ctypes.c_int)]
+	_fields_ = [('candidates', ctypes.POINTER(Candidate)),
+		('num_candidates', ctypes.c_int),
+		('max_candidates', ctypes.c_int),
+		('dirnames', ctypes.c_void_p),
+		('dirnames_size', ctypes.c_size_t)]
+
+class Stats(ctypes.Structure):
+	_fields_ = [('watch_events', ctypes.c_uint64),
+		('watch_rescans', ctypes.c_uint64),
+		('searches', ctypes.c_uint64),
+		('searches_narrowed', ctypes.c_uint64),
+		('searches_cancelled', ctypes.c_uint64),
+		('cancel_ns_saved', ctypes.c_uint64),
+		('files_checked', ctypes.c_uint64),
+		('files_rejected', ctypes.c_uint64),
+		('pool_used', ctypes.c_uint64),
+		('pool_committed', ctypes.c_uint64),
+		('pool_deleted', ctypes.c_uint64),
+		('walk_ns', ctypes.c_uint64),
+		('walk_files', ctypes.c_uint64),
+		('walk_dirs', ctypes.c_uint64),
+		('walk_git', ctypes.c_uint64),
+		('files_matched', ctypes.c_uint64),
+		('bytes_scanned', ctypes.c_uint64),
+		('search_ns', ctypes.c_uint64),
+		('scan_ns', ctypes.c_uint64),
+		('topk_ns', ctypes.c_uint64)]
 
 PROTOTYPES = {'fp_init': (ctypes.c_void_p, []),
 			  'fp_init_dir': (ctypes.c_bool, [ctypes.c_void_p, ctypes.c_char_p]),
@@ -32,19 +89,242 @@ PROTOTYPES = {'fp_init': (ctypes.c_void_p, []),
               'fp_get_candidates': (ctypes.c_bool, [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p]),
 			  'fp_filter_add_negative': (None, [ctypes.c_void_p, ctypes.c_char_p]),
 			  'fp_filter_add_positive': (None, [ctypes.c_void_p, ctypes.c_char_p]),
+			  'fp_watch_enable': (ctypes.c_bool, [ctypes.c_void_p]),
+			  'fp_watch_update': (ctypes.c_int, [ctypes.c_void_p]),
+			  'fp_watch_pending': (ctypes.c_bool, [ctypes.c_void_p]),
+			  'fp_get_stats': (None, [ctypes.c_void_p, ctypes.POINTER(Stats)]),
+			  'fp_cache_set': (None, [ctypes.c_void_p, ctypes.c_char_p]),
+			  'fp_cache_load': (ctypes.c_int, [ctypes.c_void_p, ctypes.c_char_p]),
+			  'fp_cache_save': (ctypes.c_bool, [ctypes.c_void_p]),
+			  'fp_set_threads': (ctypes.c_bool, [ctypes.c_void_p, ctypes.c_int]),
+			  'fp_set_walk_threads': (None, [ctypes.c_void_p, ctypes.c_int]),
+			  'fp_set_git': (None, [ctypes.c_void_p, ctypes.c_int]),
+			  'fp_set_case': (None, [ctypes.c_void_p, ctypes.c_int]),
+			  'fp_cancel': (None, [ctypes.c_void_p]),
+			  'fp_set_prefilter': (None, [ctypes.c_void_p, ctypes.c_bool]),
+			  'fp_set_simd': (ctypes.c_bool, [ctypes.c_void_p, ctypes.c_bool]),
+			  'fp_set_memory_limit': (ctypes.c_bool, [ctypes.c_void_p, ctypes.c_size_t]),
+			  'fp_index_truncated': (ctypes.c_bool, [ctypes.c_void_p]),
+			  'fp_candidates_pack': (ctypes.c_size_t, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]),
+			  'fp_set_progress': (None, [ctypes.c_void_p, ctypes.c_uint]),
+			  'fp_get_progress': (ctypes.c_size_t, [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]),
+			  'fp_set_boosts': (ctypes.c_bool, [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_int), ctypes.c_int]),
 }
 
 class Error(Exception):
 	pass
 
+class Cancelled(Error):
+	" The search was abandoned by a call to cancel() "
+	pass
+
+class Index(object):
+	"""
+	A native index. Each one built for a FilePirate has a new generation.
+	It is freed once it has been replaced and no search is using it.
+	"""
+	def __init__(self, handle, watching, generation):
+		self.handle = handle
+		self.watching = watching
+		self.generation = generation
+		self.users = 0
+		self.changes = 0             # Changes made to it by watching
+		self.frecency_version = None # Of the boosts given to the native code
+
+def _root_key(root):
+	return hashlib.sha1(os.path.abspath(root).encode('utf-8')).hexdigest()[:16]
+
+def cache_filename(root, negative_filters, positive_filters, git=GIT_OFF):
+	" Name of the index cache file for 'root'. The filters, and where the files come from, are part of the key. "
+	filters = '\0'.join(['-'] + list(negative_filters) + ['+'] + list(positive_filters) + (['git%d' % (git)] if git else []))
+	filters_key = hashlib.sha1(filters.encode('utf-8')).hexdigest()[:8]
+	return os.path.join(CACHE_DIR, '%s-%s.idx' % (_root_key(root), filters_key))
+
+def default_socket():
+	" Where the filepirated daemon listens unless told otherwise "
+	runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+	if runtime_dir:
+		return os.path.join(runtime_dir, 'filepirate.sock')
+	return os.path.join('/tmp', 'filepirate-%d.sock' % (os.getuid()))
+
+def invalidate_cache(root=None):
+	" Remove cached indexes for 'root', or all of them if root is None "
+	pattern = '%s-*.idx' % (_root_key(root)) if root else '*.idx'
+	for filename in glob.glob(os.path.join(CACHE_DIR, pattern)):
+		try:
+			os.remove(filename)
+		except OSError:
+			pass
+
+class Trace(object):
+	"""
+	Appends events to 'filename', one JSON object per line. Each has "event",
+	"time" (seconds since the epoch) and fields of its own. Events from
+	several threads, or processes, may be interleaved.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.file = None
+
+	def write(self, event, **fields):
+		fields['event'] = event
+		fields['time'] = time.time()
+		line = json.dumps(fields, sort_keys=True) + '\n'
+		with self.lock:
+			try:
+				if self.file is None:
+					self.file = open(self.filename, 'a')
+				self.file.write(line)
+				self.file.flush()
+			except OSError:
+				# Tracing mustn't stop searches working
+				pass
+
+class Frecency(object):
+	"""
+	Files the user has opened, ranked by how often and how recently. Each
+	open adds 1 to a file's score, and scores halve every 'half_life'
+	seconds. Only the 'max_files' best are kept.
+
+	The store is a small text file shared by every editor (and the daemon).
+	It isn't read until it's needed, and is read again whenever it changes.
+	"""
+	def __init__(self, filename=FRECENCY_FILE, max_files=FRECENCY_MAX_FILES, half_life=FRECENCY_HALF_LIFE):
+		self.filename = filename
+		self.max_files = max_files
+		self.half_life = half_life
+		self.lock = threading.Lock()
+		self.files = {}        # Absolute path -> (score, time of last open)
+		self.mtime = None      # Of the file when it was read
+		self._version = 0      # Incremented whenever 'files' changes
+
+	def _score(self, score, when, now):
+		return score * 0.5 ** (max(now - when, 0) / self.half_life)
+
+	def _load(self):
+		" Read the store, if it has changed since it was last read "
+		try:
+			mtime = os.stat(self.filename).st_mtime_ns
+		except OSError:
+			return
+		if mtime == self.mtime:
+			return
+
+		files = {}
+		try:
+			with open(self.filename, 'r', encoding='utf-8') as f:
+				for line in f:
+					score, when, path = line.rstrip('\n').split(' ', 2)
+					files[path] = (float(score), float(when))
+		except (OSError, ValueError):
+			return
+		self.files = files
+		self.mtime = mtime
+		self._version += 1
+
+	def _save(self):
+		tmp = '%s.%d' % (self.filename, os.getpid())
+		try:
+			os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+			with open(tmp, 'w', encoding='utf-8') as f:
+				for path, (score, when) in self.files.items():
+					f.write('%.4f %d %s\n' % (score, when, path))
+			os.replace(tmp, self.filename)
+			self.mtime = os.stat(self.filename).st_mtime_ns
+		except OSError:
+			pass
+
+	def record(self, path):
+		" Note that the file at 'path' was opened "
+		path = os.path.abspath(path)
+		now = time.time()
+		with self.lock:
+			self._load()
+			score, when = self.files.get(path, (0.0, now))
+			self.files[path] = (self._score(score, when, now) + 1, now)
+			if len(self.files) > self.max_files:
+				# Forget the files with the lowest scores
+				ranked = sorted(self.files.items(), key=lambda item: self._score(item[1][0], item[1][1], now), reverse=True)
+				self.files = dict(ranked[:self.max_files])
+			self._version += 1
+			self._save()
+
+	def version(self):
+		" Changes whenever the boosts might have "
+		with self.lock:
+			self._load()
+			return self._version
+
+	def boosts(self, root):
+		"""
+		Return the version, and a dict of the boost for each file under
+		'root', keyed by path relative to it (like './a/b'). The boost is
+		the log of the score, so a file opened often doesn't win however
+		badly it matches.
+		"""
+		prefix = os.path.join(os.path.abspath(root), '')
+		now = time.time()
+		boosts = {}
+		with self.lock:
+			self._load()
+			for path, (score, when) in self.files.items():
+				if path.startswith(prefix):
+					boost = int(round(math.log2(1 + self._score(score, when, now))))
+					if boost > 0:
+						boosts['./' + path[len(prefix):]] = boost
+			return self._version, boosts
+
 class FilePirate(object):
 	"""
 	Interface to native code
+
+	If 'watch' is True, the native code watches the tree for changes
+	(using inotify) and applies them to the index before each search, so
+	rescans are only needed if watching fails.
+
+	If 'cache' is True, the index is saved to disk after every scan, and
+	loaded from there (rather than walking the tree) when a FilePirate is
+	created for the same root. If the tree has changed since the cache was
+	written, the stale index is searched while a new one is built in the
+	background, as it is by rescan().
+
+	'threads' is the number of threads used for each search, and to walk
+	the tree. 'walk_threads', if given, overrides the latter; 0 walks the
+	tree with fts, as File Pirate used to.
+
+	'git' says where the files in a git work tree come from: GIT_OFF walks
+	the tree as usual, GIT_TRACKED reads the git index instead, so that
+	ignored files are left out without being walked, and GIT_UNTRACKED adds
+	the files which aren't tracked but aren't ignored either. Roots which
+	aren't git work trees are always walked.
+
+	'case' says how letters match: CASE_EXACT only matches the case typed,
+	CASE_IGNORE matches either case but ranks matches in the case typed
+	higher, and CASE_SMART ignores case unless the search term has upper case
+	letters.
+
+	'memory_limit' is the most memory, in bytes, the index may use. If the
+	tree doesn't fit, the index is truncated (see truncated()). None means
+	the native default.
+
+	If 'frecency' is a Frecency, files opened often rank higher.
+
+	The results of the last 'result_cache' searches are remembered, and
+	returned again if the index hasn't changed since (see
+	cached_candidates()).
+
+	If 'trace' is a Trace, every search and index build is written to it,
+	with its timings and the native counters for it.
+
+	If 'progress_interval' is set, searches publish the best results they
+	have found so far every that many milliseconds, which progress() reads.
 	"""
 	# Class static
 	native = None
 
-	def __init__(self, root, max_candidates, negative_filters, positive_filters):
+	def __init__(self, root, max_candidates, negative_filters, positive_filters, watch=False, cache=False, threads=1, memory_limit=None, walk_threads=None, git=GIT_OFF, case=CASE_EXACT, frecency=None,
+			result_cache=RESULT_CACHE_SIZE, trace=None, progress_interval=None):
 		self.root = root
 
 		if self.__class__.native is None:
@@ -59,64 +339,495 @@ class FilePirate(object):
 		self.max_candidates = max_candidates
 		self.negative_filters = negative_filters
 		self.positive_filters = positive_filters
+		self.watch = watch
+		self.cache = cache
+		self.threads = threads
+		self.walk_threads = walk_threads
+		self.git = git
+		self.case = case
+		self.memory_limit = memory_limit
+		self.frecency = frecency
+		self.result_cache = result_cache
+		# Term -> (index state, results), least recently used first. Guarded by index_lock.
+		self.results = collections.OrderedDict()
+		self.result_hits = 0
+		self.result_misses = 0
+		self.trace = trace
+		self.progress_interval = progress_interval
+		# Time spent in get_candidates() when the results weren't cached, and
+		# in getting the results out of the native code
+		self.search_ns = 0
+		self.decode_ns = 0
+		# Held while searching, as the candidate list is shared
+		self.lock = threading.Lock()
+		# Held briefly to replace the index, or to start or finish using it
+		self.index_lock = threading.Lock()
+		self.searching = None     # Index used by the search in progress
+		self.rescanning = False
+		self.generation = 0       # Of the current index
+		self.last_generation = 0  # Of the index the last search ran against
+		self.cancel_requested = False
 		self.create()
 	
 	def __del__(self):
 		if self.native:
 			if hasattr(self, 'candidates'):
 				self.native.fp_candidate_list_destroy(self.candidates)
-			if hasattr(self, 'handle'):
-				self.native.fp_deinit(self.handle)
+			if hasattr(self, 'index'):
+				self.native.fp_deinit(self.index.handle)
 	
 	def rescan(self):
-		self.__del__()
-		self.create()
+		" Build a new index in the background. Searches use the current one until it's ready. "
+		with self.index_lock:
+			if self.rescanning:
+				return
+			self.rescanning = True
+
+		refresh = threading.Thread(target=self._refresh)
+		refresh.daemon = True
+		refresh.start()
+
+	def invalidate_cache(self):
+		" Remove cached indexes for this root. The current index is unaffected. "
+		invalidate_cache(self.root)
 	
 	def create(self):
-		self.handle = self.native.fp_init()
-		if bool(self.handle) == False: # ctypes-speak for handle == NULL
+		handle, watching, cache_status = self._create_native(use_cache=True)
+		self.generation += 1
+		self.index = Index(handle, watching, self.generation)
+
+		self.candidates = self.native.fp_candidate_list_create(self.max_candidates)
+		if self.candidates == None:
+			raise Error("fp_candidate_list_create")
+		# Grown as needed by _unpack(), and by progress()
+		self.pack_buffer = ctypes.create_string_buffer(4096)
+		self.progress_buffer = ctypes.create_string_buffer(4096)
+
+		if cache_status == CACHE_STALE:
+			self.rescan()
+
+	def _create_native(self, use_cache):
+		" Build a native index. Returns the handle, whether it is being watched, and the cache status. "
+		handle = self.native.fp_init()
+		if bool(handle) == False: # ctypes-speak for handle == NULL
 			raise Error("fp_init")
 
+		if self.memory_limit is not None and not self.native.fp_set_memory_limit(handle, self.memory_limit):
+			self.native.fp_deinit(handle)
+			raise Error("fp_set_memory_limit")
+
 		for negative in self.negative_filters:
-			self.native.fp_filter_add_negative(self.handle, negative.encode('utf-8'))
+			self.native.fp_filter_add_negative(handle, negative.encode('utf-8'))
 
 		for positive in self.positive_filters:
-			self.native.fp_filter_add_positive(self.handle, positive.encode('utf-8'))
+			self.native.fp_filter_add_positive(handle, positive.encode('utf-8'))
 
-		if not self.native.fp_init_dir(self.handle, self.root.encode('utf-8')):
-			raise Error("fp_init_dir")
+		watching = self.watch and self.native.fp_watch_enable(handle)
+		self.native.fp_set_threads(handle, self.threads)
+		if self.walk_threads is not None:
+			self.native.fp_set_walk_threads(handle, self.walk_threads)
+		self.native.fp_set_git(handle, self.git)
+		self.native.fp_set_case(handle, self.case)
+		if self.progress_interval:
+			self.native.fp_set_progress(handle, self.progress_interval)
 
-		self.candidates = self.native.fp_candidate_list_create(self.max_candidates)
-		if self.candidates == None:
-			raise Error("fp_candidate_list_create")
+		cache_status = CACHE_NONE
+		if self.cache:
+			filename = cache_filename(self.root, self.negative_filters, self.positive_filters, self.git)
+			self.native.fp_cache_set(handle, filename.encode('utf-8'))
+			if use_cache:
+				cache_status = self.native.fp_cache_load(handle, self.root.encode('utf-8'))
+
+		if cache_status == CACHE_NONE:
+			if not self.native.fp_init_dir(handle, self.root.encode('utf-8')):
+				self.native.fp_deinit(handle)
+				raise Error("fp_init_dir")
+
+			if self.cache:
+				try:
+					os.makedirs(os.path.dirname(filename), exist_ok=True)
+				except OSError:
+					pass
+				self.native.fp_cache_save(handle)
+
+		if self.trace:
+			stats = self._native_stats(handle)
+			self.trace.write('index', root=self.root, cache_status=cache_status, watching=bool(watching),
+					walk_ms=stats['walk_ns'] / 1e6, files=stats['walk_files'], dirs=stats['walk_dirs'],
+					git=bool(stats['walk_git']), pool_used=stats['pool_used'])
+
+		return handle, watching, cache_status
+
+	def _swap(self, handle, watching, cache_status):
+		with self.index_lock:
+			old = self.index
+			self.generation += 1
+			self.index = Index(handle, watching, self.generation)
+			unused = old.users == 0
+		if unused:
+			self.native.fp_deinit(old.handle)
+
+	def _refresh(self):
+		# Runs in a background thread, started by rescan()
+		try:
+			self._swap(*self._create_native(use_cache=False))
+		except Error:
+			pass
+		finally:
+			with self.index_lock:
+				self.rescanning = False
+
+	@contextlib.contextmanager
+	def _use_index(self, searching=False):
+		" Use the current index, making sure it isn't freed until we're done "
+		with self.index_lock:
+			index = self.index
+			index.users += 1
+			if searching:
+				self.searching = index
+		try:
+			yield index
+		finally:
+			with self.index_lock:
+				index.users -= 1
+				if searching:
+					self.searching = None
+				unused = index.users == 0 and index is not self.index
+			if unused:
+				self.native.fp_deinit(index.handle)
+
+	def _index_state(self, index, frecency_version):
+		" Results for the same term are the same while this is "
+		return (index.generation, index.changes, frecency_version)
+
+	def cached_candidates(self, search_term, relative=False, scores=False, positions=False):
+		"""
+		The results of an earlier search for 'search_term' (see
+		get_candidates()), if the index hasn't changed since, or None. This
+		doesn't wait for a search in progress, so it can be called from
+		another thread.
+		"""
+		if not self.result_cache:
+			return None
+		frecency_version = self.frecency.version() if self.frecency is not None else None
+		key = (search_term, relative, positions)
+		with self.index_lock:
+			entry = self.results.get(key)
+			if entry is None or entry[0] != self._index_state(self.index, frecency_version):
+				return None
+			if self.index.watching and self.native.fp_watch_pending(self.index.handle):
+				return None
+			self.results.move_to_end(key)
+			self.result_hits += 1
+			self.last_generation = self.index.generation
+			return self._results(entry[1], entry[2], entry[3], scores)
+
+	def _results(self, paths, goodness, positions, scores):
+		if positions is not None:
+			return list(zip(paths, goodness, positions)) if scores else list(zip(paths, positions))
+		return list(zip(paths, goodness)) if scores else list(paths)
+
+	def get_candidates(self, search_term, relative=False, scores=False, positions=False):
+		"""
+		Search the current index, and return the paths of the best matches,
+		best first. Paths start with './' unless 'relative' is set. If
+		'scores' is set, each result is a (path, score) tuple instead. If
+		'positions' is set, the byte offsets in the path of the characters
+		which matched the search term are added to the end of each result:
+		(path, positions) or (path, score, positions).
+		Sets last_generation to the generation of the index.
+		"""
+		results = self.cached_candidates(search_term, relative, scores, positions)
+		if results is not None:
+			if self.trace:
+				self.trace.write('search', root=self.root, term=search_term, cached=True, results=len(results))
+			return results
+
+		start = time.perf_counter()
+		with self.lock:
+			with self._use_index(searching=True) as index:
+				self.last_generation = index.generation
+				before = self._native_stats(index.handle) if self.trace else None
+				try:
+					paths, goodness, matched = self._get_candidates(index, search_term, relative, positions)
+				finally:
+					elapsed = time.perf_counter() - start
+					self.search_ns += int(elapsed * 1e9)
+					if self.trace:
+						self._trace_search(index, search_term, before, elapsed)
+				state = self._index_state(index, index.frecency_version)
 
-	def get_candidates(self, search_term):
-		result = self.native.fp_get_candidates(self.handle, search_term.encode('utf-8'), len(search_term), self.candidates)
+		if self.result_cache:
+			key = (search_term, relative, positions)
+			with self.index_lock:
+				self.result_misses += 1
+				self.results[key] = (state, paths, goodness, matched)
+				self.results.move_to_end(key)
+				while len(self.results) > self.result_cache:
+					self.results.popitem(last=False)
+		return self._results(paths, goodness, matched, scores)
+
+	def _get_candidates(self, index, search_term, relative, positions):
+		if index.watching:
+			changes = self.native.fp_watch_update(index.handle)
+			if changes < 0:
+				# Ran out of inotify watches. Carry on with what we have until the next rescan.
+				index.watching = False
+			else:
+				index.changes += changes
+
+		if self.frecency is not None and index.frecency_version != self.frecency.version():
+			self._set_boosts(index)
+
+		self.cancel_requested = False
+		result = self.native.fp_get_candidates(index.handle, search_term.encode('utf-8'), len(search_term), self.candidates)
 		if not result:
+			if self.cancel_requested:
+				raise Cancelled("fp_get_candidates")
 			raise Error("fp_get_candidates")
 
-		candidates = []
-		candidate = self.candidates.contents.best
-		while bool(candidate): # magic: bool(ptr) = false when ptr is null
-			candidate = candidate.contents
-			if candidate.goodness == -1:
-				# That's it
-				break
-			candidates.append(os.path.join(candidate.dirname.decode('utf-8'), candidate.filename.decode('utf-8')))
-			candidate = candidate.worse
+		start = time.perf_counter()
+		results = self._unpack((PACK_RELATIVE if relative else 0) | (PACK_POSITIONS if positions else 0))
+		self.decode_ns += int((time.perf_counter() - start) * 1e9)
+		return results
+
+	def _trace_search(self, index, search_term, before, elapsed):
+		" Write a search, and what the native code did for it, to the trace "
+		after = self._native_stats(index.handle)
+		change = lambda name: after[name] - before[name]
+		self.trace.write('search', root=self.root, term=search_term, cached=False, generation=index.generation,
+				results=self.candidates.contents.num_candidates, cancelled=bool(change('searches_cancelled')),
+				narrowed=bool(change('searches_narrowed')), checked=change('files_checked'),
+				rejected=change('files_rejected'), matched=change('files_matched'), bytes=change('bytes_scanned'),
+				native_ms=change('search_ns') / 1e6, scan_ms=change('scan_ns') / 1e6, topk_ms=change('topk_ns') / 1e6,
+				search_ms=elapsed * 1000)
+
+	def _unpack(self, flags):
+		" The paths, goodness and match positions of the candidates, from fp_candidates_pack "
+		size = self.native.fp_candidates_pack(self.candidates, self.pack_buffer, len(self.pack_buffer), flags)
+		if size > len(self.pack_buffer):
+			self.pack_buffer = ctypes.create_string_buffer(size * 2)
+			size = self.native.fp_candidates_pack(self.candidates, self.pack_buffer, len(self.pack_buffer), flags)
+		return self._decode(self.pack_buffer, size, flags)
+
+	def _decode(self, buffer, size, flags):
+		"""
+		The paths, goodness and match positions (or None, without
+		PACK_POSITIONS) of packed candidates
+		"""
+		packed = ctypes.string_at(buffer, size)
+		count, = struct.unpack_from('I', packed)
+		goodness = struct.unpack_from('%di' % (count), packed, 4)
+		# Skip the offsets; splitting the paths is quicker
+		paths_start = 4 + 8 * count
+		positions = None
+		if flags & PACK_POSITIONS:
+			needle_len, = struct.unpack_from('I', packed, paths_start)
+			flat = struct.unpack_from('%dI' % (count * needle_len), packed, paths_start + 4)
+			positions = [tuple(position for position in flat[idx * needle_len:(idx + 1) * needle_len]
+					if position != POSITION_HIDDEN) for idx in range(count)]
+			paths_start += 4 + 4 * count * needle_len
+		if count == 0:
+			return [], (), positions
+		# Names which aren't UTF-8 come out as they would from os.listdir()
+		paths = packed[paths_start:-1].decode('utf-8', 'surrogateescape').split('\0')
+		return paths, goodness, positions
 
-		return candidates
+	def progress(self, relative=False, scores=False, positions=False):
+		"""
+		The best results found so far by the search in progress, as
+		get_candidates() would return them, or None if there is no search in
+		progress or it hasn't published any results yet (see
+		'progress_interval'). Called from another thread; doesn't wait for
+		the search.
+		"""
+		with self.index_lock:
+			index = self.searching
+			if index is None or not self.progress_interval:
+				return None
+			index.users += 1
+		try:
+			flags = (PACK_RELATIVE if relative else 0) | (PACK_POSITIONS if positions else 0)
+			size = self.native.fp_get_progress(index.handle, self.progress_buffer, len(self.progress_buffer), flags)
+			if size > len(self.progress_buffer):
+				self.progress_buffer = ctypes.create_string_buffer(size * 2)
+				size = self.native.fp_get_progress(index.handle, self.progress_buffer, len(self.progress_buffer), flags)
+			# Nothing yet, or the second call found more than fits
+			if size == 0 or size > len(self.progress_buffer):
+				return None
+			paths, goodness, matched = self._decode(self.progress_buffer, size, flags)
+		finally:
+			with self.index_lock:
+				index.users -= 1
+				unused = index.users == 0 and index is not self.index
+			if unused:
+				self.native.fp_deinit(index.handle)
+		return self._results(paths, goodness, matched, scores)
+
+	def _set_boosts(self, index):
+		version, boosts = self.frecency.boosts(self.root)
+		paths = (ctypes.c_char_p * len(boosts))(*[path.encode('utf-8') for path in boosts])
+		values = (ctypes.c_int * len(boosts))(*boosts.values())
+		if self.native.fp_set_boosts(index.handle, paths, values, len(boosts)):
+			index.frecency_version = version
+
+	def cancel(self):
+		" Abandon the search in progress, if any, from another thread. It raises Cancelled. "
+		with self.index_lock:
+			self.cancel_requested = True
+			self.native.fp_cancel((self.searching or self.index).handle)
+
+	def truncated(self):
+		" True if the index hit the memory limit, so some files are missing. Doesn't wait for a search in progress. "
+		with self._use_index() as index:
+			return self.native.fp_index_truncated(index.handle)
+
+	def _native_stats(self, handle):
+		stats = Stats()
+		self.native.fp_get_stats(handle, ctypes.byref(stats))
+		return dict((name, getattr(stats, name)) for name, _ in Stats._fields_)
+
+	def stats(self):
+		" Return native statistics, and the time spent in Python, as a dict "
+		with self.lock:
+			with self._use_index() as index:
+				stats = self._native_stats(index.handle)
+		stats['result_cache_hits'] = self.result_hits
+		stats['result_cache_misses'] = self.result_misses
+		stats['py_search_ns'] = self.search_ns
+		stats['py_decode_ns'] = self.decode_ns
+		return stats
+
+
+class RemoteFilePirate(object):
+	"""
+	Like FilePirate, but the index is kept by a filepirated daemon listening
+	on 'socket_path', and shared with its other clients. The daemon's own
+	options say whether it watches, caches and so on.
+
+	cancel() can't stop the daemon's search, but the results are thrown away.
+	"""
+	def __init__(self, socket_path, root, max_candidates, negative_filters, positive_filters, git=GIT_OFF, case=CASE_EXACT):
+		self.socket_path = socket_path
+		self.root = root
+		self.max_candidates = max_candidates
+		self.negative_filters = list(negative_filters)
+		self.positive_filters = list(positive_filters)
+		self.git = git
+		self.case = case
+		self.lock = threading.Lock()
+		self.sock = None
+		self.reader = None
+		self.last_generation = 0
+		self.last_latency_ms = None # Of the last search, as measured by the daemon
+		self.rescanning = False
+		self._truncated = False
+		self.cancel_requested = False
+
+	def __del__(self):
+		self._disconnect()
+
+	def _disconnect(self):
+		if self.sock is not None:
+			self.reader.close()
+			self.sock.close()
+			self.sock = self.reader = None
+
+	def _request(self, op, **args):
+		request = dict(op=op, root=self.root, max_candidates=self.max_candidates,
+				negative=self.negative_filters, positive=self.positive_filters, git=self.git, case=self.case)
+		request.update(args)
+		line = (json.dumps(request) + '\n').encode('utf-8')
+
+		with self.lock:
+			# Try again once on a new connection, in case the daemon was restarted
+			for attempt in range(2):
+				try:
+					if self.sock is None:
+						self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+						self.reader = self.sock.makefile('rb')
+						self.sock.connect(self.socket_path)
+					self.sock.sendall(line)
+					reply = self.reader.readline()
+					if reply:
+						break
+				except OSError as e:
+					self._disconnect()
+					if attempt:
+						raise Error("filepirated %s: %s" % (self.socket_path, str(e)))
+				else:
+					self._disconnect()
+			else:
+				raise Error("filepirated %s: connection closed" % (self.socket_path))
+
+		reply = json.loads(reply.decode('utf-8'))
+		if not reply['ok']:
+			raise Error(reply['error'])
+		return reply
+
+	def get_candidates(self, search_term, relative=False, scores=False, positions=False):
+		self.cancel_requested = False
+		reply = self._request('search', term=search_term, relative=relative, scores=scores, positions=positions)
+		self.last_generation = reply['generation']
+		self.last_latency_ms = reply['latency_ms']
+		self.rescanning = reply['rescanning']
+		self._truncated = reply['truncated']
+		if self.cancel_requested:
+			raise Cancelled("fp_get_candidates")
+		if positions:
+			return [tuple(result[:-1]) + (tuple(result[-1]),) for result in reply['results']]
+		if scores:
+			return [tuple(result) for result in reply['results']]
+		return reply['results']
+
+	def cached_candidates(self, search_term, relative=False, scores=False, positions=False):
+		" The daemon caches results itself "
+		return None
+
+	def progress(self, relative=False, scores=False, positions=False):
+		" The daemon doesn't send partial results "
+		return None
+
+	def cancel(self):
+		self.cancel_requested = True
+
+	def rescan(self):
+		self._request('rescan')
+
+	def invalidate_cache(self):
+		self._request('invalidate_cache')
+
+	def truncated(self):
+		" As of the last search "
+		return self._truncated
+
+	def stats(self):
+		return self._request('stats')['stats']
 
 
 class FilePirates(object):
 	"""
 	A set of FilePirate objects. Keeps only MAX_PIRATES in memory. Eviction is LRU.
+	'options' are passed on to each FilePirate. If 'daemon' is the path of a
+	filepirated socket, they are RemoteFilePirates instead, and the options
+	other than 'git' and 'case' are ignored. The daemon reads the same
+	frecency store.
 	"""
-	def __init__(self, max_candidates):
+	def __init__(self, max_candidates, daemon=None, **options):
 		self.pirates = []
 		self.negative_filter = []
 		self.positive_filter = []
 		self.max_candidates = max_candidates
+		self.daemon = daemon
+		self.options = options
+		self.frecency = options.get('frecency')
+
+	def find(self, root):
+		" The pirate for 'root', or None if there isn't one yet. May be called while another thread uses get(). "
+		for pirate in list(self.pirates):
+			if pirate.root == root:
+				return pirate
+		return None
 
 	def get(self, root):
 		for idx in range(len(self.pirates)):
@@ -127,17 +838,42 @@ class FilePirates(object):
 		else:
 			if len(self.pirates) >= MAX_PIRATES:
 				self.pirates.pop()
-			pirate = FilePirate(root, self.max_candidates, self.negative_filter, self.positive_filter)
+			pirate = self._create(root)
 
 		self.pirates.insert(0, pirate)
 		return pirate
 
+	def _create(self, root):
+		if self.daemon:
+			return RemoteFilePirate(self.daemon, root, self.max_candidates, self.negative_filter, self.positive_filter,
+					self.options.get('git', GIT_OFF), self.options.get('case', CASE_EXACT))
+		return FilePirate(root, self.max_candidates, self.negative_filter, self.positive_filter, **self.options)
+
 	def add_negative_filter(self, filter):
 		self.negative_filter.append(filter)
 
+	def record_open(self, path):
+		" Note that the user opened 'path', if frecency is on "
+		if self.frecency is not None:
+			self.frecency.record(path)
+
 	def add_positive_filter(self, filter):
 		self.positive_filter.append(filter)
 
+	def invalidate_cache(self, root=None):
+		" Remove cached indexes for 'root', or for every root if None, and rescan any loaded pirate "
+		if self.daemon:
+			# The daemon's indexes (and cache) may be for other roots too
+			for pirate in self.pirates:
+				if root is None or pirate.root == root:
+					pirate.invalidate_cache()
+			return
+
+		invalidate_cache(root)
+		for pirate in self.pirates:
+			if root is None or pirate.root == root:
+				pirate.rescan()
+
 if __name__ == '__main__':
 	# test it
 	dirname = sys.argv[1]
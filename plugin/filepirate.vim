@@ -5,9 +5,18 @@ import vim
 
 plugin_dir = os.path.dirname(vim.eval('expand("<sfile>")'))
 sys.path.insert(0, plugin_dir)
-from vimfilepirate import filepirate_open, filepirate_key, filepirate_callback, filepirate_accept, filepirate_cancel, filepirate_up, filepirate_down, filepirate_bs, filepirate_rescan, filepirate_enter_insert_mode, filepirate_enter_normal_mode, filepirate_add_negative_filter
+from vimfilepirate import filepirate_open, filepirate_key, filepirate_callback, filepirate_accept, filepirate_cancel, filepirate_up, filepirate_down, filepirate_bs, filepirate_rescan, filepirate_enter_insert_mode, filepirate_enter_normal_mode, filepirate_add_negative_filter, filepirate_stats
 EOF
 
+command! FilePirateStats python3 filepirate_stats()
+
+" Polls for search results; see VimAsync
+function! FilePirateTimer(timer)
+	python3 filepirate_callback()
+endfunction
+
+highlight default link FilePirateMatch Search
+
 if !exists("g:filepirate_map_leader") || g:filepirate_map_leader != 0
 	noremap <Leader>t :python3 filepirate_open()<CR>
 endif
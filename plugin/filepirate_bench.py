@@ -0,0 +1,445 @@
+"""
+File Pirate benchmarks
+
+Builds a synthetic tree, indexes it, and times each keystroke of typing
+every query, one character at a time. Run as:
+
+    python3 filepirate_bench.py [--files N] [--layout flat|deep|tree] [--root DIR] [--json FILE] [query...]
+
+The index build time, walk throughput and pool size are reported, and the
+50th, 90th and 99th percentile and worst keystroke latency for each query
+and overall. --json also writes them to FILE, and --compare reads an
+earlier FILE and shows the change, so that runs on different commits can be
+compared.
+
+The tree layout is one of:
+  flat  random names up to --depth levels deep, 20 files per directory
+  deep  a Java/JS style multi-module project, 8 files per directory
+  tree  a balanced tree, --depth levels of --fanout directories each, with
+        the files spread evenly over the leaves
+Names are drawn from a list of words, either uniformly or, with
+--names zipf, so that a few words are much more common than the rest.
+
+--case picks how letters match, so the cost of ignoring case can be
+compared with exact matching.
+
+With --prefilter, compares searches with the character mask prefilter off
+and on instead. With --walk, times walking the tree with fts and with the parallel walker
+instead. With --extract, times getting --results results out of the native
+code for each query, one candidate at a time through ctypes (as File Pirate
+used to) and with fp_candidates_pack. With --simd, compares searches with
+the scalar matcher and with the vector one.
+
+--fuzz N searches for N random queries with both matchers, in each case
+mode, and checks that they find the same files with the same scores, and
+that the match positions of each result pick out the query.
+
+The tree is kept in DIR (default: a directory in /dev/shm if there is one,
+so that the disk isn't measured, otherwise under the system temporary
+directory) and reused by later runs with the same options. Nothing needs
+the network.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import filepirate
+
+WORDS = ['app', 'lib', 'src', 'test', 'util', 'core', 'net', 'http', 'json', 'parse', 'render', 'view',
+		'model', 'index', 'cache', 'store', 'event', 'queue', 'worker', 'client', 'server', 'auth',
+		'config', 'log', 'main', 'Widget', 'Handler', 'Factory', 'Manager', 'Service']
+EXTENSIONS = ['.c', '.h', '.py', '.js', '.java', '.go', '.rs', '.txt', '.md', '.json']
+DEFAULT_QUERIES = ['m', 'mn', 'main', 'src/ut', 'hndlr', 'WdgtFct', 'zq', 'Qx9', 'x.rs', 'cfgjs']
+DEFAULT_DEPTH = 5
+DEFAULT_FANOUT = 8
+# Bump when the meaning of the JSON results changes
+RESULTS_FORMAT = 1
+CASES = {'exact': filepirate.CASE_EXACT, 'ignore': filepirate.CASE_IGNORE, 'smart': filepirate.CASE_SMART}
+
+def uniform_word(rng):
+	return rng.choice(WORDS)
+
+def zipf_word(rng):
+	" The nth most common word is n times rarer than the most common one "
+	return rng.choices(WORDS, ZIPF_WEIGHTS)[0]
+
+ZIPF_WEIGHTS = [1.0 / (rank + 1) for rank in range(len(WORDS))]
+NAMES = {'uniform': uniform_word, 'zipf': zipf_word}
+
+def flat_dir(rng, word, dir_idx, depth, fanout):
+	" A directory a few levels down, with random names "
+	depth = rng.randint(1, depth)
+	parts = ['%s%d' % (word(rng), rng.randint(0, 9)) for _ in range(depth)]
+	parts[-1] += '-%d' % (dir_idx)
+	return parts
+
+def deep_dir(rng, word, dir_idx, depth, fanout):
+	" A Java package or JS component directory, deep in a multi-module project "
+	module = 'module-%s' % (WORDS[dir_idx % len(WORDS)].lower())
+	if rng.random() < 0.7:
+		parts = [module, 'src', rng.choice(['main', 'test']), 'java', 'com', 'example', 'platform']
+	else:
+		parts = [module, 'frontend', 'src', 'components']
+	parts += [word(rng).lower() for _ in range(rng.randint(1, max(depth - 1, 1)))]
+	parts.append('%s%d' % (word(rng).lower(), dir_idx))
+	return parts
+
+def tree_dir(rng, word, dir_idx, depth, fanout):
+	" Leaf 'dir_idx' of a balanced tree. Each directory's name depends only on where it is. "
+	parts = []
+	for level in range(depth):
+		node = dir_idx // (fanout ** (depth - 1 - level))
+		parts.append('%s%d' % (word(random.Random('%d/%d' % (level, node))), node % fanout))
+	return parts
+
+# Directory generator and files per directory (None: spread over the leaves) for each layout
+LAYOUTS = {'flat': (flat_dir, 20), 'deep': (deep_dir, 8), 'tree': (tree_dir, None)}
+
+def tree_name(num_files, layout='flat', depth=DEFAULT_DEPTH, fanout=DEFAULT_FANOUT, names='uniform', seed=1):
+	" A name for the tree with these options, used for its marker and default directory "
+	name = '%s-%d' % (layout, num_files)
+	if depth != DEFAULT_DEPTH or layout == 'tree':
+		name += '-d%d' % (depth)
+	if layout == 'tree':
+		name += '-f%d' % (fanout)
+	if names != 'uniform':
+		name += '-' + names
+	if seed != 1:
+		name += '-s%d' % (seed)
+	return name
+
+def make_tree(root, num_files, layout='flat', depth=DEFAULT_DEPTH, fanout=DEFAULT_FANOUT, names='uniform', seed=1):
+	" Create 'num_files' empty files under 'root', unless a previous run already has "
+	marker = os.path.join(root, '.filepirate-bench-' + tree_name(num_files, layout, depth, fanout, names, seed))
+	if os.path.exists(marker):
+		return
+
+	make_dir, files_per_dir = LAYOUTS[layout]
+	if files_per_dir is None:
+		files_per_dir = max(1, -(-num_files // (fanout ** depth)))
+	word = NAMES[names]
+	rng = random.Random(seed)
+	for dir_idx in range(num_files // files_per_dir):
+		path = os.path.join(root, *make_dir(rng, word, dir_idx, depth, fanout))
+		os.makedirs(path, exist_ok=True)
+		for file_idx in range(files_per_dir):
+			name = '%s%s%d%s' % (word(rng), word(rng), file_idx, rng.choice(EXTENSIONS))
+			open(os.path.join(path, name), 'w').close()
+
+	open(marker, 'w').close()
+
+def default_root():
+	" Somewhere on a tmpfs, if possible "
+	if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+		return '/dev/shm'
+	return tempfile.gettempdir()
+
+def percentile(samples, percent):
+	" Nearest-rank percentile of sorted 'samples' "
+	rank = max(0, -(-len(samples) * percent // 100) - 1)
+	return samples[min(int(rank), len(samples) - 1)]
+
+def summarise(samples):
+	" Percentiles of 'samples', in seconds, as milliseconds "
+	samples = sorted(samples)
+	if not samples:
+		return {'keystrokes': 0}
+	summary = {'keystrokes': len(samples)}
+	for percent in (50, 90, 99):
+		summary['p%d_ms' % (percent)] = percentile(samples, percent) * 1000
+	summary['max_ms'] = samples[-1] * 1000
+	return summary
+
+def bench_build(root, repeat, threads, case=filepirate.CASE_EXACT):
+	" Index the tree 'repeat' times. Returns the last FilePirate and the timings. "
+	times = []
+	for _ in range(repeat):
+		# Free the last index first, so only one is in memory
+		pirate = None
+		start = time.perf_counter()
+		pirate = filepirate.FilePirate(root, 10, [], [], threads=threads, case=case, result_cache=0)
+		times.append(time.perf_counter() - start)
+	stats = pirate.stats()
+	times.sort()
+	walk_seconds = stats['walk_ns'] / 1e9
+	build = {'best_s': times[0], 'median_s': times[len(times) // 2],
+			'walk_s': walk_seconds, 'files': stats['walk_files'], 'dirs': stats['walk_dirs'],
+			'files_per_s': stats['walk_files'] / max(walk_seconds, 1e-9),
+			'pool_used': stats['pool_used'], 'pool_committed': stats['pool_committed'],
+			'bytes_per_file': stats['pool_used'] / float(max(stats['walk_files'], 1))}
+	print('index: %.2fs best, %.2fs median; walked %d files in %d directories (%.0f files/sec)' % (build['best_s'],
+		build['median_s'], build['files'], build['dirs'], build['files_per_s']))
+	print('pool: %.1fMB used (%.1f bytes per file), %.1fMB committed' % (build['pool_used'] / 1048576.0,
+		build['bytes_per_file'], build['pool_committed'] / 1048576.0))
+	return pirate, build
+
+def type_query(pirate, query):
+	" Type 'query' one character at a time. Returns the time each keystroke's search took. "
+	# Start from an empty search, as a newly opened File Pirate window does
+	pirate.get_candidates('')
+	times = []
+	for length in range(1, len(query) + 1):
+		start = time.perf_counter()
+		pirate.get_candidates(query[:length])
+		times.append(time.perf_counter() - start)
+	return times
+
+def bench_typing(pirate, queries, repeat):
+	" Keystroke latency percentiles for typing each query, and for all of them together "
+	print('%-12s %10s %10s %10s %10s %10s' % ('query', 'keystrokes', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)'))
+	results = {}
+	everything = []
+	for query in queries:
+		samples = []
+		for _ in range(repeat):
+			samples += type_query(pirate, query)
+		everything += samples
+		results[query] = summarise(samples)
+	overall = summarise(everything)
+	for query, summary in [(query, results[query]) for query in queries] + [('(all)', overall)]:
+		if summary['keystrokes']:
+			print('%-12s %10d %10.3f %10.3f %10.3f %10.3f' % (query, summary['keystrokes'],
+				summary['p50_ms'], summary['p90_ms'], summary['p99_ms'], summary['max_ms']))
+	return results, overall
+
+def git_commit():
+	" The commit File Pirate is at, or None "
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+				stderr=subprocess.DEVNULL).decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(old, new):
+	" Show how 'new' results differ from 'old' ones "
+	def change(name, before, after):
+		print('%-24s %12.3f %12.3f %+9.1f%%' % (name, before, after, 100.0 * (after - before) / max(before, 1e-9)))
+
+	print('compared with %s' % (old.get('commit') or 'unknown commit'))
+	if old.get('tree') != new['tree']:
+		print('warning: the trees differ')
+	print('%-24s %12s %12s %10s' % ('', 'before', 'after', 'change'))
+	change('index best (s)', old['build']['best_s'], new['build']['best_s'])
+	change('walk (files/sec)', old['build']['files_per_s'], new['build']['files_per_s'])
+	change('pool used (MB)', old['build']['pool_used'] / 1048576.0, new['build']['pool_used'] / 1048576.0)
+	pairs = [('(all)', old['keystrokes'], new['keystrokes'])]
+	pairs += [(query, old['typing'].get(query), summary) for query, summary in sorted(new['typing'].items())]
+	for query, before, after in pairs:
+		if not after['keystrokes'] or not before or not before['keystrokes']:
+			continue
+		for measure in ('p50_ms', 'p99_ms'):
+			change('%s %s' % (query, measure), before[measure], after[measure])
+
+def time_query(pirate, query, repeat):
+	" Best time of 'repeat' full searches for 'query', in seconds "
+	best = None
+	for _ in range(repeat):
+		# Searching for nothing discards the matches of earlier searches, so
+		# this one isn't narrowed
+		pirate.get_candidates('')
+		start = time.perf_counter()
+		pirate.get_candidates(query)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def bench_prefilter(pirate, queries, repeat):
+	" Time each query with the character mask prefilter off and on "
+	print('%-12s %10s %10s %10s' % ('query', 'off (ms)', 'on (ms)', 'rejected'))
+	for query in queries:
+		pirate.native.fp_set_prefilter(pirate.index.handle, False)
+		off = time_query(pirate, query, repeat)
+
+		pirate.native.fp_set_prefilter(pirate.index.handle, True)
+		on = time_query(pirate, query, repeat)
+
+		pirate.get_candidates('')
+		before = pirate.stats()
+		pirate.get_candidates(query)
+		after = pirate.stats()
+		checked = after['files_checked'] - before['files_checked']
+		rejected = after['files_rejected'] - before['files_rejected']
+		print('%-12s %10.2f %10.2f %9.1f%%' % (query, off * 1000, on * 1000, 100.0 * rejected / max(checked, 1)))
+
+def bench_simd(pirate, queries, repeat):
+	" Time each query with the scalar matcher and with the vector one "
+	if not pirate.native.fp_set_simd(pirate.index.handle, True):
+		sys.exit('this build of File Pirate has no vector matcher')
+	print('%-12s %12s %10s %8s' % ('query', 'scalar (ms)', 'simd (ms)', 'speedup'))
+	for query in queries:
+		pirate.native.fp_set_simd(pirate.index.handle, False)
+		scalar = time_query(pirate, query, repeat)
+
+		pirate.native.fp_set_simd(pirate.index.handle, True)
+		simd = time_query(pirate, query, repeat)
+		print('%-12s %12.2f %10.2f %7.2fx' % (query, scalar * 1000, simd * 1000, scalar / max(simd, 1e-9)))
+
+def fuzz_query(rng, paths):
+	" A random query: mostly bits of a real path, with some case changes and noise "
+	path = rng.choice(paths)
+	query = ''.join(c for c in path if rng.random() < 0.15) or path[-1]
+	query = ''.join(c.swapcase() if rng.random() < 0.1 else c for c in query)
+	if rng.random() < 0.2:
+		query += rng.choice('xyzXYZ/._0123456789')
+	return query[-rng.randint(1, 12):]
+
+def positions_match(query, path, positions, fold):
+	" Do 'positions' in 'path' spell out 'query'? "
+	path = path.encode('utf-8')
+	found = bytes(path[position] for position in positions)
+	if list(positions) != sorted(set(positions)):
+		return False
+	return found.lower() == query.encode('utf-8').lower() if fold else found == query.encode('utf-8')
+
+def bench_fuzz(root, count, threads, seed):
+	" Check that both matchers agree on 'count' random queries, and that match positions are right "
+	paths = []
+	for dirpath, dirnames, filenames in os.walk(root):
+		paths.extend(os.path.relpath(os.path.join(dirpath, name), root) for name in filenames)
+	rng = random.Random(seed)
+	queries = [fuzz_query(rng, paths) for _ in range(count)]
+	failures = 0
+	for case_name in ('exact', 'ignore'):
+		pirate = filepirate.FilePirate(root, len(paths), [], [], threads=threads, case=CASES[case_name], result_cache=0)
+		if not pirate.native.fp_set_simd(pirate.index.handle, True):
+			sys.exit('this build of File Pirate has no vector matcher')
+		for query in queries:
+			results = []
+			for simd in (False, True):
+				pirate.native.fp_set_simd(pirate.index.handle, simd)
+				pirate.get_candidates('')
+				results.append(pirate.get_candidates(query, relative=True, scores=True))
+			if results[0] != results[1]:
+				failures += 1
+				print('%s %r: scalar found %d, simd found %d' % (case_name, query, len(results[0]), len(results[1])))
+			for path, positions in pirate.get_candidates(query, positions=True):
+				if not positions_match(query, path, positions, case_name == 'ignore'):
+					failures += 1
+					print('%s %r: positions %r in %r' % (case_name, query, positions, path))
+					break
+	print('%d queries, %d files, %d failures' % (count * 2, len(paths), failures))
+	if failures:
+		sys.exit(1)
+
+def bench_walk(root, threads):
+	" Time a full walk of the tree with fts, and with the parallel walker "
+	print('%-12s %10s %10s %12s' % ('walker', 'files', 'time (s)', 'files/sec'))
+	for walk_threads in sorted(set([0, 1, threads])):
+		pirate = filepirate.FilePirate(root, 10, [], [], walk_threads=walk_threads)
+		stats = pirate.stats()
+		seconds = stats['walk_ns'] / 1e9
+		name = 'fts' if walk_threads == 0 else '%d thread%s' % (walk_threads, 's' if walk_threads > 1 else '')
+		print('%-12s %10d %10.2f %12.0f' % (name, stats['walk_files'], seconds, stats['walk_files'] / max(seconds, 1e-9)))
+
+def extract_ctypes(pirate):
+	" The results of the last search, read one candidate at a time "
+	candidates = []
+	result = pirate.candidates.contents
+	for idx in range(result.num_candidates):
+		candidate = result.candidates[idx]
+		candidates.append(os.path.join(candidate.dirname.decode('utf-8'), candidate.filename.decode('utf-8')))
+	return [candidate[2:] if candidate.startswith('./') else candidate for candidate in candidates]
+
+def extract_packed(pirate):
+	" The results of the last search, from fp_candidates_pack "
+	return pirate._unpack(filepirate.PACK_RELATIVE)[0]
+
+def bench_extract(root, queries, num_results, repeat):
+	" Time both ways of extracting 'num_results' results for each query "
+	pirate = filepirate.FilePirate(root, num_results, [], [], result_cache=0)
+	print('%-12s %8s %12s %12s %8s' % ('query', 'results', 'ctypes (ms)', 'packed (ms)', 'speedup'))
+	for query in queries:
+		pirate.get_candidates(query)
+		assert extract_ctypes(pirate) == extract_packed(pirate)
+		times = []
+		for extract in (extract_ctypes, extract_packed):
+			best = None
+			for _ in range(repeat):
+				start = time.perf_counter()
+				extract(pirate)
+				elapsed = time.perf_counter() - start
+				best = elapsed if best is None else min(best, elapsed)
+			times.append(best)
+		print('%-12s %8d %12.3f %12.3f %7.1fx' % (query, pirate.candidates.contents.num_candidates,
+			times[0] * 1000, times[1] * 1000, times[0] / max(times[1], 1e-9)))
+
+def main():
+	parser = argparse.ArgumentParser(description='File Pirate benchmarks')
+	parser.add_argument('--files', type=int, default=1000000, help='number of files in the synthetic tree')
+	parser.add_argument('--root', help='where to build the tree')
+	parser.add_argument('--layout', choices=sorted(LAYOUTS), default='flat',
+			help='flat: random names a few levels deep; deep: Java/JS style multi-module project; tree: balanced tree')
+	parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, help='most directory levels (flat), extra package levels (deep) or levels (tree)')
+	parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT, help='subdirectories of each directory (tree)')
+	parser.add_argument('--names', choices=sorted(NAMES), default='uniform', help='how often each word appears in names')
+	parser.add_argument('--seed', type=int, default=1, help='random seed for the tree')
+	parser.add_argument('--repeat', type=int, default=5, help='builds, and times each query is typed or searched for')
+	parser.add_argument('--threads', type=int, default=1, help='threads for searching and walking')
+	parser.add_argument('--case', choices=sorted(CASES), default='exact', help='how letters match')
+	parser.add_argument('--json', metavar='FILE', help='write the results to FILE')
+	parser.add_argument('--compare', metavar='FILE', help='compare the results with those in FILE, from --json')
+	parser.add_argument('--prefilter', action='store_true', help='compare the prefilter off and on rather than time typing')
+	parser.add_argument('--walk', action='store_true', help='compare walkers rather than time searches')
+	parser.add_argument('--extract', action='store_true', help='compare ways of getting results out rather than time searches')
+	parser.add_argument('--results', type=int, default=500, help='results to get out for --extract')
+	parser.add_argument('--simd', action='store_true', help='compare the scalar and vector matchers rather than time typing')
+	parser.add_argument('--fuzz', type=int, metavar='N', help='check the scalar and vector matchers agree on N random queries')
+	parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES)
+	args = parser.parse_args()
+
+	name = tree_name(args.files, args.layout, args.depth, args.fanout, args.names, args.seed)
+	root = args.root or os.path.join(default_root(), 'filepirate-bench-' + name)
+	start = time.perf_counter()
+	make_tree(root, args.files, args.layout, args.depth, args.fanout, args.names, args.seed)
+	print('tree: %s (%.1fs)' % (root, time.perf_counter() - start))
+
+	if args.walk:
+		bench_walk(root, args.threads)
+		return
+
+	if args.extract:
+		bench_extract(root, args.queries, args.results, args.repeat)
+		return
+
+	if args.fuzz:
+		bench_fuzz(root, args.fuzz, args.threads, args.seed)
+		return
+
+	pirate, build = bench_build(root, args.repeat, args.threads, CASES[args.case])
+
+	if args.prefilter:
+		bench_prefilter(pirate, args.queries, args.repeat)
+		return
+
+	if args.simd:
+		bench_simd(pirate, args.queries, args.repeat)
+		return
+
+	typing, keystrokes = bench_typing(pirate, args.queries, args.repeat)
+	results = {'format': RESULTS_FORMAT, 'commit': git_commit(), 'time': time.time(),
+			'host': {'machine': platform.machine(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+			'tree': {'name': name, 'layout': args.layout, 'files': args.files, 'depth': args.depth,
+				'fanout': args.fanout, 'names': args.names, 'seed': args.seed},
+			'threads': args.threads, 'case': args.case, 'repeat': args.repeat, 'build': build,
+			'typing': typing, 'keystrokes': keystrokes}
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+			f.write('\n')
+
+	if args.compare:
+		with open(args.compare) as f:
+			compare(json.load(f), results)
+
+if __name__ == '__main__':
+	main()
+
+# vim: sw=4 noet ts=4:
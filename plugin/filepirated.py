@@ -0,0 +1,240 @@
+"""
+File Pirate daemon
+
+Keeps indexes for any number of roots, and answers queries for them over a
+Unix socket, so several editors working on the same tree share one index.
+Run as:
+
+    python3 filepirated.py [--socket PATH] [--no-watch] [--cache] [--threads N] [--no-frecency] [--trace FILE]
+
+The protocol is line based. Each request is a JSON object on a line of its
+own, and gets a JSON object on a line of its own in reply. Every request has
+an "op", and every reply has "ok", plus "error" if it is false:
+
+  search            root, term, max_candidates, negative, positive, git,
+                    case, relative, scores, positions
+                    -> results, generation, truncated, rescanning, latency_ms
+  rescan            root, max_candidates, negative, positive, git, case
+  stats             root, max_candidates, negative, positive, git, case -> stats
+  invalidate_cache  root (or null for every root)
+
+An index is kept for each combination of root, max_candidates, filters, git
+and case (see filepirate.FilePirate).
+Requests on one connection are answered in order; use one connection per
+client thread. See filepirate.RemoteFilePirate for the client.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import stat
+import socket
+import argparse
+import threading
+import collections
+import socketserver
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import filepirate
+
+DEFAULT_MAX_ROOTS = 20
+
+class Daemon(object):
+	" The indexes, and the requests which use them. 'options' are passed on to each FilePirate. "
+	def __init__(self, max_roots=DEFAULT_MAX_ROOTS, verbose=False, **options):
+		self.max_roots = max_roots
+		self.verbose = verbose
+		self.options = options
+		self.lock = threading.Lock()
+		# Key -> [lock, FilePirate or None], least recently used first
+		self.pirates = collections.OrderedDict()
+		self.queries = 0
+		self.query_seconds = 0.0
+
+	def get(self, root, max_candidates, negative, positive, git=filepirate.GIT_OFF, case=filepirate.CASE_EXACT):
+		" The FilePirate for this root and these filters, creating it if need be "
+		key = (root, max_candidates, tuple(negative), tuple(positive), git, case)
+		with self.lock:
+			entry = self.pirates.get(key)
+			if entry is None:
+				entry = self.pirates[key] = [threading.Lock(), None]
+				while len(self.pirates) > self.max_roots:
+					# Searches still using it keep it alive until they finish
+					self.pirates.popitem(last=False)
+			self.pirates.move_to_end(key)
+
+		# Other roots can be used while this one is indexed
+		with entry[0]:
+			if entry[1] is None:
+				entry[1] = filepirate.FilePirate(root, max_candidates, list(negative), list(positive), git=git, case=case,
+						**self.options)
+			return entry[1]
+
+	def _pirate(self, request):
+		return self.get(request['root'], int(request.get('max_candidates', 10)),
+				request.get('negative', []), request.get('positive', []), int(request.get('git', filepirate.GIT_OFF)),
+				int(request.get('case', filepirate.CASE_EXACT)))
+
+	def search(self, request):
+		pirate = self._pirate(request)
+		start = time.perf_counter()
+		results = pirate.get_candidates(request['term'], bool(request.get('relative')), bool(request.get('scores')),
+				bool(request.get('positions')))
+		elapsed = time.perf_counter() - start
+
+		with self.lock:
+			self.queries += 1
+			self.query_seconds += elapsed
+		if self.verbose:
+			print('%s %r: %d results in %.2fms' % (request['root'], request['term'], len(results), elapsed * 1000))
+
+		return {'results': results,
+				'generation': pirate.last_generation,
+				'truncated': pirate.truncated(),
+				'rescanning': pirate.rescanning,
+				'latency_ms': elapsed * 1000}
+
+	def rescan(self, request):
+		self._pirate(request).rescan()
+		return {}
+
+	def stats(self, request):
+		stats = self._pirate(request).stats()
+		with self.lock:
+			stats['daemon_queries'] = self.queries
+			stats['daemon_query_ms'] = self.query_seconds * 1000
+			stats['daemon_roots'] = len(self.pirates)
+		return {'stats': stats}
+
+	def invalidate_cache(self, request):
+		root = request.get('root')
+		filepirate.invalidate_cache(root)
+		with self.lock:
+			entries = [entry for key, entry in self.pirates.items() if root is None or key[0] == root]
+		for entry in entries:
+			if entry[1] is not None:
+				entry[1].rescan()
+		return {}
+
+	OPS = {'search': search, 'rescan': rescan, 'stats': stats, 'invalidate_cache': invalidate_cache}
+
+	def handle(self, line):
+		" Answer one request line. Returns the reply line. "
+		try:
+			request = json.loads(line)
+			op = self.OPS.get(request.get('op'))
+			if op is None:
+				raise filepirate.Error("unknown op %r" % (request.get('op')))
+			reply = op(self, request)
+			reply['ok'] = True
+		except Exception as e:
+			reply = {'ok': False, 'error': str(e)}
+		return json.dumps(reply) + '\n'
+
+class RequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			self.wfile.write(self.server.pirate_daemon.handle(line.decode('utf-8')).encode('utf-8'))
+			self.wfile.flush()
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	" Answers each client in its own thread "
+	daemon_threads = True
+
+	def __init__(self, socket_path, daemon):
+		self.pirate_daemon = daemon
+		self.socket_path = socket_path
+		remove_stale_socket(socket_path)
+		old_umask = os.umask(0o077)
+		try:
+			socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+		finally:
+			os.umask(old_umask)
+		# To tell our socket from one which has replaced it
+		self.socket_inode = os.stat(socket_path).st_ino
+
+	def remove_socket(self):
+		" Remove the socket, unless another daemon has replaced it since "
+		try:
+			if os.stat(self.socket_path).st_ino == self.socket_inode:
+				os.remove(self.socket_path)
+		except FileNotFoundError:
+			pass
+
+class AlreadyRunning(Exception):
+	pass
+
+class NotASocket(Exception):
+	pass
+
+def remove_stale_socket(socket_path):
+	"""
+	Remove 'socket_path' if it's left over from a daemon which didn't exit
+	cleanly. Raises AlreadyRunning if a daemon is still listening on it, and
+	NotASocket if it's something else, such as a mistyped file name.
+	"""
+	try:
+		if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+			raise NotASocket(socket_path)
+	except FileNotFoundError:
+		return
+
+	probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		probe.connect(socket_path)
+	except (ConnectionRefusedError, FileNotFoundError):
+		pass
+	else:
+		raise AlreadyRunning(socket_path)
+	finally:
+		probe.close()
+
+	try:
+		os.remove(socket_path)
+	except FileNotFoundError:
+		pass
+
+def main():
+	parser = argparse.ArgumentParser(description='File Pirate daemon')
+	parser.add_argument('--socket', default=filepirate.default_socket(), help='where to listen (default: %(default)s)')
+	parser.add_argument('--no-watch', dest='watch', action='store_false', help="don't watch the trees for changes")
+	parser.add_argument('--cache', action='store_true', help='save the indexes to the on-disk cache')
+	parser.add_argument('--threads', type=int, default=0, help='threads for each search; 0 means one per CPU')
+	parser.add_argument('--memory-limit', type=int, default=0, help='most memory, in MB, each index may use; 0 for the default')
+	parser.add_argument('--max-roots', type=int, default=DEFAULT_MAX_ROOTS, help='indexes to keep (default: %(default)s)')
+	parser.add_argument('--no-frecency', dest='frecency', action='store_false',
+			help="don't rank files the editors open often higher")
+	parser.add_argument('--verbose', action='store_true', help='print the latency of every query')
+	parser.add_argument('--trace', metavar='FILE', help='append every search and index build to FILE, as JSON lines')
+	args = parser.parse_args()
+
+	daemon = Daemon(args.max_roots, args.verbose, watch=args.watch, cache=args.cache,
+			threads=args.threads if args.threads > 0 else (os.cpu_count() or 1),
+			memory_limit=args.memory_limit * 1024 * 1024 if args.memory_limit > 0 else None,
+			frecency=filepirate.Frecency() if args.frecency else None,
+			trace=filepirate.Trace(args.trace) if args.trace else None)
+	try:
+		server = Server(args.socket, daemon)
+	except AlreadyRunning:
+		sys.exit('filepirated: a daemon is already running on %s' % (args.socket))
+	except NotASocket:
+		sys.exit('filepirated: %s exists and is not a socket' % (args.socket))
+	except OSError as e:
+		sys.exit('filepirated: %s: %s' % (args.socket, e.strerror or e))
+	# Clean up the socket when killed, too
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	print('filepirated: listening on %s' % (args.socket))
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		server.remove_socket()
+
+if __name__ == '__main__':
+	main()
+
+# vim: sw=4 noet ts=4:
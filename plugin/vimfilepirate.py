@@ -17,11 +17,16 @@ import os
 
 import filepirate
 
-POLL_INTERVAL = 100 # milliseconds
+POLL_INTERVAL = 100 # milliseconds, when polling with CursorHold
+TIMER_INTERVAL = 2 # milliseconds, when polling with a timer
 DUMMY_FILEPIRATE = False # Debug -- provide bogus results
 DUMMY_FILEPIRATE_DELAY = 3 # Seconds
 PROMPT = '> '
 SPINNER_DELAY = 1 # seconds between starting a search and showing the spinner
+SPINNER_INTERVAL = 0.1 # seconds between turns of the spinner
+PROGRESS_INTERVAL = 50 # milliseconds between updates of the best results so far, while searching
+MATCH_GROUP = 'FilePirateMatch' # Highlight group for the characters which matched the search term
+MATCHADDPOS_MAX = 8 # Positions per matchaddpos() call; older Vims don't take any more
 
 BUFFER_OPTIONS = [
 	'bufhidden=unload',  # unload buf when no longer displayed
@@ -81,7 +86,17 @@ CONFIGURABLES = {'g:filepirate_max_results': (int, 10),
 		'g:filepirate_is_modal': (int, 0),
 		'g:filepirate_map_extra_normal': (dict, {}),
 		'g:filepirate_map_extra_insert': (dict, {}),
-		'g:filepirate_negative_filter': (list, [])}
+		'g:filepirate_negative_filter': (list, []),
+		'g:filepirate_watch': (int, 0),
+		'g:filepirate_cache': (int, 0),
+		'g:filepirate_threads': (int, 0),
+		'g:filepirate_memory_limit': (int, 0),
+		'g:filepirate_daemon': (str, ''),
+		'g:filepirate_git': (int, 0),
+		'g:filepirate_case': (int, filepirate.CASE_SMART),
+		'g:filepirate_frecency': (int, 1),
+		'g:filepirate_result_cache': (int, filepirate.RESULT_CACHE_SIZE),
+		'g:filepirate_trace': (str, '')}
 
 # Shown while reloading directory information
 SPINNER = r'/-\|'
@@ -102,7 +117,12 @@ class ConfigLoadError(Exception):
 class FilePirateThread(threading.Thread):
 	"""
 	This runs in the background and searches for things the user types.  When
-	the search is complete, "results" is set to a list of matching names.
+	the search is complete, "results" is set to a list of (name, positions)
+	tuples: each matching name, and the byte offsets of the characters in it
+	which matched. "notes" is set at the same time, to a list of things to
+	tell the user about the index the results came from, such as that it was
+	truncated or is being rescanned; these are shown on the search line
+	rather than as results.
 	While searches are in progress (= "idle" is False), new searches can be
 	enqueued. "results" is only set when the final such enqueued search
 	completes.
@@ -118,27 +138,50 @@ class FilePirateThread(threading.Thread):
 	The reason this is done with idle flags and so on instead of callbacks is
 	because Vim doesn't support asynchronous notification, so the interface
 	code below is obliged to poll this object for results. It does this every
-	POLL_INTERVAL ms (default 0.1 seconds).
+	TIMER_INTERVAL ms (default 2) while a search is running, or every
+	POLL_INTERVAL ms (default 0.1 seconds) in Vims without timers; see
+	VimAsync.
 
-	TODO: An obvious improvement is to add support for cancelling in-progress
-	searches, perhaps with a flag that the native code can check once per
-	directory, or possibly just by having a separate search thread and killing
-	it off.
+	Enqueueing a search cancels the one in progress, since its results would
+	be thrown away anyway. The native code checks for cancellation every so
+	often while scanning.
+
+	If the results for a term are still in the FilePirate's cache, search()
+	sets "results" straight away, without waking the thread.
+
+	While a search is in progress, partial() returns the best results it has
+	found so far, so that they can be shown before it finishes.
+
+	The time searches wait to be picked up, the time from search() until
+	the results are displayed (see displayed()), and the time from the
+	results being ready until they are displayed, are added up for stats(),
+	and written to the 'trace' option, if it is a filepirate.Trace.
 	"""
-	def __init__(self, max_results):
+	def __init__(self, max_results, **options):
 		threading.Thread.__init__(self)
 		self.daemon = True
 		self.search_terms = []
+		self.serial = 0 # Of the latest search
+		self.active_serial = 0 # Of the search in progress, if any
+		self.queued_at = 0 # When the latest search was started
+		self.queue_wait = 0 # Seconds the latest search waited for the thread
+		self.cached = False # Were the latest search's results from the cache?
+		self.trace = options.get('trace')
+		self.finished_at = 0 # When the latest search's results were ready
+		self.timings = {'searches': 0, 'searches_cached': 0, 'queue_wait_ns': 0, 'displayed': 0, 'display_ns': 0,
+				'deliver_ns': 0}
 		self.lock = threading.Lock()
 		self.event = threading.Event()
 		self.results = None
+		self.notes = []
 		self.rescan_requested = False
+		self.active_pirate = None # The FilePirate currently searching, if any
 		if DUMMY_FILEPIRATE:
 			self.do_search = self._do_search_dummy
 			self.dummy_counter = 0
 		else:
 			self.do_search = self._do_search_fp
-			self.pirates = filepirate.FilePirates(max_results)
+			self.pirates = filepirate.FilePirates(max_results, **options)
 
 	def run(self):
 		while True:
@@ -153,16 +196,21 @@ class FilePirateThread(threading.Thread):
 			self.lock.acquire()
 			if self.search_terms:
 				term = self.search_terms[-1]
+				serial = self.active_serial = self.serial
+				self.queue_wait = time.perf_counter() - self.queued_at
+				self.timings['queue_wait_ns'] += int(self.queue_wait * 1e9)
 				self.search_terms = []
 				self.event.clear()
 				self.lock.release()
 
-				self.results = None
-
-				results = self.do_search(term)
+				results, notes = self.do_search(term)
 
-				if not self.search_terms: # Still good!
+				self.lock.acquire()
+				if serial == self.serial: # Still good!
 					self.results = results
+					self.notes = notes
+					self.finished_at = time.perf_counter()
+				self.lock.release()
 			else:
 				self.event.clear()
 				self.lock.release()
@@ -172,33 +220,110 @@ class FilePirateThread(threading.Thread):
 		try:
 			pirate = self.pirates.get(os.getcwd())
 		except Exception as e:
-			return ["ERROR: %s" % (str(e))]
+			return [("ERROR: %s" % (str(e)), ())], []
 
 		if self.rescan_requested:
+			# Searches carry on against the old index until the new one is ready
 			pirate.rescan()
 			self.rescan_requested = False
 
 		try:
-			results = pirate.get_candidates(term)
+			self.active_pirate = pirate
+			results = pirate.get_candidates(term, relative=True, positions=True)
+		except filepirate.Cancelled:
+			# A newer search is waiting, so these results would be discarded anyway.
+			return [], []
 		except Exception as e:
-			return ["ERROR: %s" % (str(e))]
-		# FIXME: Hackish, and not necessary (just pretty)
-		results = [result[2:] if result.startswith('./') else result for result in results]
-		return results
+			return [("ERROR: %s" % (str(e)), ())], []
+		finally:
+			self.active_pirate = None
+		return self._format_results(pirate, results)
+
+	def partial(self):
+		" The best results so far of the latest search, if it's still in progress, or None "
+		with self.lock:
+			pirate = self.active_pirate
+			if pirate is None or self.active_serial != self.serial or self.results is not None:
+				return None
+		return pirate.progress(relative=True, positions=True)
+
+	def _format_results(self, pirate, results):
+		" 'results', and notes about the index they came from "
+		notes = []
+		if pirate.truncated():
+			notes.append("WARNING: index truncated; raise g:filepirate_memory_limit")
+		if pirate.rescanning:
+			notes.append("(rescanning...)")
+		return results, notes
 
 	def _do_search_dummy(self, term):
 		# called from within thread -- pretend to search
 		self.dummy_counter += 1
 		time.sleep(DUMMY_FILEPIRATE_DELAY)
 		self.rescan_requested = False
-		return ['Test file - %d - %s' % (self.dummy_counter, term) for i in range(10)]
+		return [('Test file - %d - %s' % (self.dummy_counter, term), ()) for i in range(10)], []
+
+	def _cached_search(self, term):
+		" Results for 'term' from the FilePirate's cache, and notes about them, or None "
+		if DUMMY_FILEPIRATE or self.rescan_requested:
+			return None
+		pirate = self.pirates.find(os.getcwd())
+		if pirate is None:
+			return None
+		results = pirate.cached_candidates(term, relative=True, positions=True)
+		if results is None:
+			return None
+		return self._format_results(pirate, results)
 
 	def search(self, term):
+		cached = self._cached_search(term)
+		results = cached[0] if cached is not None else None
+
 		self.lock.acquire()
-		self.search_terms.append(term)
-		self.event.set()
+		self.serial += 1
+		self.queued_at = time.perf_counter()
+		self.queue_wait = 0
+		self.cached = results is not None
+		self.timings['searches'] += 1
+		self.timings['searches_cached'] += self.cached
+		pirate = self.active_pirate
+		if pirate is not None:
+			pirate.cancel()
+		if results is not None:
+			# Any search still queued is for an older term
+			self.search_terms = []
+		else:
+			self.search_terms.append(term)
+			self.event.set()
+		self.results = results
+		if cached is not None:
+			self.notes = cached[1]
+		self.finished_at = self.queued_at
 		self.lock.release()
 	
+	def displayed(self, term):
+		" Called when the results of the latest search, for 'term', have been drawn "
+		with self.lock:
+			now = time.perf_counter()
+			elapsed = now - self.queued_at
+			deliver = now - self.finished_at
+			self.timings['displayed'] += 1
+			self.timings['display_ns'] += int(elapsed * 1e9)
+			self.timings['deliver_ns'] += int(deliver * 1e9)
+			queue_wait, cached = self.queue_wait, self.cached
+		if self.trace:
+			self.trace.write('display', term=term, cached=cached, queue_wait_ms=queue_wait * 1000, display_ms=elapsed * 1000,
+					deliver_ms=deliver * 1000)
+
+	def stats(self):
+		" Timings from this thread, and statistics from the FilePirate for the current directory, if any "
+		with self.lock:
+			stats = dict(self.timings)
+		pirate = None if DUMMY_FILEPIRATE else self.pirates.find(os.getcwd())
+		if pirate is not None:
+			stats.update(pirate.stats())
+		return stats
+
 	def rescan(self):
 		self.rescan_requested = True
 
@@ -207,17 +332,31 @@ class FilePirateThread(threading.Thread):
 		self.pirates.add_negative_filter(filter)
 		self.lock.release()
 
+	def record_open(self, path):
+		if not DUMMY_FILEPIRATE:
+			self.pirates.record_open(path)
+
 class VimAsync(object):
 	"""
 	Simulates vim-plugin-initiated communication using polling.
 
-	Unfortunately Vim doesn't really support polling either.  Consequently this
-	is a massive hack. For more details, see
+	Vim doesn't let other threads call into it, so while a search is running,
+	the callback is called from Vim's main loop every so often to see whether
+	there is anything to draw. The callback returns True if it drew anything.
+
+	Where Vim has timers (Vim 8 and Neovim), a repeating timer calls it every
+	TIMER_INTERVAL ms. The timer only runs between start() and stop(), so
+	nothing is polled while idle.
+
+	Otherwise this is a massive hack, which can only call back every
+	POLL_INTERVAL ms. For more details, see
 	http://vim.wikia.com/wiki/Timer_to_execute_commands_periodically
 	"""
 
 	def __init__(self):
 		self.running = False
+		self.timer = None
+		self.use_timers = vim.eval("exists('*timer_start')") == '1'
 		self.clear()
 		self.saved_updatetime = int(vim.eval('&updatetime'))
 	
@@ -228,25 +367,40 @@ class VimAsync(object):
 	def start(self, callback, *args):
 		self.callback = callback
 		self.callback_args = args
-		if not self.running:
+		if self.running:
+			return
+		if self.use_timers:
+			self.timer = int(vim.eval("timer_start(%d, 'FilePirateTimer', {'repeat': -1})" % (TIMER_INTERVAL)))
+		else:
 			# Set up our CursorHold autocommand callback
 			self.saved_updatetime = int(vim.eval('&updatetime'))
 			vim.command('set updatetime=%d' % (POLL_INTERVAL))
 			vim.command("au CursorHold * python3 filepirate_callback()")
 			# The magic key we remap for KeyHold timer updates
 			vim.command('noremap <silent> <buffer> <C-A> :python3 ""<CR>')
-			self.running = True
+		self.running = True
 	
 	def stop(self):
-		vim.command('set updatetime=%d' % (self.saved_updatetime))
-		vim.command("au! CursorHold *")
+		if self.use_timers:
+			if self.timer is not None:
+				vim.eval('timer_stop(%d)' % (self.timer))
+				self.timer = None
+		else:
+			vim.command('set updatetime=%d' % (self.saved_updatetime))
+			vim.command("au! CursorHold *")
 		self.running = False
 		self.clear()
 
 	def from_vim(self):
-		assert self.running
-		self.callback(*self.callback_args)
-		vim.command('call feedkeys("\\<C-A>")')
+		if not self.running:
+			# A timer which fired before it was stopped
+			return
+		drawn = self.callback(*self.callback_args)
+		if self.use_timers:
+			if drawn:
+				vim.command('redraw')
+		else:
+			vim.command('call feedkeys("\\<C-A>")')
 
 class VimFilePirate(object):
 	"""
@@ -257,12 +411,16 @@ class VimFilePirate(object):
 		self.config_load()
 
 		self.buf = None
+		self.lines = [] # What the buffer shows, as of the last render()
+		self.highlighted = [] # Match positions of each result line highlighted by render()
 		self.vimasync = VimAsync()
 		self.fp = None
 		self.searching = False
 		self.stored_vim_globals = {}
 		self.previous_window_number = None
 		self.search_start_time = 0
+		self.last_progress = 0 # When search_poll() last looked for the best results so far
+		self.last_spin = 0 # When search_poll() last turned the spinner
 		self.reset()
 	
 	def reset(self):
@@ -294,13 +452,10 @@ class VimFilePirate(object):
 		# Set up the window.
 		self.buffer_register_keys()
 		self.buf = vim.current.buffer
+		self.lines = self.buf[:]
+		self.highlighted = []
 
-		self.draw_search_line()
-		self.unlock_buffer()
-		for idx in range(self.config['g:filepirate_max_results']):
-			if len(self.buf) - 2 < idx:
-				self.buf.append('')
-		self.lock_buffer()
+		self.render(self.search_line(), [])
 		vim.current.window.cursor = (2, 0)
 	
 	def config_load(self):
@@ -313,7 +468,7 @@ class VimFilePirate(object):
 				try:
 					if key_class is int:
 						value = int(value)
-					elif key_class in (list, dict):
+					elif key_class in (str, list, dict):
 						# Nothing special to do
 						pass
 					else:
@@ -398,26 +553,40 @@ class VimFilePirate(object):
 			self._buffer_unregister_keys_special(KEYS['normal'])
 	
 	def search_poll(self):
-		if self.searching is True:
-			if self.fp and self.fp.results is not None:
-				self.spinner_character = ' '
-				self.vimasync.stop()
-				self.searching = False
-				self.draw_search_line()
-				self.show_results(self.fp.results)
-			else:
-				self.advance_spinner()
+		" Draw the results, or the best so far, if there are any. Returns True if anything was drawn. "
+		if self.searching is not True:
+			return False
+		if self.fp and self.fp.results is not None:
+			self.spinner_character = ' '
+			self.vimasync.stop()
+			self.searching = False
+			self.render(self.search_line(), self.fp.results)
+			self.fp.displayed(self.term)
+			return True
+
+		drawn = False
+		now = time.time()
+		if now - self.last_progress >= PROGRESS_INTERVAL / 1000.0:
+			self.last_progress = now
+			partial = self.fp.partial() if self.fp else None
+			if partial is not None:
+				drawn = self.render(results=partial)
+		if now - self.last_spin >= SPINNER_INTERVAL:
+			self.last_spin = now
+			drawn = self.advance_spinner() or drawn
+		return drawn
 	
 	def advance_spinner(self):
 		if time.time() - self.search_start_time > SPINNER_DELAY:
 			self.spinner_character = SPINNER[self.spinner_position]
 			self.spinner_position = (self.spinner_position + 1) % len(SPINNER)
-			self.draw_search_line()
-	
-	def draw_search_line(self):
-		self.unlock_buffer()
-		self.buf[0] = self.spinner_character + PROMPT + self.term
-		self.lock_buffer()
+			return self.render(self.search_line())
+		return False
+
+	def search_line(self):
+		" The spinner, the search term, and anything the FilePirateThread has to say about the index "
+		notes = self.fp.notes if self.fp else []
+		return self.spinner_character + PROMPT + self.term + ''.join('  ' + note for note in notes)
 
 	def lock_buffer(self):
 		vim.command('setlocal nomodifiable')
@@ -425,13 +594,56 @@ class VimFilePirate(object):
 	def unlock_buffer(self):
 		vim.command('setlocal modifiable')
 
-	def show_results(self, results):
-		self.unlock_buffer()
-		for idx, result in enumerate(results):
-			self.buf[idx + 1] = ' ' + result
-		for idx in range(len(results), self.config['g:filepirate_max_results']):
-			self.buf[idx + 1] = ''
-		self.lock_buffer()
+	def render(self, search_line=None, results=None):
+		"""
+		Show 'search_line' on the first line, and 'results', a list of (name,
+		positions) tuples, on the rest, leaving out either if it's None.
+		Only the lines which differ from what's shown are replaced, with one
+		assignment, and nothing is done if none do. Returns True if anything
+		changed.
+		"""
+		lines = list(self.lines) or ['']
+		if search_line is not None:
+			lines[0] = search_line
+		if results is not None:
+			lines[1:] = [' ' + result for result, positions in results]
+			lines.extend([''] * (self.config['g:filepirate_max_results'] + 1 - len(lines)))
+
+		# Replace everything between the lines which are the same at the start and the end
+		old = self.lines
+		start = 0
+		while start < min(len(lines), len(old)) and lines[start] == old[start]:
+			start += 1
+		end = 0
+		while end < min(len(lines), len(old)) - start and lines[-end - 1] == old[-end - 1]:
+			end += 1
+		changed = start < len(lines) or start < len(old)
+		if changed:
+			self.unlock_buffer()
+			self.buf[start:len(old) - end] = lines[start:len(lines) - end]
+			self.lock_buffer()
+			self.lines = lines
+
+		if results is not None:
+			matched = [positions for result, positions in results]
+			if matched != self.highlighted:
+				self.highlight_matches(matched)
+				self.highlighted = matched
+				changed = True
+		return changed
+
+	def highlight_matches(self, matched):
+		"""
+		Highlight the characters of each result which matched, given their
+		positions, replacing the last highlights, in one command
+		"""
+		# Results start on the second line, after a space; columns count bytes from 1
+		positions = ['[%d,%d]' % (idx + 2, position + 2)
+				for idx, result_positions in enumerate(matched) for position in result_positions]
+		commands = ['call clearmatches()']
+		for start in range(0, len(positions), MATCHADDPOS_MAX):
+			commands.append("call matchaddpos('%s',[%s])" % (MATCH_GROUP, ','.join(positions[start:start + MATCHADDPOS_MAX])))
+		vim.command('|'.join(commands))
 
 	def set_global_options(self):
 		" Remember the previous global options settings, and set our ones. "
@@ -474,17 +686,41 @@ class VimFilePirate(object):
 			self.spinner_character = ' '
 			self.search_start_time = time.time()
 		self.term = term
-		self.draw_search_line()
 		self.vimasync.start(self.search_poll)
 		fp.search(self.term)
 		self.searching = True
+		if fp.results is not None:
+			# From the cache, so there's no need to wait for the next poll.
+			# This draws the search line too.
+			self.search_poll()
+		else:
+			self.render(self.search_line())
 
 	def _get_pirate(self):
 		if self.fp is None:
-			self.fp = FilePirateThread(self.config['g:filepirate_max_results'])
+			self.fp = FilePirateThread(self.config['g:filepirate_max_results'], **self._pirate_options())
 			self.fp.start()
 		return self.fp
 	
+	def _pirate_options(self):
+		" Options for each FilePirate, from the configuration "
+		threads = self.config['g:filepirate_threads']
+		if threads <= 0:
+			threads = os.cpu_count() or 1
+		memory_limit = self.config['g:filepirate_memory_limit']
+		return {'watch': bool(self.config['g:filepirate_watch']),
+				'cache': bool(self.config['g:filepirate_cache']),
+				'threads': threads,
+				'memory_limit': memory_limit * 1024 * 1024 if memory_limit > 0 else None,
+				'git': self.config['g:filepirate_git'],
+				'case': self.config['g:filepirate_case'],
+				'daemon': self.config['g:filepirate_daemon'] or None,
+				'result_cache': self.config['g:filepirate_result_cache'],
+				'progress_interval': PROGRESS_INTERVAL,
+				'trace': filepirate.Trace(os.path.expanduser(self.config['g:filepirate_trace'])) if self.config['g:filepirate_trace'] else None,
+				# Not read until the first search
+				'frecency': filepirate.Frecency() if self.config['g:filepirate_frecency'] else None}
+	
 	def filepirate_accept(self, line_number = None):
 		" Close the File Pirate window and switch to the selected file "
 		if line_number is None:
@@ -493,6 +729,8 @@ class VimFilePirate(object):
 		else:
 			# 0-indexed
 			filename = self.buf[line_number + 1][1:]
+		if self.fp is not None and os.path.isfile(filename):
+			self.fp.record_open(filename)
 		filename = filename.replace(' ', r'\ ')
 		self.filepirate_close()
 
@@ -541,6 +779,17 @@ class VimFilePirate(object):
 	def filepirate_add_negative_filter(self, filter):
 		self._get_pirate().add_negative_filter(filter)
 
+	def filepirate_stats(self):
+		" Print timings and counters, for :FilePirateStats "
+		if self.fp is None:
+			print("File Pirate hasn't searched yet")
+			return
+		for name, value in sorted(self.fp.stats().items()):
+			if name.endswith('_ns'):
+				print('%s: %.1f ms' % (name[:-3], value / 1e6))
+			else:
+				print('%s: %s' % (name, value))
+
 # Singleton
 vim_file_pirate = VimFilePirate()
 
@@ -557,5 +806,6 @@ filepirate_rescan   = vim_file_pirate.filepirate_rescan
 filepirate_enter_insert_mode = vim_file_pirate.filepirate_enter_insert_mode
 filepirate_enter_normal_mode = vim_file_pirate.filepirate_enter_normal_mode
 filepirate_add_negative_filter = vim_file_pirate.filepirate_add_negative_filter
+filepirate_stats    = vim_file_pirate.filepirate_stats
 
 # vim: set sw=4 noet ts=4: